@@ -0,0 +1,61 @@
+"""
+Compares the native aaxc decrypter with ffmpeg on a downloaded file.
+
+Usage: python benchmarks/decrypt_benchmark.py book.aax --key <hex> --iv <hex>
+
+The key and iv are the ones from the decryption voucher of the book's license.
+"""
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+import aax_decrypter
+
+def decrypt_native(source: str, destination: str, key: str, iv: str):
+    aax_decrypter.decrypt_file(source, destination, key, iv)
+
+def decrypt_ffmpeg(source: str, destination: str, key: str, iv: str):
+    subprocess.run(
+        ['ffmpeg', '-y', '-audible_key', key, '-audible_iv', iv, '-i', source, '-c', 'copy', destination],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True
+    )
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark aaxc decryption")
+    parser.add_argument("file")
+    parser.add_argument("--key", required=True)
+    parser.add_argument("--iv", required=True)
+    parser.add_argument("--runs", default=3, type=int)
+    args = parser.parse_args()
+
+    engines = {}
+    if aax_decrypter.is_available():
+        engines['native'] = decrypt_native
+    else:
+        print('cryptography is not installed, skipping the native decrypter')
+    if shutil.which('ffmpeg'):
+        engines['ffmpeg'] = decrypt_ffmpeg
+    else:
+        print('ffmpeg is not on the PATH, skipping it')
+
+    size_mb = os.path.getsize(args.file) / 1024 / 1024
+    with tempfile.TemporaryDirectory() as tmp:
+        for name, decrypt in engines.items():
+            destination = os.path.join(tmp, f'{name}.m4a')
+            times = []
+            for _ in range(args.runs):
+                start = time.perf_counter()
+                decrypt(args.file, destination, args.key, args.iv)
+                times.append(time.perf_counter() - start)
+                os.remove(destination)
+            best = min(times)
+            print(f'{name:>7}: best {best:.2f}s of {args.runs}, {size_mb / best:.0f} MiB/s')
+
+if __name__ == "__main__":
+    main()
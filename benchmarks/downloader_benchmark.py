@@ -0,0 +1,176 @@
+"""
+Runs library_downloader against the fake audible api and CDN of fake_audible.py and reports books per minute and
+bytes per second.
+
+Usage: python benchmarks/downloader_benchmark.py --books 50 --file-size 8388608 --bandwidth 10485760 --error-rate 0.02
+
+The fake server runs in its own process, so it doesn't compete with the downloader for the event loop. First
+download_books_and_metadata syncs the whole library into an empty temp folder, then update_metadata refreshes
+the metadata, including the unlisted books, which are only found in the catalog.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import platform
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+from typing import Dict
+
+import httpx
+
+from fake_audible import FakeAudibleConfig, add_config_arguments, config_from_arguments, fake_audible_client
+from library_benchmark import SRC_FOLDER, generate_library_items
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def start_server(config: FakeAudibleConfig, cache_folder: str, timeout: float = 300.0) -> tuple[subprocess.Popen, str]:
+    """Starts fake_audible.py and waits until it answers, generating the audio files can take a while."""
+    port = _free_port()
+    url = f'http://127.0.0.1:{port}'
+    proc = subprocess.Popen([
+        sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fake_audible.py'),
+        '--port', str(port), '--cache-folder', cache_folder, *config.arguments(),
+    ])
+
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            httpx.get(f'{url}/stats').raise_for_status()
+            return proc, url
+        except httpx.TransportError:
+            if proc.poll() is not None or time.monotonic() > deadline:
+                proc.kill()
+                raise RuntimeError('Fake audible server did not start')
+            time.sleep(0.2)
+
+def _folder_bytes(folder: str, suffix: str) -> tuple[int, int]:
+    files = [entry for entry in os.scandir(folder) if entry.name.endswith(suffix)]
+    return len(files), sum(entry.stat().st_size for entry in files)
+
+async def run_benchmark(args: argparse.Namespace, config: FakeAudibleConfig, url: str, folder: str) -> Dict:
+    import folder_settings
+    folder_settings.AUDIO_FOLDER = os.path.join(folder, 'audio')
+    folder_settings.METADATA_FOLDER = os.path.join(folder, 'metadata')
+    folder_settings.DOWNLOAD_FOLDER = os.path.join(folder, 'downloads')
+    for path in (folder_settings.AUDIO_FOLDER, folder_settings.METADATA_FOLDER, folder_settings.DOWNLOAD_FOLDER):
+        os.makedirs(path)
+
+    import book_store
+    import library_downloader
+    from request_scheduler import AUDIBLE_API_HOST, HostLimits, RequestScheduler, ScheduledAudibleClient
+    # Set by main() of library_downloader once the folders are configured
+    library_downloader.get_set_of_asins = book_store.get_set_of_asins
+
+    scheduler = RequestScheduler(
+        limits={AUDIBLE_API_HOST: HostLimits(rate=args.api_rate or None, burst=args.metadata_workers, max_in_flight=args.max_connections_per_host)},
+        default_limits=HostLimits(max_in_flight=args.max_connections_per_host),
+        max_retries=args.max_retries,
+    )
+    client = ScheduledAudibleClient(fake_audible_client(url), scheduler)
+    concurrency = library_downloader.Concurrency(metadata=args.metadata_workers, download=args.download_workers, decrypt=args.decrypt_workers, download_segments=args.download_segments)
+    listed = config.books - config.unlisted
+    results = dict()
+
+    report_path = os.path.join(folder, 'report.json')
+    start = time.perf_counter()
+    await library_downloader.download_books_and_metadata(
+        client, concurrency, sync_state_path=os.path.join(folder, 'sync_state'), scheduler=scheduler,
+        stream_decrypt=args.stream_decrypt, native_decrypt=args.decrypter == 'native', report_path=report_path,
+    )
+    seconds = time.perf_counter() - start
+    books, size = _folder_bytes(folder_settings.AUDIO_FOLDER, '.m4b')
+    with open(report_path, 'r') as file:
+        stages = json.load(file)['stages']
+    results['download'] = {
+        'seconds': seconds,
+        'books': books,
+        'failed': listed - books,
+        'bytes': size,
+        'books_per_minute': books / seconds * 60,
+        'bytes_per_second': size / seconds,
+        'stages': stages,
+    }
+
+    # Books that are no longer in the library get their metadata from the catalog
+    for item in generate_library_items(config.books, config.seed)[listed:]:
+        book_store.get_metadata_store().write(library_downloader._make_book_data(item))
+
+    start = time.perf_counter()
+    counts = await library_downloader.update_metadata(client, concurrency)
+    seconds = time.perf_counter() - start
+    books = len(book_store.get_set_of_asins())
+    results['update_metadata'] = {
+        'seconds': seconds,
+        'books': books,
+        'books_per_minute': books / seconds * 60,
+        **counts,
+    }
+
+    await client.client.close()
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark library_downloader against a local fake audible api and CDN')
+    add_config_arguments(parser)
+    parser.add_argument('--cache-folder', default=os.path.join(tempfile.gettempdir(), 'fake_audible'), help='Generated audio files are kept here between runs')
+    parser.add_argument('--metadata-workers', type=int, default=4)
+    parser.add_argument('--download-workers', type=int, default=4)
+    parser.add_argument('--decrypt-workers', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--download-segments', type=int, default=1)
+    parser.add_argument('--decrypter', choices=['native', 'ffmpeg'], default='native')
+    parser.add_argument('--stream-decrypt', action='store_true')
+    parser.add_argument('--api-rate', type=float, default=0.0, help='Requests per second to the fake api, 0 for no limit')
+    parser.add_argument('--max-connections-per-host', type=int, default=8)
+    parser.add_argument('--max-retries', type=int, default=5)
+    parser.add_argument('--output', default='downloader_benchmark.json')
+    args = parser.parse_args()
+    config = config_from_arguments(args)
+
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    logging.getLogger('httpx').setLevel(logging.WARNING)
+    logging.getLogger('audible').setLevel(logging.WARNING)
+
+    proc, url = start_server(config, args.cache_folder)
+    try:
+        with tempfile.TemporaryDirectory() as folder:
+            results = asyncio.run(run_benchmark(args, config, url, folder))
+        server = httpx.get(f'{url}/stats').json()
+    finally:
+        proc.terminate()
+        proc.wait()
+
+    try:
+        revision = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True, cwd=SRC_FOLDER).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        revision = None
+
+    report = {
+        'revision': revision,
+        'created': datetime.now(timezone.utc).isoformat(),
+        'python': platform.python_version(),
+        'server': vars(config),
+        'options': {name: value for name, value in vars(args).items() if name not in vars(config)},
+        'results': results,
+        'server_stats': server,
+    }
+    with open(args.output, 'w') as file:
+        json.dump(report, file, indent=2)
+
+    download = results['download']
+    print(f'download: {download["books"]} books, {download["failed"]} failed, {download["seconds"]:.1f}s, '
+          f'{download["books_per_minute"]:.1f} books/min, {download["bytes_per_second"] / 1024 / 1024:.1f} MB/s', file=sys.stderr)
+    update = results['update_metadata']
+    print(f'update_metadata: {update["books"]} books, {update["updated"]} updated, {update["failed"]} failed, {update["seconds"]:.1f}s, {update["books_per_minute"]:.1f} books/min', file=sys.stderr)
+    print(f'server: {server["requests"]} requests, {server["throttled"]} throttled, {server["errors"]} errors, {server["disconnects"]} disconnects', file=sys.stderr)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,342 @@
+"""
+A local stand-in for the audible api and CDN, to test and benchmark library_downloader without an audible account.
+
+Usage: python benchmarks/fake_audible.py --books 50 --latency 0.05 --bandwidth 20 --error-rate 0.05 --disconnect-rate 0.1
+
+Serves 1.0/library, 1.0/library/{asin}, 1.0/catalog/products/{asin}, 1.0/content/{asin}/licenserequest and the
+audio files under /cdn with range support. The audio files are synthetic aaxc files the native decrypter can
+decrypt, the license vouchers are encrypted for the device of fake_authenticator(). Faults are injected with a
+seeded random generator, so runs with the same options see the same sequence of faults.
+"""
+import argparse
+import asyncio
+import base64
+import hashlib
+import json
+import logging
+import os
+import random
+import re
+import struct
+import sys
+import tempfile
+import time
+from dataclasses import dataclass, asdict, fields
+from datetime import datetime, timedelta, timezone
+from typing import AsyncIterator, Dict, List
+
+import audible
+import httpx
+import uvicorn
+from audible.aescipher import aes_cbc_encrypt
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import JSONResponse, Response, StreamingResponse
+from starlette.routing import Route
+
+from library_benchmark import generate_library_items
+
+DEVICE_TYPE = 'A2CZJZGLK2JJVM'
+DEVICE_SERIAL_NUMBER = 'FAKEDEVICE0000000000'
+CUSTOMER_ID = 'amzn1.account.FAKEACCOUNT'
+
+CHUNK_SIZE = 64 * 1024
+SAMPLES_PER_CHUNK = 20
+
+@dataclass
+class FakeAudibleConfig:
+    books: int = 20
+    # Books at the end of the library that are only in the catalog, as if they were removed from the library
+    unlisted: int = 0
+    file_size: int = 4 * 1024 * 1024
+    seed: int = 1
+    # Seconds before every api response and before the first byte of every CDN response
+    latency: float = 0.0
+    cdn_latency: float = 0.0
+    # Bytes per second per CDN connection and for all CDN connections together, 0 for no limit
+    bandwidth: float = 0.0
+    total_bandwidth: float = 0.0
+    # Fractions of requests answered with 429 and with 500 or 503, and of CDN responses cut off in the middle
+    throttle_rate: float = 0.0
+    error_rate: float = 0.0
+    disconnect_rate: float = 0.0
+
+    def arguments(self) -> List[str]:
+        return [f'--{field.name.replace("_", "-")}={getattr(self, field.name)}' for field in fields(self)]
+
+def add_config_arguments(parser: argparse.ArgumentParser):
+    for field in fields(FakeAudibleConfig):
+        parser.add_argument(f'--{field.name.replace("_", "-")}', type=field.type, default=field.default)
+
+def config_from_arguments(args: argparse.Namespace) -> FakeAudibleConfig:
+    return FakeAudibleConfig(**{field.name: getattr(args, field.name) for field in fields(FakeAudibleConfig)})
+
+def fake_authenticator() -> audible.Authenticator:
+    return audible.Authenticator.from_dict({
+        'locale_code': 'us',
+        'access_token': 'Atna|fake',
+        'expires': time.time() + 365 * 24 * 3600,
+        'device_info': {'device_type': DEVICE_TYPE, 'device_serial_number': DEVICE_SERIAL_NUMBER},
+        'customer_info': {'user_id': CUSTOMER_ID},
+    })
+
+def fake_audible_client(api_url: str) -> audible.AsyncClient:
+    client = audible.AsyncClient(auth=fake_authenticator())
+    # The client has no option for the api url, it's derived from the marketplace
+    client._api_url = httpx.URL(api_url)
+    return client
+
+def book_key(asin: str) -> tuple[bytes, bytes]:
+    digest = hashlib.sha256(asin.encode()).digest()
+    return digest[:16], digest[16:]
+
+def _box(box_type: bytes, payload: bytes) -> bytes:
+    return struct.pack('>I', 8 + len(payload)) + box_type + payload
+
+def _full_box(box_type: bytes, payload: bytes) -> bytes:
+    return _box(box_type, b'\0\0\0\0' + payload)
+
+def _encrypt_sample(sample: bytes, key: bytes, iv: bytes) -> bytes:
+    # Like audible, only the full blocks of a sample are encrypted
+    length = len(sample) & ~15
+    encryptor = Cipher(algorithms.AES(key), modes.CBC(iv)).encryptor()
+    return encryptor.update(sample[:length]) + encryptor.finalize() + sample[length:]
+
+def make_aax(path: str, size: int, key: bytes, iv: bytes, seed: int):
+    """Writes an aaxc file with about size bytes of encrypted audio samples and the moov box before them."""
+    rng = random.Random(seed)
+    sizes = list()
+    while sum(sizes) < size:
+        sizes.extend(rng.randint(200, 1000) for _ in range(SAMPLES_PER_CHUNK))
+    chunk_count = len(sizes) // SAMPLES_PER_CHUNK
+
+    def moov(chunk_offsets: List[int]) -> bytes:
+        sample_entry = _box(b'aavd', bytes(6) + struct.pack('>H', 1) + bytes(8) + struct.pack('>HHHHI', 2, 16, 0, 0, 44100 << 16)
+                            + _box(b'esds', bytes(20)) + _box(b'adrm', bytes(56)) + _box(b'aabd', bytes(16)))
+        stbl = _box(b'stbl',
+                    _full_box(b'stsd', struct.pack('>I', 1) + sample_entry)
+                    + _full_box(b'stsz', struct.pack(f'>II{len(sizes)}I', 0, len(sizes), *sizes))
+                    + _full_box(b'stsc', struct.pack('>IIII', 1, 1, SAMPLES_PER_CHUNK, 1))
+                    + _full_box(b'stco', struct.pack(f'>I{chunk_count}I', chunk_count, *chunk_offsets)))
+        trak = _box(b'trak', _box(b'tkhd', bytes(84)) + _box(b'mdia', _box(b'mdhd', bytes(24)) + _box(b'minf', stbl)))
+        return _box(b'moov', _box(b'mvhd', bytes(100)) + trak)
+
+    ftyp = _box(b'ftyp', b'aax \0\0\0\x01aax M4B mp42')
+    offset = len(ftyp) + len(moov([0] * chunk_count)) + 8
+    chunk_offsets = list()
+    samples = list()
+    for i, sample_size in enumerate(sizes):
+        if i % SAMPLES_PER_CHUNK == 0:
+            chunk_offsets.append(offset)
+        samples.append(_encrypt_sample(rng.randbytes(sample_size), key, iv))
+        offset += sample_size
+
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'wb') as file:
+        file.write(ftyp)
+        file.write(moov(chunk_offsets))
+        file.write(struct.pack('>I', 8 + sum(sizes)) + b'mdat')
+        file.writelines(samples)
+    os.replace(tmp_path, path)
+
+class InjectedDisconnect(Exception):
+    """Aborts a response, the server closes the connection before the declared length was sent."""
+
+class _HideInjectedDisconnects(logging.Filter):
+    def filter(self, record: logging.LogRecord) -> bool:
+        return not (record.exc_info and isinstance(record.exc_info[1], InjectedDisconnect))
+
+class _Pacer:
+    """Delays writes so they don't exceed rate bytes per second."""
+    def __init__(self, rate: float):
+        self.rate = rate
+        self._next = time.monotonic()
+
+    async def wait(self, count: int):
+        now = time.monotonic()
+        self._next = max(self._next, now) + count / self.rate
+        if self._next > now:
+            await asyncio.sleep(self._next - now)
+
+@dataclass
+class ServerStats:
+    requests: int = 0
+    throttled: int = 0
+    errors: int = 0
+    disconnects: int = 0
+    bytes_sent: int = 0
+
+class FakeAudible:
+    def __init__(self, config: FakeAudibleConfig, folder: str):
+        self.config = config
+        self.folder = folder
+        self.stats = ServerStats()
+        self._rng = random.Random(config.seed)
+        self._total_pacer = _Pacer(config.total_bandwidth) if config.total_bandwidth > 0 else None
+
+        items = generate_library_items(config.books, config.seed)
+        purchased = datetime(2020, 1, 1, tzinfo=timezone.utc)
+        for n, item in enumerate(items):
+            item['purchase_date'] = (purchased + timedelta(hours=n)).strftime('%Y-%m-%dT%H:%M:%SZ')
+        self.catalog: Dict[str, dict] = {item['asin']: item for item in items}
+        self.library: List[dict] = items[:len(items) - config.unlisted]
+        self._owned = {item['asin'] for item in self.library}
+        self._numbers = {asin: n for n, asin in enumerate(self.catalog)}
+
+        os.makedirs(folder, exist_ok=True)
+        self.files: Dict[str, str] = dict()
+        for n, asin in enumerate(self.catalog):
+            path = os.path.join(folder, f'{asin}-{config.file_size}-{config.seed}.aax')
+            if not os.path.exists(path):
+                make_aax(path, config.file_size, *book_key(asin), seed=config.seed + n)
+            self.files[asin] = path
+
+    def routes(self) -> List[Route]:
+        return [
+            Route('/1.0/library', self.library_page),
+            Route('/1.0/library/{asin}', self.library_item),
+            Route('/1.0/catalog/products/{asin}', self.catalog_product),
+            Route('/1.0/content/{asin}/licenserequest', self.license_request, methods=['POST']),
+            Route('/cdn/{asin}/{filename}', self.cdn_file, methods=['GET', 'HEAD']),
+            Route('/stats', self.server_stats),
+        ]
+
+    async def _fault(self, latency: float) -> Response | None:
+        """Waits for the configured latency and returns the injected error response, if the request gets one."""
+        self.stats.requests += 1
+        if latency > 0:
+            await asyncio.sleep(latency)
+
+        roll = self._rng.random()
+        if roll < self.config.throttle_rate:
+            self.stats.throttled += 1
+            return JSONResponse({'message': 'Rate exceeded'}, status_code=429, headers={'Retry-After': '1'})
+        if roll < self.config.throttle_rate + self.config.error_rate:
+            self.stats.errors += 1
+            return JSONResponse({'message': 'Injected error'}, status_code=self._rng.choice((500, 503)))
+        return None
+
+    async def library_page(self, request: Request) -> Response:
+        fault = await self._fault(self.config.latency)
+        if fault is not None:
+            return fault
+
+        page = int(request.query_params.get('page', 1))
+        num_results = int(request.query_params.get('num_results', 50))
+        items = sorted(self.library, key=lambda item: item['purchase_date'], reverse=request.query_params.get('sort_by', '').startswith('-'))
+        return JSONResponse({'items': items[(page - 1) * num_results:page * num_results]}, headers={'Total-Count': str(len(items))})
+
+    async def library_item(self, request: Request) -> Response:
+        fault = await self._fault(self.config.latency)
+        if fault is not None:
+            return fault
+
+        asin = request.path_params['asin']
+        if asin not in self._owned:
+            return JSONResponse({'message': 'Not found'}, status_code=404)
+        return JSONResponse({'item': self.catalog[asin]})
+
+    async def catalog_product(self, request: Request) -> Response:
+        fault = await self._fault(self.config.latency)
+        if fault is not None:
+            return fault
+
+        item = self.catalog.get(request.path_params['asin'])
+        if item is None:
+            return JSONResponse({'message': 'Not found'}, status_code=404)
+        return JSONResponse({'product': item})
+
+    async def license_request(self, request: Request) -> Response:
+        fault = await self._fault(self.config.latency)
+        if fault is not None:
+            return fault
+
+        asin = request.path_params['asin']
+        if asin not in self._owned:
+            return JSONResponse({'message': 'Customer does not own this title'}, status_code=403)
+
+        key, iv = book_key(asin)
+        voucher = json.dumps({'key': key.hex(), 'iv': iv.hex(), 'rules': []})
+        voucher += '\0' * (-len(voucher) % 16)
+        digest = hashlib.sha256((DEVICE_TYPE + DEVICE_SERIAL_NUMBER + CUSTOMER_ID + asin).encode('ascii')).digest()
+        n = self._numbers[asin]
+
+        return JSONResponse({'content_license': {
+            'asin': asin,
+            'license_response': base64.b64encode(aes_cbc_encrypt(digest[:16], digest[16:], voucher, padding='none')).decode(),
+            'content_metadata': {
+                'content_url': {'offline_url': f'{str(request.base_url).rstrip("/")}/cdn/{asin}/bk_adbl_{n:06d}_22_64.aax'},
+                'chapter_info': {'chapters': [{'title': 'Chapter 1', 'start_offset_ms': 0, 'length_ms': 60_000}]},
+            },
+        }})
+
+    async def cdn_file(self, request: Request) -> Response:
+        path = self.files.get(request.path_params['asin'])
+        if path is None:
+            return Response(status_code=404)
+        fault = await self._fault(self.config.cdn_latency)
+        if fault is not None:
+            return fault
+
+        size = os.path.getsize(path)
+        headers = {'Accept-Ranges': 'bytes', 'Content-Type': 'audio/vnd.audible.aax'}
+        if request.method == 'HEAD':
+            return Response(status_code=200, headers={**headers, 'Content-Length': str(size)})
+
+        start, end, status_code = 0, size - 1, 200
+        match = re.fullmatch(r'bytes=(\d+)-(\d*)', request.headers.get('range', ''))
+        if match:
+            start = int(match.group(1))
+            end = min(int(match.group(2)), size - 1) if match.group(2) else size - 1
+            if start > end:
+                return Response(status_code=416, headers={'Content-Range': f'bytes */{size}'})
+            status_code = 206
+            headers['Content-Range'] = f'bytes {start}-{end}/{size}'
+        headers['Content-Length'] = str(end - start + 1)
+
+        cut = None
+        if self._rng.random() < self.config.disconnect_rate:
+            cut = self._rng.randint(start, end)
+        return StreamingResponse(self._send_file(path, start, end + 1, cut), status_code=status_code, headers=headers)
+
+    async def _send_file(self, path: str, start: int, end: int, cut: int | None) -> AsyncIterator[bytes]:
+        pacer = _Pacer(self.config.bandwidth) if self.config.bandwidth > 0 else None
+        with open(path, 'rb') as file:
+            file.seek(start)
+            offset = start
+            while offset < end:
+                if cut is not None and offset >= cut:
+                    self.stats.disconnects += 1
+                    raise InjectedDisconnect()
+                chunk = file.read(min(CHUNK_SIZE, end - offset))
+                for current in (pacer, self._total_pacer):
+                    if current is not None:
+                        await current.wait(len(chunk))
+                offset += len(chunk)
+                self.stats.bytes_sent += len(chunk)
+                yield chunk
+
+    async def server_stats(self, request: Request) -> Response:
+        return JSONResponse(asdict(self.stats))
+
+def create_app(config: FakeAudibleConfig, folder: str) -> Starlette:
+    return Starlette(routes=FakeAudible(config, folder).routes())
+
+def main():
+    parser = argparse.ArgumentParser(description='Local stand-in for the audible api and CDN')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--cache-folder', default=os.path.join(tempfile.gettempdir(), 'fake_audible'), help='Generated audio files are kept here between runs')
+    add_config_arguments(parser)
+    args = parser.parse_args()
+    config = config_from_arguments(args)
+
+    start = time.perf_counter()
+    app = create_app(config, args.cache_folder)
+    print(f'Generated {config.books} books in {time.perf_counter() - start:.1f}s, serving on http://{args.host}:{args.port}', file=sys.stderr)
+    logging.getLogger('uvicorn.error').addFilter(_HideInjectedDisconnects())
+    uvicorn.run(app, host=args.host, port=args.port, log_level='warning')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,267 @@
+"""
+Measures book_store and the feed endpoints against synthetic libraries.
+
+Usage: python benchmarks/library_benchmark.py --sizes 100 1000 10000 --output results.json
+
+Every library size runs in its own process, so the first call of each entry point is really cold. The metadata
+is written the way library_downloader writes it and the audio files are sparse, so even large libraries need
+little disk space. The JSON results of two revisions can be compared to find regressions.
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timezone
+from typing import Callable, Dict, List
+
+SRC_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+sys.path.insert(0, SRC_FOLDER)
+
+WORDS = ['night', 'empire', 'shadow', 'river', 'crown', 'storm', 'garden', 'silent', 'last', 'iron', 'glass',
+         'winter', 'kingdom', 'stars', 'secret', 'house', 'war', 'dragon', 'city', 'lost', 'code', 'fire']
+
+def _title(rng: random.Random) -> str:
+    return ' '.join(rng.choice(WORDS) for _ in range(rng.randint(2, 5))).title()
+
+def _asin(prefix: str, n: int) -> str:
+    return f'{prefix}{n:09d}'
+
+def generate_library_items(size: int, seed: int) -> List[Dict]:
+    """
+    Builds library api items with a realistic mix: about half of the books are in series of 2 to 15 books,
+    a few in two series, some are podcast episodes and the rest are individual books.
+    """
+    rng = random.Random(seed)
+    items = list()
+    series_count = 0
+    podcast_count = 0
+
+    while len(items) < size:
+        kind = rng.random()
+        if kind < 0.55:
+            series_asin = _asin('S', series_count)
+            series_title = _title(rng)
+            series_count += 1
+            for sequence in range(1, min(rng.randint(2, 15), size - len(items)) + 1):
+                series = [{'asin': series_asin, 'title': series_title, 'sequence': str(sequence)}]
+                if rng.random() < 0.05:
+                    series.append({'asin': _asin('S', series_count), 'title': _title(rng), 'sequence': str(rng.randint(1, 5))})
+                    series_count += 1
+                items.append(_item(rng, len(items), series=series))
+        elif kind < 0.6:
+            podcast_asin = _asin('P', podcast_count)
+            podcast_title = _title(rng)
+            podcast_count += 1
+            for sort in range(1, min(rng.randint(5, 50), size - len(items)) + 1):
+                relationships = [{'asin': podcast_asin, 'title': podcast_title, 'sort': str(sort), 'content_delivery_type': 'PodcastParent'}]
+                items.append(_item(rng, len(items), relationships=relationships))
+        else:
+            items.append(_item(rng, len(items)))
+
+    return items
+
+def _item(rng: random.Random, n: int, series: List[Dict] | None = None, relationships: List[Dict] | None = None) -> Dict:
+    return {
+        'asin': _asin('B', n),
+        'title': _title(rng),
+        'language': 'english',
+        'release_date': f'{rng.randint(1990, 2025)}-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}',
+        'series': series,
+        'relationships': relationships,
+    }
+
+def write_library(folder: str, size: int, seed: int, backend: str):
+    import folder_settings
+    from library_downloader import _make_book_data, generate_download_filename
+    from metadata_store import JsonMetadataStore, SqliteMetadataStore
+
+    metadata_folder = os.path.join(folder, 'metadata')
+    audio_folder = os.path.join(folder, 'audio')
+    os.makedirs(metadata_folder)
+    os.makedirs(audio_folder)
+    folder_settings.METADATA_FOLDER = metadata_folder
+
+    rng = random.Random(seed)
+    products = list()
+    for n, item in enumerate(generate_library_items(size, seed)):
+        products.append(_make_book_data(item))
+        filename = generate_download_filename(item['asin'], f'https://cdn.example/{item["asin"]}/bk_adbl_{n}_22_64.aax')
+        with open(os.path.join(audio_folder, f'{filename[:-4]}.m4b'), 'wb') as file:
+            # Sparse, only the size is real
+            file.truncate(rng.randint(20, 800) * 1024 * 1024)
+
+    if backend == 'sqlite':
+        SqliteMetadataStore(os.path.join(metadata_folder, 'catalog.sqlite3')).write_many(products)
+    else:
+        JsonMetadataStore(metadata_folder).write_many(products)
+
+def measure(name: str, call: Callable[[], object], repeat: int, max_seconds: float) -> Dict:
+    """Times the first call, then up to repeat warm calls, and finally the peak allocation of one traced call."""
+    start = time.perf_counter()
+    call()
+    cold = time.perf_counter() - start
+
+    warm = list()
+    budget_end = time.perf_counter() + max_seconds
+    while len(warm) < repeat and (not warm or time.perf_counter() < budget_end):
+        start = time.perf_counter()
+        call()
+        warm.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    call()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    warm.sort()
+    return {
+        'name': name,
+        'cold_ms': cold * 1000,
+        'warm_median_ms': statistics.median(warm) * 1000,
+        'warm_p95_ms': warm[min(int(len(warm) * 0.95), len(warm) - 1)] * 1000,
+        'warm_runs': len(warm),
+        'throughput_per_s': len(warm) / sum(warm) if sum(warm) > 0 else None,
+        'peak_alloc_bytes': peak,
+    }
+
+def run_measurements(folder: str, backend: str, repeat: int, max_seconds: float) -> List[Dict]:
+    """Runs in a fresh process per library, main reads its settings from the environment when it's imported."""
+    os.environ.update(
+        AUDIO_FOLDER=os.path.join(folder, 'audio'),
+        METADATA_FOLDER=os.path.join(folder, 'metadata'),
+        METADATA_BACKEND=backend,
+        HTTP_PASSWORD='benchmark',
+        PODCAST_FEED_IMAGE='https://example.com/cover.jpg',
+        PODCAST_HASH_SALT='benchmark',
+    )
+    os.chdir(SRC_FOLDER)
+
+    import book_store
+    import main
+    from starlette.testclient import TestClient
+
+    results = list()
+
+    def add(name: str, call: Callable[[], object]):
+        results.append(measure(name, call, repeat, max_seconds))
+
+    # Entry points that rebuild everything on every call
+    from metadata_store import JsonMetadataStore, SqliteMetadataStore
+
+    def new_metadata_store():
+        if backend == 'sqlite':
+            return SqliteMetadataStore(main.folder_settings.METADATA_CATALOG)
+        return JsonMetadataStore(main.folder_settings.METADATA_FOLDER)
+
+    if backend == 'json':
+        def read_json_store():
+            store = new_metadata_store()
+            store.refresh()
+            return store.grouped_products()
+        add('metadata_store.JsonMetadataStore (cold read)', read_json_store)
+    # A new store per call, the shared one would already hold the metadata
+    add('book_store.LibraryIndex.refresh (rebuild)', lambda: book_store.LibraryIndex(new_metadata_store(), main.folder_settings.AUDIO_FOLDER, main.folder_settings.METADATA_FOLDER).refresh())
+
+    # The first call builds the shared index, the later ones only check for changes
+    add('book_store.get_library', book_store.get_library)
+    library = book_store.get_library()
+    largest_series = max(library.series.values(), key=lambda s: len(s.books), default=None)
+    largest_podcast = max(library.podcasts.values(), key=lambda p: len(p.books), default=None)
+    some_asin = next(iter(library.books))
+
+    add('book_store.get_set_of_asins', book_store.get_set_of_asins)
+    add('book_store.get_all_individual_books', book_store.get_all_individual_books)
+    add('book_store.get_series', book_store.get_series)
+    add('book_store.get_podcasts', book_store.get_podcasts)
+    if largest_series is not None:
+        add('book_store.get_series_by_asin', lambda: book_store.get_series_by_asin(largest_series.asin))
+    if largest_podcast is not None:
+        add('book_store.get_podcast_by_asin', lambda: book_store.get_podcast_by_asin(largest_podcast.asin))
+    add('book_store.get_audio_file_from_asin', lambda: book_store.get_audio_file_from_asin(some_asin))
+
+    client = TestClient(main.app)
+    auth = ('user', 'benchmark')
+
+    def get(path: str, headers: Dict[str, str] | None = None):
+        def call():
+            response = client.get(path, auth=auth, headers=headers)
+            if response.status_code >= 400:
+                raise RuntimeError(f'{path} returned {response.status_code}')
+        return call
+
+    book = library.books[some_asin]
+    routes = {
+        'GET /': '/',
+        'GET /individual_books': '/individual_books',
+        'GET /audio_file/{hash}/{filename} (64 KiB range)': f'/audio_file/{main.get_salted_hash(book.audio_file)}/{book.audio_file}',
+    }
+    if largest_series is not None:
+        routes[f'GET /series/{{asin}} ({len(largest_series.books)} books)'] = f'/series/{largest_series.asin}'
+    if largest_podcast is not None:
+        routes[f'GET /podcast/{{asin}} ({len(largest_podcast.books)} books)'] = f'/podcast/{largest_podcast.asin}'
+
+    for name, path in routes.items():
+        headers = {'Range': 'bytes=0-65535'} if path.startswith('/audio_file') else None
+        add(name, get(path, headers))
+
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark book_store and the feed endpoints on synthetic libraries')
+    parser.add_argument('--sizes', nargs='+', type=int, default=[100, 1000, 10000])
+    parser.add_argument('--backend', choices=['json', 'sqlite'], default='json')
+    parser.add_argument('--repeat', type=int, default=20, help='Maximum number of warm calls per entry point')
+    parser.add_argument('--max-seconds', type=float, default=5.0, help='Time budget for the warm calls of one entry point')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', default='library_benchmark.json')
+    parser.add_argument('--measure', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.measure:
+        results = run_measurements(args.measure, args.backend, args.repeat, args.max_seconds)
+        json.dump({'results': results, 'max_rss_bytes': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024}, sys.stdout)
+        return
+
+    try:
+        revision = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True, cwd=SRC_FOLDER).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        revision = None
+
+    report = {
+        'revision': revision,
+        'created': datetime.now(timezone.utc).isoformat(),
+        'python': platform.python_version(),
+        'backend': args.backend,
+        'libraries': [],
+    }
+
+    for size in args.sizes:
+        with tempfile.TemporaryDirectory() as folder:
+            start = time.perf_counter()
+            write_library(folder, size, args.seed, args.backend)
+            print(f'{size} books: generated in {time.perf_counter() - start:.1f}s', file=sys.stderr)
+
+            proc = subprocess.run(
+                [sys.executable, os.path.abspath(__file__), '--measure', folder, '--backend', args.backend,
+                 '--repeat', str(args.repeat), '--max-seconds', str(args.max_seconds)],
+                capture_output=True, text=True, check=True,
+            )
+            measured = json.loads(proc.stdout)
+
+        report['libraries'].append({'size': size, **measured})
+        for result in measured['results']:
+            print(f'{size:>7} {result["name"]:<55} cold {result["cold_ms"]:9.2f}ms  warm {result["warm_median_ms"]:9.2f}ms', file=sys.stderr)
+
+    with open(args.output, 'w') as file:
+        json.dump(report, file, indent=2)
+
+if __name__ == '__main__':
+    main()
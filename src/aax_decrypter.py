@@ -0,0 +1,242 @@
+import logging
+import os
+import shutil
+import struct
+from dataclasses import dataclass
+from typing import List, Tuple
+
+import mp4
+
+try:
+    from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+except ImportError:
+    Cipher = None
+
+_logger = logging.getLogger(__name__)
+
+# Amount of file data that is read, decrypted and written back at once
+BATCH_SIZE = 4 * 1024 * 1024
+
+# Boxes in the audio sample entry that only describe the drm and are hidden in the decrypted file
+DRM_BOXES = ('adrm', 'aabd')
+
+class UnsupportedFile(Exception):
+    """The file has a structure the native decrypter can't handle, ffmpeg has to be used instead."""
+
+def is_available() -> bool:
+    return Cipher is not None
+
+@dataclass(frozen=True)
+class SampleRun:
+    """Consecutive samples of the encrypted track, as stored in one chunk."""
+    offset: int
+    sizes: Tuple[int, ...]
+
+    @property
+    def end(self) -> int:
+        return self.offset + sum(self.sizes)
+
+@dataclass
+class AaxLayout:
+    # File offset -> the four bytes that replace what's there, to turn the file into a plain m4b
+    patches: List[Tuple[int, bytes]]
+    runs: List[SampleRun]
+
+def _full_box_entries(data: bytes, offset: int, header_size: int, fmt: str) -> list:
+    count, = struct.unpack_from('>I', data, offset + header_size + 4)
+    entry_size = struct.calcsize(fmt)
+    start = offset + header_size + 8
+    return [struct.unpack_from(fmt, data, start + i * entry_size) for i in range(count)]
+
+def _sample_sizes(data: bytes, stbl: Tuple[int, int, int]) -> List[int]:
+    stsz = mp4.find_box(data, ['stsz'], stbl[0] + stbl[2], stbl[0] + stbl[1])
+    if stsz is None:
+        raise UnsupportedFile('Encrypted track has no stsz box')
+    offset, _, header_size = stsz
+    sample_size, count = struct.unpack_from('>II', data, offset + header_size + 4)
+    if sample_size != 0:
+        return [sample_size] * count
+    return list(struct.unpack_from(f'>{count}I', data, offset + header_size + 12))
+
+def _chunk_offsets(data: bytes, stbl: Tuple[int, int, int]) -> List[int]:
+    for box_type, fmt in (('stco', '>I'), ('co64', '>Q')):
+        box = mp4.find_box(data, [box_type], stbl[0] + stbl[2], stbl[0] + stbl[1])
+        if box is not None:
+            return [entry[0] for entry in _full_box_entries(data, box[0], box[2], fmt)]
+    raise UnsupportedFile('Encrypted track has no chunk offsets')
+
+def _sample_runs(data: bytes, stbl: Tuple[int, int, int]) -> List[SampleRun]:
+    sizes = _sample_sizes(data, stbl)
+    chunk_offsets = _chunk_offsets(data, stbl)
+    stsc = mp4.find_box(data, ['stsc'], stbl[0] + stbl[2], stbl[0] + stbl[1])
+    if stsc is None:
+        raise UnsupportedFile('Encrypted track has no stsc box')
+    chunk_entries = _full_box_entries(data, stsc[0], stsc[2], '>III')
+
+    runs = []
+    sample = 0
+    for i, (first_chunk, samples_per_chunk, _) in enumerate(chunk_entries):
+        last_chunk = chunk_entries[i + 1][0] - 1 if i + 1 < len(chunk_entries) else len(chunk_offsets)
+        for chunk in range(first_chunk, last_chunk + 1):
+            run_sizes = tuple(sizes[sample:sample + samples_per_chunk])
+            if len(run_sizes) != samples_per_chunk:
+                raise UnsupportedFile('Sample table has more samples in chunks than sizes')
+            runs.append(SampleRun(chunk_offsets[chunk - 1], run_sizes))
+            sample += samples_per_chunk
+
+    if sample != len(sizes):
+        raise UnsupportedFile('Sample table has more sizes than samples in chunks')
+    return runs
+
+def _audio_sample_entry_children(data: bytes, entry_offset: int, header_size: int) -> int:
+    # QuickTime sound sample description, the version decides how many fields precede the child boxes
+    version, = struct.unpack_from('>H', data, entry_offset + header_size + 8)
+    if version == 0:
+        return entry_offset + header_size + 28
+    if version == 1:
+        return entry_offset + header_size + 44
+    raise UnsupportedFile(f'Unsupported sound sample description version {version}')
+
+def read_layout(path: str) -> AaxLayout:
+    """Finds the encrypted samples and the boxes that mark the file as encrypted."""
+    patches = []
+    moov = None
+    with open(path, 'rb') as file:
+        for offset, size, box_type, header_size in mp4.iter_file_boxes(file):
+            if box_type == 'ftyp':
+                file.seek(offset)
+                ftyp = file.read(size)
+                for brand_offset in range(header_size, size, 4):
+                    if brand_offset == header_size + 4:
+                        continue  # minor version
+                    if ftyp[brand_offset:brand_offset + 4] == b'aax ':
+                        patches.append((offset + brand_offset, b'M4B '))
+            elif box_type == 'moov':
+                file.seek(offset)
+                moov = (offset, file.read(size))
+            elif box_type == 'moof':
+                raise UnsupportedFile('Fragmented files are not supported')
+
+    if moov is None:
+        raise UnsupportedFile('File has no moov box')
+    moov_offset, data = moov
+
+    runs = []
+    moov_header = mp4.read_box_header(data, 0)
+    for trak_offset, trak_size, box_type, trak_header_size in mp4.iter_boxes(data, moov_header[2]):
+        if box_type != 'trak':
+            continue
+        stbl = mp4.find_box(data, ['mdia', 'minf', 'stbl'], trak_offset + trak_header_size, trak_offset + trak_size)
+        if stbl is None:
+            continue
+        stsd = mp4.find_box(data, ['stsd'], stbl[0] + stbl[2], stbl[0] + stbl[1])
+        if stsd is None:
+            continue
+
+        entries = list(mp4.iter_boxes(data, stsd[0] + stsd[2] + 8, stsd[0] + stsd[1]))
+        encrypted = [entry for entry in entries if entry[2] == 'aavd']
+        if not encrypted:
+            continue
+        if len(entries) != 1:
+            raise UnsupportedFile('Encrypted track has more than one sample description')
+
+        entry_offset, entry_size, _, entry_header_size = encrypted[0]
+        patches.append((moov_offset + entry_offset + 4, b'mp4a'))
+        children_start = _audio_sample_entry_children(data, entry_offset, entry_header_size)
+        for child_offset, _, child_type, _ in mp4.iter_boxes(data, children_start, entry_offset + entry_size):
+            if child_type in DRM_BOXES:
+                patches.append((moov_offset + child_offset + 4, b'free'))
+
+        runs.extend(_sample_runs(data, stbl))
+
+    if not runs:
+        raise UnsupportedFile('File has no encrypted track')
+    runs.sort(key=lambda run: run.offset)
+    return AaxLayout(patches, runs)
+
+def _batches(runs: List[SampleRun]) -> List[List[SampleRun]]:
+    """Groups runs that are close together in the file, so each batch is one read and one write."""
+    batches = []
+    current = []
+    for run in runs:
+        if current and (run.end - current[0].offset > BATCH_SIZE or run.offset > current[-1].end + BATCH_SIZE // 16):
+            batches.append(current)
+            current = []
+        current.append(run)
+    if current:
+        batches.append(current)
+    return batches
+
+def _decrypt_batch(fd: int, batch: List[SampleRun], key: bytes, iv: bytes):
+    start = batch[0].offset
+    buffer = bytearray(os.pread(fd, batch[-1].end - start, start))
+    if len(buffer) != batch[-1].end - start:
+        raise UnsupportedFile('Sample data extends beyond the end of the file')
+
+    # Every sample is encrypted on its own with AES-CBC starting at the iv, a trailing partial block stays plain.
+    # CBC decryption XORs each block with the previous ciphertext block, so putting the iv in front of every
+    # sample lets a single decryptor handle the whole batch, the blocks decrypted from the ivs are dropped.
+    view = memoryview(buffer)
+    samples = []
+    ciphertext = []
+    for run in batch:
+        sample_offset = run.offset - start
+        for size in run.sizes:
+            length = size & ~15
+            if length:
+                sample = view[sample_offset:sample_offset + length]
+                samples.append(sample)
+                ciphertext.append(iv)
+                ciphertext.append(sample)
+            sample_offset += size
+
+    if not samples:
+        return
+
+    decryptor = Cipher(algorithms.AES(key), modes.CBC(iv)).decryptor()
+    plaintext = memoryview(decryptor.update(b''.join(ciphertext)) + decryptor.finalize())
+
+    position = 0
+    for sample in samples:
+        position += 16
+        sample[:] = plaintext[position:position + len(sample)]
+        position += len(sample)
+
+    os.pwrite(fd, buffer, start)
+
+def decrypt_file(source: str, destination: str, key: str, iv: str):
+    """
+    Writes the decrypted m4b of an aaxc file to destination, key and iv are the hex strings of the voucher.
+
+    The file keeps its structure, so the copy is made by the kernel and only the audio samples and a few
+    box types are rewritten in place. Raises UnsupportedFile before anything is written if the file can't be handled.
+    """
+    if not is_available():
+        raise UnsupportedFile('The cryptography package is not installed')
+
+    key_bytes = bytes.fromhex(key)
+    iv_bytes = bytes.fromhex(iv)
+    if len(key_bytes) != 16 or len(iv_bytes) != 16:
+        raise UnsupportedFile('Voucher key and iv must be 16 bytes')
+
+    try:
+        layout = read_layout(source)
+    except (ValueError, IndexError, struct.error) as e:
+        raise UnsupportedFile(f'Malformed file: {e}') from e
+
+    shutil.copyfile(source, destination)
+    try:
+        fd = os.open(destination, os.O_RDWR)
+        try:
+            for batch in _batches(layout.runs):
+                _decrypt_batch(fd, batch, key_bytes, iv_bytes)
+
+            for offset, value in layout.patches:
+                os.pwrite(fd, value, offset)
+        finally:
+            os.close(fd)
+    except BaseException:
+        os.remove(destination)
+        raise
+
+    _logger.debug(f'Decrypted {sum(len(run.sizes) for run in layout.runs)} samples of {source}')
@@ -0,0 +1,50 @@
+import json
+import os
+import re
+from typing import Dict, FrozenSet, Iterable, Tuple
+
+# The asins in the library of every named account are stored as {name}.json in this folder of the metadata folder
+ACCOUNTS_FOLDER = 'accounts'
+
+def parse_auth_file(value: str) -> Tuple[str | None, str]:
+    """Parses PATH or NAME=PATH, the name of an account is used in file names and the feed urls."""
+    name, separator, path = value.partition('=')
+    if not separator:
+        return None, value
+    if re.fullmatch(r'[A-Za-z0-9_-]+', name) is None:
+        raise ValueError(f'Account names may only contain letters, digits, _ and -: {name}')
+    return name, path
+
+def accounts_folder(metadata_folder: str) -> str:
+    return os.path.join(metadata_folder, ACCOUNTS_FOLDER)
+
+def accounts_mtime(metadata_folder: str) -> int | None:
+    try:
+        return os.stat(accounts_folder(metadata_folder)).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+def read_account_library(metadata_folder: str, name: str) -> FrozenSet[str]:
+    try:
+        with open(os.path.join(accounts_folder(metadata_folder), f'{name}.json'), 'r') as file:
+            return frozenset(json.load(file)['asins'])
+    except FileNotFoundError:
+        return frozenset()
+
+def read_account_libraries(metadata_folder: str) -> Dict[str, FrozenSet[str]]:
+    """Maps the name of every account to the asins in its library."""
+    try:
+        filenames = os.listdir(accounts_folder(metadata_folder))
+    except FileNotFoundError:
+        return dict()
+    names = sorted(filename[:-5] for filename in filenames if filename.endswith('.json'))
+    return {name: read_account_library(metadata_folder, name) for name in names}
+
+def write_account_library(metadata_folder: str, name: str, asins: Iterable[str]):
+    folder = accounts_folder(metadata_folder)
+    os.makedirs(folder, exist_ok=True)
+    path = os.path.join(folder, f'{name}.json')
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'w') as file:
+        json.dump({'asins': sorted(asins)}, file)
+    os.replace(tmp_path, path)
@@ -0,0 +1,349 @@
+import hmac
+import os
+import secrets
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from email.utils import format_datetime
+from typing import Any, BinaryIO, Callable, Dict, List, Tuple
+
+import anyio
+from starlette.exceptions import HTTPException
+from starlette.requests import Request
+
+from book_store import Book, get_library
+from cover_art import cover_filename
+from feed_cache import is_not_modified
+from metrics import Gauge
+
+# Size of the reads when the server doesn't support zero-copy sends, uvicorn doesn't
+CHUNK_SIZE = 256 * 1024
+
+# Requests with more ranges than this, after merging close ones, get the whole file
+MAX_RANGES = 16
+
+# Ranges with a smaller gap than this are merged, a separate part would cost more than the bytes in between
+RANGE_MERGE_GAP = 80
+
+MEDIA_TYPE = 'audio/mp4'
+
+ACTIVE_STREAMS = Gauge('audible_feed_audio_streams_active', 'Audio file responses currently being sent.')
+ACTIVE_COVER_RESPONSES = Gauge('audible_feed_cover_responses_active', 'Cover responses currently being sent.')
+
+# Copied from starlette utils
+def get_route_path(scope: dict[str, Any]) -> str:
+    path: str = scope["path"]
+    root_path = scope.get("root_path", "")
+    if not root_path:
+        return path
+
+    if not path.startswith(root_path):
+        return path
+
+    if path == root_path:
+        return ""
+
+    if path[len(root_path)] == "/":
+        return path[len(root_path) :]
+
+    return path
+
+@dataclass
+class OpenFile:
+    file: BinaryIO
+    size: int
+    mtime_ns: int
+    users: int = 0
+    evicted: bool = False
+
+    @property
+    def etag(self) -> str:
+        return f'"{self.size:x}-{self.mtime_ns:x}"'
+
+    @property
+    def last_modified(self) -> datetime:
+        # HTTP dates have a precision of seconds, anything finer breaks If-Modified-Since comparisons
+        return datetime.fromtimestamp(self.mtime_ns // 1_000_000_000, timezone.utc)
+
+class OpenFileCache:
+    """
+    Keeps the most recently served files open, so seeking podcast apps don't cost an open and fstat per request.
+
+    Files that are still being sent when they are evicted are closed by their last release. acquire() opens files
+    and is called from worker threads, so the cache is guarded by a lock.
+    """
+    def __init__(self, max_open_files: int):
+        self.max_open_files = max_open_files
+        self._files: OrderedDict[str, OpenFile] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def acquire(self, path: str) -> OpenFile:
+        with self._lock:
+            open_file = self._files.get(path)
+            if open_file is None:
+                file = open(path, 'rb', buffering=0)
+                stat = os.fstat(file.fileno())
+                open_file = OpenFile(file=file, size=stat.st_size, mtime_ns=stat.st_mtime_ns)
+                self._files[path] = open_file
+                while len(self._files) > self.max_open_files:
+                    _, oldest = self._files.popitem(last=False)
+                    self._evict(oldest)
+            else:
+                self._files.move_to_end(path)
+
+            open_file.users += 1
+            return open_file
+
+    def release(self, open_file: OpenFile):
+        with self._lock:
+            open_file.users -= 1
+            if open_file.evicted and open_file.users == 0:
+                open_file.file.close()
+
+    def clear(self):
+        with self._lock:
+            for open_file in self._files.values():
+                self._evict(open_file)
+            self._files.clear()
+
+    def _evict(self, open_file: OpenFile):
+        open_file.evicted = True
+        if open_file.users == 0:
+            open_file.file.close()
+
+def parse_ranges(http_range: str, size: int) -> List[Tuple[int, int]] | None:
+    """
+    Returns the satisfiable ranges of a Range header as start and inclusive end, sorted and with close ranges merged.
+
+    None means the header is invalid and has to be ignored, an empty list that no range is satisfiable.
+    """
+    unit, _, range_set = http_range.partition('=')
+    if unit.strip().lower() != 'bytes':
+        return None
+
+    ranges = list()
+    for range_spec in range_set.split(','):
+        range_spec = range_spec.strip()
+        if not range_spec:
+            continue
+        first, separator, last = range_spec.partition('-')
+        first, last = first.strip(), last.strip()
+        if not separator or not (first.isdigit() or first == '') or not (last.isdigit() or last == '') or first == last == '':
+            return None
+
+        if first == '':
+            suffix_length = int(last)
+            if suffix_length > 0 and size > 0:
+                ranges.append((max(size - suffix_length, 0), size - 1))
+            continue
+
+        start = int(first)
+        if last and int(last) < start:
+            return None
+        end = int(last) if last else size - 1
+        if start < size:
+            ranges.append((start, min(end, size - 1)))
+
+    ranges.sort()
+    merged = list()
+    for start, end in ranges:
+        if merged and start <= merged[-1][1] + RANGE_MERGE_GAP:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+class AudioFileServer:
+    """
+    Serves the decrypted audio files under /{hash}/{filename}.
+
+    Only files of books in the library and their split chapters are served, the chapters under the hash of their
+    book. The salted hashes are computed once per library generation. The library refresh and opening the files
+    run in worker threads, so they don't stall the streams on the event loop.
+    Responses carry a strong ETag and a long Cache-Control max-age so reverse proxies can cache them, ranges are
+    sent with the ASGI zero-copy extension when the server supports it. uvicorn doesn't, there the ranges are read
+    with pread in worker threads.
+    """
+    active_responses = ACTIVE_STREAMS
+
+    def __init__(self, directory: str, salted_hash: Callable[[str], str], max_open_files: int = 64, cache_max_age: int = 30 * 24 * 3600, media_type: str = MEDIA_TYPE):
+        self.directory = directory
+        self.salted_hash = salted_hash
+        self.media_type = media_type
+        self.cache_control = f'public, max-age={cache_max_age}'
+        self._open_files = OpenFileCache(max_open_files)
+        self._generation: int | None = None
+        # File name -> salted hash
+        self._hashes: Dict[str, str] = dict()
+        # Held while the hashes of a new generation are computed, so concurrent requests don't all rebuild them
+        self._rebuild_lock = threading.Lock()
+
+    def _book_hashes(self, book: Book) -> Dict[str, str]:
+        """Maps the files served for a book to their salted hash."""
+        book_hash = self.salted_hash(book.audio_file)
+        hashes = {book.audio_file: book_hash}
+        hashes.update((chapter.filename, book_hash) for chapter in book.chapter_files or ())
+        return hashes
+
+    def _expected_hash(self, filename: str) -> str | None:
+        library = get_library()
+        if library.generation != self._generation:
+            with self._rebuild_lock:
+                if library.generation != self._generation:
+                    hashes = dict()
+                    for book in library.books.values():
+                        hashes.update(self._book_hashes(book))
+                    self._hashes = hashes
+                    self._generation = library.generation
+                    # Files may have been replaced since they were opened
+                    self._open_files.clear()
+        return self._hashes.get(filename)
+
+    async def __call__(self, scope: dict, receive: Callable, send: Callable):
+        if scope['method'] not in ('GET', 'HEAD'):
+            raise HTTPException(status_code=405, headers={'Allow': 'GET, HEAD'})
+
+        hash_from_url, _, filename = get_route_path(scope)[1:].partition('/')
+        expected_hash = await anyio.to_thread.run_sync(self._expected_hash, filename)
+        if expected_hash is None or not hmac.compare_digest(hash_from_url.encode(), expected_hash.encode()):
+            raise HTTPException(status_code=404)
+
+        try:
+            open_file = await anyio.to_thread.run_sync(self._open_files.acquire, os.path.join(self.directory, filename))
+        except FileNotFoundError:
+            raise HTTPException(status_code=404)
+
+        self.active_responses.inc()
+        try:
+            await self._respond(Request(scope, receive), open_file, send)
+        finally:
+            self.active_responses.dec()
+            self._open_files.release(open_file)
+
+    async def _respond(self, request: Request, open_file: OpenFile, send: Callable):
+        headers = {
+            'accept-ranges': 'bytes',
+            'etag': open_file.etag,
+            'last-modified': format_datetime(open_file.last_modified, usegmt=True),
+            'cache-control': self.cache_control,
+        }
+
+        if is_not_modified(request, open_file.etag, open_file.last_modified):
+            await _send_start(send, 304, headers)
+            await send({'type': 'http.response.body', 'body': b''})
+            return
+
+        ranges = None
+        http_range = request.headers.get('range')
+        if http_range is not None and self._range_applies(request, open_file, headers):
+            ranges = parse_ranges(http_range, open_file.size)
+            if ranges is not None and len(ranges) > MAX_RANGES:
+                ranges = None
+
+        head = request.method == 'HEAD'
+        body = _BodySender(request.scope, send, open_file, head)
+
+        if ranges is None:
+            headers['content-type'] = self.media_type
+            headers['content-length'] = str(open_file.size)
+            await _send_start(send, 200, headers)
+            await body.file_range(0, open_file.size)
+        elif not ranges:
+            headers['content-range'] = f'bytes */{open_file.size}'
+            headers['content-length'] = '0'
+            await _send_start(send, 416, headers)
+        elif len(ranges) == 1:
+            start, end = ranges[0]
+            headers['content-type'] = self.media_type
+            headers['content-range'] = f'bytes {start}-{end}/{open_file.size}'
+            headers['content-length'] = str(end - start + 1)
+            await _send_start(send, 206, headers)
+            await body.file_range(start, end - start + 1)
+        else:
+            boundary = secrets.token_hex(16)
+            part_headers = [
+                f'--{boundary}\r\nContent-Type: {self.media_type}\r\nContent-Range: bytes {start}-{end}/{open_file.size}\r\n\r\n'.encode('latin-1')
+                for start, end in ranges
+            ]
+            closing = f'--{boundary}--\r\n'.encode('latin-1')
+            headers['content-type'] = f'multipart/byteranges; boundary={boundary}'
+            headers['content-length'] = str(
+                sum(len(part_header) + end - start + 1 + 2 for part_header, (start, end) in zip(part_headers, ranges)) + len(closing)
+            )
+            await _send_start(send, 206, headers)
+            for part_header, (start, end) in zip(part_headers, ranges):
+                await body.data(part_header)
+                await body.file_range(start, end - start + 1)
+                await body.data(b'\r\n')
+            await body.data(closing)
+
+        await body.finish()
+
+    @staticmethod
+    def _range_applies(request: Request, open_file: OpenFile, headers: Dict[str, str]) -> bool:
+        if_range = request.headers.get('if-range')
+        if if_range is None:
+            return True
+        # If-Range uses the strong comparison, a weak ETag never matches
+        if_range = if_range.strip()
+        return if_range == headers['etag'] or if_range == headers['last-modified']
+
+class CoverFileServer(AudioFileServer):
+    """
+    Serves the cover variants under /{hash}/{asin}.{size}.jpg from the covers folder.
+
+    All variants of a book share the salted hash of its asin, covers of books that aren't in the library aren't served.
+    """
+    active_responses = ACTIVE_COVER_RESPONSES
+
+    def __init__(self, directory: str, salted_hash: Callable[[str], str], max_open_files: int = 64, cache_max_age: int = 30 * 24 * 3600):
+        super().__init__(directory, salted_hash, max_open_files, cache_max_age, media_type='image/jpeg')
+
+    def _book_hashes(self, book: Book) -> Dict[str, str]:
+        if not book.has_cover:
+            return dict()
+        book_hash = cover_hash(self.salted_hash, book.asin)
+        return {cover_filename(book.asin, size): book_hash for size in book.cover_sizes}
+
+def cover_hash(salted_hash: Callable[[str], str], asin: str) -> str:
+    # Prefixed, so the hash of a cover never equals the hash of an audio file
+    return salted_hash(f'cover/{asin}')
+
+async def _send_start(send: Callable, status: int, headers: Dict[str, str]):
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [(name.encode('latin-1'), value.encode('latin-1')) for name, value in headers.items()],
+    })
+
+class _BodySender:
+    """Sends the parts of a response body, file ranges without copying them through python if the server allows it."""
+    def __init__(self, scope: dict, send: Callable, open_file: OpenFile, head: bool):
+        self.send = send
+        self.open_file = open_file
+        self.head = head
+        self.zero_copy = 'http.response.zerocopysend' in scope.get('extensions', {})
+
+    async def data(self, data: bytes):
+        if not self.head:
+            await self.send({'type': 'http.response.body', 'body': data, 'more_body': True})
+
+    async def file_range(self, offset: int, count: int):
+        if self.head or count == 0:
+            return
+        if self.zero_copy:
+            await self.send({'type': 'http.response.zerocopysend', 'file': self.open_file.file, 'offset': offset, 'count': count, 'more_body': True})
+            return
+
+        fd = self.open_file.file.fileno()
+        end = offset + count
+        while offset < end:
+            chunk = await anyio.to_thread.run_sync(os.pread, fd, min(CHUNK_SIZE, end - offset), offset)
+            if not chunk:
+                raise RuntimeError(f'File shrank while sending it, expected {end} bytes')
+            offset += len(chunk)
+            await self.send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+
+    async def finish(self):
+        await self.send({'type': 'http.response.body', 'body': b'', 'more_body': False})
@@ -0,0 +1,37 @@
+import os
+from dataclasses import dataclass
+from typing import Dict
+
+@dataclass(frozen=True)
+class AudioFile:
+    filename: str
+    size: int
+    mtime_ns: int
+
+def asin_from_audio_filename(filename: str) -> str | None:
+    """
+    Returns the asin of a decrypted audio file name or None, if it's not one.
+
+    library_downloader.generate_download_filename names the files {asin}_{CONTENT_ID}.aax, after
+    decryption they end in .m4b instead.
+    """
+    if not filename.endswith('.m4b'):
+        return None
+    asin, separator, _ = filename.partition('_')
+    if not separator or not asin:
+        return None
+    return asin
+
+def scan_audio_folder(path: str) -> Dict[str, AudioFile]:
+    """Maps the asin of every decrypted audio file in path to its file name, size and mtime in a single pass."""
+    audio_files = dict()
+
+    with os.scandir(path) as it:
+        for entry in it:
+            asin = asin_from_audio_filename(entry.name)
+            if asin is None or not entry.is_file():
+                continue
+            stat = entry.stat()
+            audio_files[asin] = AudioFile(filename=entry.name, size=stat.st_size, mtime_ns=stat.st_mtime_ns)
+
+    return audio_files
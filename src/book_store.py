@@ -1,58 +1,31 @@
+import logging
 import os
-import json
-import re
-from dataclasses import dataclass
-from typing import List, Dict
+import threading
+import time
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from typing import List, Dict, FrozenSet, Tuple
 import folder_settings
+from accounts import accounts_mtime, read_account_libraries
+from metrics import Counter, Gauge, Histogram
+from audio_store import AudioFile, scan_audio_folder
+from chapter_split import ChapterFile, read_chapter_files
+from cover_art import covers_mtime, scan_covers
+from media_probe import MediaInfo, read_media_info
+from metadata_store import MetadataStore, get_metadata_store
 
-def get_set_of_asins(path: str = folder_settings.METADATA_FOLDER):
-    metadata_files = [x for x in os.listdir(path) if re.fullmatch(r"(?!series)(?!content).*.json", x)]
+_logger = logging.getLogger(__name__)
 
-    asins = set()
+# How often the metadata store is fully refreshed to find files modified in place
+LIBRARY_RESCAN_INTERVAL = 5.0
 
-    for metadata_filename in metadata_files:
-        with open(os.path.join(path, metadata_filename), "r") as f:
-            parsed_data = json.load(f)
-            asins.add(parsed_data['product']['asin'])
+LIBRARY_REBUILDS = Counter('audible_feed_library_rebuilds_total', 'Rebuilds of the library index after metadata or audio files changed.')
+LIBRARY_REBUILD_SECONDS = Histogram('audible_feed_library_rebuild_seconds', 'Time to rescan the changed files and rebuild the library index.')
+METADATA_FILES = Gauge('audible_feed_metadata_files', 'Books in the metadata store.')
+LIBRARY_BOOKS = Gauge('audible_feed_library_books', 'Books in the library index, only books with an audio file are included.')
 
-    return asins
-
-def _get_parsed_metadata(path: str):
-    metadata_files = [x for x in os.listdir(path) if re.fullmatch(r"(?!series)(?!content).*.json", x)]
-
-    series_books = dict()
-    podcast_books = dict()
-    individual_books = list()
-
-    for metadata_filename in metadata_files:
-        with open(f'{path}/{metadata_filename}', "r") as metadata_file:
-            parsed_data = json.load(metadata_file)
-            is_individual = True
-            if 'series' in parsed_data['product']:
-                is_individual = False
-                for series in parsed_data['product']['series']:
-                    if series['asin'] not in series_books:
-                        series_books[series['asin']] = list()
-                    series_books[series['asin']].append(parsed_data['product'])
-            if 'podcasts' in parsed_data['product']:
-                is_individual = False
-                for podcast in parsed_data['product']['podcasts']:
-                    if podcast['asin'] not in podcast_books:
-                        podcast_books[podcast['asin']] = list()
-                    podcast_books[podcast['asin']].append(parsed_data['product'])
-            if is_individual:
-                individual_books.append(parsed_data['product'])
-
-    for series_asin, book_data in series_books.items():
-        book_data.sort(key=lambda x: list(filter(lambda y: y['asin'] == series_asin, x['series']))[0]['sequence'])
-
-    for podcast_asin, book_data in podcast_books.items():
-        book_data.sort(key=lambda x: float(list(filter(lambda y: y['asin'] == podcast_asin, x['podcasts']))[0]['sort']))
-
-    return individual_books, series_books, podcast_books
-
-def _find_m4b_file(book_asin: str, filelist: List):
-    return [x for x in filelist if re.fullmatch(rf".*_?{book_asin}_.*\.m4b", x)][0]
+def get_set_of_asins():
+    return get_metadata_store().get_set_of_asins()
 
 @dataclass
 class Book:
@@ -60,13 +33,31 @@ class Book:
     asin: str
     audio_file: str
     pub_date: str
+    byte_size: int
+    audio_mtime_ns: int
+    # Duration and chapters, None until the audio file was probed
+    media_info: MediaInfo | None = None
+    # One file per chapter, None until the audio file was split
+    chapter_files: List[ChapterFile] | None = None
+    # Sizes of the cover variants in the covers folder, largest first, empty without a cover
+    cover_sizes: Tuple[int, ...] = ()
 
-def _book_from_dict(d: Dict, filelist: List) -> Book:
+    @property
+    def has_cover(self) -> bool:
+        return bool(self.cover_sizes)
+
+def _book_from_dict(d: Dict, audio_files: Dict[str, AudioFile], media_info: Dict[AudioFile, MediaInfo], chapter_files: Dict[AudioFile, List[ChapterFile]], covers: Dict[str, Tuple[int, ...]]) -> Book:
+    audio_file = audio_files[d['asin']]
     return Book(
         title=d['title'],
         asin=d['asin'],
-        audio_file=_find_m4b_file(d['asin'], filelist=filelist),
+        audio_file=audio_file.filename,
         pub_date=d['release_date'],
+        byte_size=audio_file.size,
+        audio_mtime_ns=audio_file.mtime_ns,
+        media_info=media_info.get(audio_file),
+        chapter_files=chapter_files.get(audio_file),
+        cover_sizes=covers.get(d['asin'], ()),
     )
 
 @dataclass
@@ -81,55 +72,198 @@ class Podcast:
     asin: str
     books: List[Book]
 
-def _make_book_series(asin: str, books: List[Dict], filelist: List) -> BookSeries:
+def _make_book_series(asin: str, books: List[Dict], audio_files: Dict[str, AudioFile], media_info: Dict[AudioFile, MediaInfo], chapter_files: Dict[AudioFile, List[ChapterFile]], covers: Dict[str, Tuple[int, ...]]) -> BookSeries:
     title = list(filter(lambda x: x['asin'] == asin, books[0]['series']))[0]['title']
     return BookSeries(
         title=title,
         asin=asin,
-        books= [_book_from_dict(d, filelist) for d in books],
+        books= [_book_from_dict(d, audio_files, media_info, chapter_files, covers) for d in books],
     )
 
-def _make_book_podcast(asin: str, books: List[Dict], filelist: List) -> Podcast:
+def _make_book_podcast(asin: str, books: List[Dict], audio_files: Dict[str, AudioFile], media_info: Dict[AudioFile, MediaInfo], chapter_files: Dict[AudioFile, List[ChapterFile]], covers: Dict[str, Tuple[int, ...]]) -> Podcast:
     title = list(filter(lambda x: x['asin'] == asin, books[0]['podcasts']))[0]['title']
     return Podcast(
         title=title,
         asin=asin,
-        books= [_book_from_dict(d, filelist) for d in books],
+        books= [_book_from_dict(d, audio_files, media_info, chapter_files, covers) for d in books],
     )
 
+@dataclass
+class Library:
+    individual_books: List[Book]
+    series: Dict[str, BookSeries]
+    podcasts: Dict[str, Podcast]
+    # Incremented every time the library is rebuilt, used to invalidate anything derived from it
+    generation: int = 0
+    last_modified: datetime = datetime.fromtimestamp(0, timezone.utc)
+    # Every book of the library by asin
+    books: Dict[str, Book] = field(default_factory=dict)
+    # The part of the library of every named account, with the same generation
+    accounts: Dict[str, 'Library'] = field(default_factory=dict)
+
+def _account_library(library: Library, asins: FrozenSet[str]) -> Library:
+    """Filters the library down to the books of an account, the books are shared with the merged library."""
+    series = {asin: BookSeries(title=s.title, asin=asin, books=[b for b in s.books if b.asin in asins]) for asin, s in library.series.items()}
+    podcasts = {asin: Podcast(title=p.title, asin=asin, books=[b for b in p.books if b.asin in asins]) for asin, p in library.podcasts.items()}
+    return Library(
+        individual_books=[b for b in library.individual_books if b.asin in asins],
+        series={asin: s for asin, s in series.items() if s.books},
+        podcasts={asin: p for asin, p in podcasts.items() if p.books},
+        generation=library.generation,
+        last_modified=library.last_modified,
+        books={asin: b for asin, b in library.books.items() if asin in asins},
+    )
+
+class LibraryIndex:
+    """
+    Keeps the grouped and sorted library in memory and only rebuilds it when the metadata or audio files changed.
+
+    The cheap change checks of the metadata store and the audio folder mtime run on every refresh, a full
+    refresh of the metadata store, which also notices files modified in place, at most every
+    LIBRARY_RESCAN_INTERVAL seconds.
+    """
+    def __init__(self, metadata_store: MetadataStore, audio_folder: str, metadata_folder: str):
+        self.metadata_store = metadata_store
+        self.audio_folder = audio_folder
+        self.metadata_folder = metadata_folder
+        self.library = Library(individual_books=[], series={}, podcasts={})
+        self._audio_folder_mtime: int | None = None
+        self._audio_files: Dict[str, AudioFile] = dict()
+        self._media_info: Dict[AudioFile, MediaInfo] = dict()
+        self._chapter_files: Dict[AudioFile, List[ChapterFile]] = dict()
+        self._accounts_mtime: int | None = None
+        self._accounts: Dict[str, FrozenSet[str]] = dict()
+        self._covers_mtime: int | None = None
+        self._covers: Dict[str, Tuple[int, ...]] = dict()
+        self._last_scan = 0.0
+        self._lock = threading.Lock()
+
+    def refresh(self) -> Library:
+        with self._lock:
+            audio_folder_mtime = os.stat(self.audio_folder).st_mtime_ns
+            account_folder_mtime = accounts_mtime(self.metadata_folder)
+            cover_folder_mtime = covers_mtime(self.metadata_folder)
+            now = time.monotonic()
+
+            if (not self.metadata_store.has_changed()
+                    and audio_folder_mtime == self._audio_folder_mtime
+                    and account_folder_mtime == self._accounts_mtime
+                    and cover_folder_mtime == self._covers_mtime
+                    and now - self._last_scan < LIBRARY_RESCAN_INTERVAL):
+                return self.library
+
+            self._last_scan = now
+            start = time.perf_counter()
+            changed = self.metadata_store.refresh()
+
+            if audio_folder_mtime != self._audio_folder_mtime:
+                self._audio_files = scan_audio_folder(self.audio_folder)
+                self._media_info = self._read_media_info()
+                self._chapter_files = self._read_chapter_files()
+                changed = True
+
+            if account_folder_mtime != self._accounts_mtime:
+                self._accounts = read_account_libraries(self.metadata_folder)
+                changed = True
+
+            if cover_folder_mtime != self._covers_mtime:
+                self._covers = scan_covers(self.metadata_folder)
+                changed = True
+
+            if changed:
+                self.library = self._build_library(generation=self.library.generation + 1)
+                LIBRARY_REBUILDS.inc()
+                LIBRARY_REBUILD_SECONDS.observe(time.perf_counter() - start)
+
+            self._audio_folder_mtime = audio_folder_mtime
+            self._accounts_mtime = account_folder_mtime
+            self._covers_mtime = cover_folder_mtime
+            return self.library
+
+    def _read_media_info(self) -> Dict[AudioFile, MediaInfo]:
+        """Reads the probe sidecars of new or changed audio files, writing a sidecar also changes the folder mtime."""
+        media_info = dict()
+        for audio_file in self._audio_files.values():
+            info = self._media_info.get(audio_file) or read_media_info(self.audio_folder, audio_file)
+            if info is not None:
+                media_info[audio_file] = info
+        return media_info
+
+    def _read_chapter_files(self) -> Dict[AudioFile, List[ChapterFile]]:
+        """Reads the chapter split manifests of new or changed audio files, a new split also changes the folder mtime."""
+        chapter_files = dict()
+        for audio_file in self._audio_files.values():
+            files = self._chapter_files.get(audio_file) or read_chapter_files(self.audio_folder, audio_file)
+            if files is not None:
+                chapter_files[audio_file] = files
+        return chapter_files
+
+    def _build_library(self, generation: int) -> Library:
+        audio_files = self._audio_files
+        media_info = self._media_info
+        chapter_files = self._chapter_files
+        covers = self._covers
+        individual, series, podcasts = self.metadata_store.grouped_products()
+        METADATA_FILES.set(len({d['asin'] for d in individual} | {d['asin'] for books in (*series.values(), *podcasts.values()) for d in books}))
+
+        individual = [d for d in individual if self._has_audio_file(d, audio_files)]
+        series = {asin: [d for d in books if d['asin'] in audio_files] for asin, books in series.items()}
+        podcasts = {asin: [d for d in books if d['asin'] in audio_files] for asin, books in podcasts.items()}
+
+        book_series = [_make_book_series(asin=asin, books=books, audio_files=audio_files, media_info=media_info, chapter_files=chapter_files, covers=covers) for asin, books in series.items() if books]
+        book_series.sort(key=lambda s: s.title)
+        book_podcasts = [_make_book_podcast(asin=asin, books=books, audio_files=audio_files, media_info=media_info, chapter_files=chapter_files, covers=covers) for asin, books in podcasts.items() if books]
+        book_podcasts.sort(key=lambda s: s.title)
+
+        individual_books = sorted([_book_from_dict(d, audio_files, media_info, chapter_files, covers) for d in individual], key=lambda s: s.title)
+
+        books = {book.asin: book for book in individual_books}
+        for grouped in book_series + book_podcasts:
+            books.update((book.asin, book) for book in grouped.books)
+
+        library = Library(
+            individual_books=individual_books,
+            series={s.asin: s for s in book_series},
+            podcasts={p.asin: p for p in book_podcasts},
+            generation=generation,
+            last_modified=datetime.now(timezone.utc).replace(microsecond=0),
+            books=books,
+        )
+        library.accounts = {name: _account_library(library, asins) for name, asins in self._accounts.items()}
+        LIBRARY_BOOKS.set(len(books))
+        return library
+
+    @staticmethod
+    def _has_audio_file(product: Dict, audio_files: Dict[str, AudioFile]) -> bool:
+        if product['asin'] in audio_files:
+            return True
+        _logger.warning(f'No audio file found for {product["asin"]}, skipping it')
+        return False
+
+_library_index: LibraryIndex | None = None
+_library_index_lock = threading.Lock()
+
+def get_library() -> Library:
+    global _library_index
+    with _library_index_lock:
+        if _library_index is None:
+            _library_index = LibraryIndex(get_metadata_store(), folder_settings.AUDIO_FOLDER, folder_settings.METADATA_FOLDER)
+    return _library_index.refresh()
+
 def get_all_individual_books() -> List[Book]:
-    filelist = os.listdir(folder_settings.AUDIO_FOLDER)
-    books, _, _ = _get_parsed_metadata(folder_settings.METADATA_FOLDER)
-    return sorted([_book_from_dict(d, filelist) for d in books], key=lambda s: s.title)
+    return list(get_library().individual_books)
 
 def get_series_by_asin(asin: str) -> BookSeries:
-    filelist = os.listdir(folder_settings.AUDIO_FOLDER)
-    _, series, _ = _get_parsed_metadata(folder_settings.METADATA_FOLDER)
-    return _make_book_series(asin=asin, books=series[asin], filelist=filelist)
+    return get_library().series[asin]
 
 def get_podcast_by_asin(asin: str) -> Podcast:
-    filelist = os.listdir(folder_settings.AUDIO_FOLDER)
-    _, _, podcasts = _get_parsed_metadata(folder_settings.METADATA_FOLDER)
-    return _make_book_podcast(asin=asin, books=podcasts[asin], filelist=filelist)
+    return get_library().podcasts[asin]
 
 def get_audio_file_from_asin(asin: str) -> str:
-    filelist = os.listdir(folder_settings.AUDIO_FOLDER)
-    return _find_m4b_file(asin, filelist)
+    return get_library().books[asin].audio_file
 
 def get_series() -> List[BookSeries]:
-    filelist = os.listdir(folder_settings.AUDIO_FOLDER)
-    book_series = list()
-    _, series, _ = _get_parsed_metadata(folder_settings.METADATA_FOLDER)
-    for series_asin, book_data in series.items():
-        book_series.append(_make_book_series(asin=series_asin, books=book_data, filelist=filelist))
-    book_series.sort(key=lambda s: s.title)
-    return book_series
+    return list(get_library().series.values())
 
 def get_podcasts() -> List[Podcast]:
-    filelist = os.listdir(folder_settings.AUDIO_FOLDER)
-    book_series = list()
-    _, _, podcasts = _get_parsed_metadata(folder_settings.METADATA_FOLDER)
-    for podcasts_asin, book_data in podcasts.items():
-        book_series.append(_make_book_podcast(asin=podcasts_asin, books=book_data, filelist=filelist))
-    book_series.sort(key=lambda s: s.title)
-    return book_series
+    return list(get_library().podcasts.values())
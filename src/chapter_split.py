@@ -0,0 +1,107 @@
+import asyncio
+import json
+import logging
+import os
+import shutil
+from dataclasses import dataclass, asdict
+from typing import List
+
+from audio_store import AudioFile
+from media_probe import MediaInfo
+
+_logger = logging.getLogger(__name__)
+
+# The chapters of {filename} are stored in the folder {filename}.chapters next to it
+SPLIT_SUFFIX = '.chapters'
+MANIFEST_FILENAME = 'chapters.json'
+
+@dataclass(frozen=True)
+class ChapterFile:
+    title: str
+    start: float
+    end: float
+    # Relative to the audio folder
+    filename: str
+    size: int
+
+def split_folder(audio_folder: str, audio_file: AudioFile) -> str:
+    return os.path.join(audio_folder, audio_file.filename + SPLIT_SUFFIX)
+
+def read_chapter_files(audio_folder: str, audio_file: AudioFile) -> List[ChapterFile] | None:
+    """
+    Returns the split chapters of an audio file.
+
+    Returns None if the file wasn't split or the split was made from a different version of the audio file.
+    """
+    try:
+        with open(os.path.join(split_folder(audio_folder, audio_file), MANIFEST_FILENAME), 'r') as file:
+            manifest = json.load(file)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+    if manifest.get('size') != audio_file.size or manifest.get('mtime_ns') != audio_file.mtime_ns:
+        return None
+    return [ChapterFile(**chapter) for chapter in manifest['chapters']]
+
+async def split_chapter(source: str, start: float, end: float, title: str, destination: str):
+    """Copies one chapter into its own file without re-encoding."""
+    args = [
+        'ffmpeg', '-v', 'error', '-y',
+        '-ss', f'{start:.3f}',
+        '-i', source,
+        '-t', f'{end - start:.3f}',
+        '-map', '0:a',
+        '-c', 'copy',
+        '-map_chapters', '-1',
+        '-metadata', f'title={title}',
+        # The index at the front lets players start before the whole file is downloaded
+        '-movflags', '+faststart',
+        destination,
+    ]
+    proc = await asyncio.create_subprocess_exec(*args, stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.PIPE)
+    _, stderr = await proc.communicate()
+    if proc.returncode != 0:
+        raise RuntimeError(f'ffmpeg failed to split {source} at {start}: {stderr.decode(errors="replace").strip()}')
+
+async def split_book(semaphore: asyncio.Semaphore, audio_folder: str, audio_file: AudioFile, media_info: MediaInfo) -> List[ChapterFile]:
+    """
+    Splits an audio file into one file per chapter, the semaphore limits how many ffmpeg processes run in parallel.
+
+    The chapters are written to a temporary folder that replaces the previous split once all chapters are done.
+    """
+    folder = split_folder(audio_folder, audio_file)
+    tmp_folder = f'{folder}.tmp'
+    shutil.rmtree(tmp_folder, ignore_errors=True)
+    os.makedirs(tmp_folder)
+
+    source = os.path.join(audio_folder, audio_file.filename)
+    names = [f'{i + 1:03d}.m4a' for i in range(len(media_info.chapters))]
+
+    async def split(chapter, name: str):
+        async with semaphore:
+            await split_chapter(source, chapter.start, chapter.end, chapter.title, os.path.join(tmp_folder, name))
+
+    try:
+        await asyncio.gather(*(split(chapter, name) for chapter, name in zip(media_info.chapters, names)))
+
+        chapter_files = [
+            ChapterFile(
+                title=chapter.title,
+                start=chapter.start,
+                end=chapter.end,
+                filename=f'{audio_file.filename}{SPLIT_SUFFIX}/{name}',
+                size=os.path.getsize(os.path.join(tmp_folder, name)),
+            )
+            for chapter, name in zip(media_info.chapters, names)
+        ]
+        with open(os.path.join(tmp_folder, MANIFEST_FILENAME), 'w') as file:
+            json.dump({'size': audio_file.size, 'mtime_ns': audio_file.mtime_ns, 'chapters': [asdict(x) for x in chapter_files]}, file)
+
+        shutil.rmtree(folder, ignore_errors=True)
+        os.rename(tmp_folder, folder)
+    except BaseException:
+        shutil.rmtree(tmp_folder, ignore_errors=True)
+        raise
+
+    _logger.debug(f'Split {audio_file.filename} into {len(chapter_files)} chapters')
+    return chapter_files
@@ -0,0 +1,155 @@
+import asyncio
+import glob
+import json
+import logging
+import os
+import urllib.parse
+from typing import Dict, Tuple
+
+import httpx
+
+from request_scheduler import RequestScheduler
+
+_logger = logging.getLogger(__name__)
+
+# The covers are stored as {asin}.{size}.jpg in this folder of the metadata folder
+COVERS_FOLDER = 'covers'
+
+# Boxes in pixels the variants are fitted into, 1400 is the smallest cover Apple Podcasts accepts, the others are
+# the sizes podcast apps show in lists. The first one is requested from audible and the others are scaled down from
+# it. A source is never enlarged, so a smaller one only gets the variants up to its own size.
+COVER_SIZES = (1400, 600, 300)
+
+def covers_folder(metadata_folder: str) -> str:
+    return os.path.join(metadata_folder, COVERS_FOLDER)
+
+def cover_filename(asin: str, size: int) -> str:
+    return f'{asin}.{size}.jpg'
+
+def covers_mtime(metadata_folder: str) -> int | None:
+    try:
+        return os.stat(covers_folder(metadata_folder)).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+def variant_sizes(source_size: int) -> Tuple[int, ...]:
+    """The sizes of the variants of a source whose longer side has source_size pixels, largest first."""
+    return tuple(sorted({min(size, source_size) for size in COVER_SIZES}, reverse=True))
+
+def _parse_cover_filename(filename: str) -> Tuple[str, int] | None:
+    asin, _, rest = filename.partition('.')
+    size, _, extension = rest.partition('.')
+    if extension != 'jpg' or not size.isdigit():
+        return None
+    return asin, int(size)
+
+def _complete_sizes(sizes: set) -> Tuple[int, ...] | None:
+    # The largest stored variant tells the size of the source, all variants of that source have to be there
+    if not sizes:
+        return None
+    expected = variant_sizes(max(sizes))
+    return expected if sizes.issuperset(expected) else None
+
+def scan_covers(metadata_folder: str) -> Dict[str, Tuple[int, ...]]:
+    """Returns the sizes of the stored variants, largest first, by asin for the covers that have all of them."""
+    try:
+        filenames = os.listdir(covers_folder(metadata_folder))
+    except FileNotFoundError:
+        return dict()
+    sizes = dict()
+    for filename in filenames:
+        parsed = _parse_cover_filename(filename)
+        if parsed is not None:
+            sizes.setdefault(parsed[0], set()).add(parsed[1])
+    covers = {asin: _complete_sizes(asin_sizes) for asin, asin_sizes in sizes.items()}
+    return {asin: cover_sizes for asin, cover_sizes in covers.items() if cover_sizes is not None}
+
+def has_cover(metadata_folder: str, asin: str) -> bool:
+    folder = covers_folder(metadata_folder)
+    # The smallest variant is written last
+    if os.path.exists(os.path.join(folder, cover_filename(asin, COVER_SIZES[-1]))):
+        return True
+    # A source smaller than the smallest size only has a variant of its own size
+    filenames = glob.glob(f'{glob.escape(asin)}.*.jpg', root_dir=folder)
+    sizes = {parsed[1] for parsed in map(_parse_cover_filename, filenames) if parsed is not None}
+    return _complete_sizes(sizes) is not None
+
+def cover_url_from_item(item: Dict) -> str | None:
+    """Returns the largest image of the product_images response group of a library or catalog item."""
+    images = item.get('product_images') or dict()
+    sizes = [size for size in images if size.isdigit()]
+    if not sizes:
+        return None
+    return images[max(sizes, key=int)]
+
+async def _source_size(source: str) -> int:
+    """Returns the longer side of an image in pixels."""
+    proc = await asyncio.create_subprocess_exec(
+        'ffprobe', '-v', 'error', '-select_streams', 'v:0', '-show_entries', 'stream=width,height', '-print_format', 'json', source,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.DEVNULL,
+    )
+    stdout, _ = await proc.communicate()
+    if proc.returncode != 0:
+        raise RuntimeError(f'ffprobe failed for {source}')
+    stream = json.loads(stdout)['streams'][0]
+    return max(int(stream['width']), int(stream['height']))
+
+async def _scale(source: str, size: int, destination: str):
+    tmp_destination = f'{destination[:-4]}.tmp.jpg'
+    proc = await asyncio.create_subprocess_exec(
+        'ffmpeg', '-v', 'error', '-y',
+        '-i', source,
+        # Fits the cover into the box, sizes are never larger than the source
+        '-vf', f"scale=w='min(iw,{size})':h='min(ih,{size})':force_original_aspect_ratio=decrease",
+        '-q:v', '3',
+        tmp_destination,
+        stdout=asyncio.subprocess.DEVNULL,
+        stderr=asyncio.subprocess.PIPE,
+    )
+    _, stderr = await proc.communicate()
+    if proc.returncode != 0:
+        raise RuntimeError(f'ffmpeg failed to scale {source} to {size}: {stderr.decode(errors="replace").strip()}')
+    os.replace(tmp_destination, destination)
+
+async def fetch_cover(httpx_client: httpx.AsyncClient, scheduler: RequestScheduler, metadata_folder: str, asin: str, url: str):
+    """
+    Downloads the cover of a book and stores its variants, named after the size they really have.
+
+    The variants are encoded once here, so the feed server only sends files. The smallest variant is written last,
+    an interrupted fetch leaves the cover incomplete and it is fetched again.
+    """
+    folder = covers_folder(metadata_folder)
+    os.makedirs(folder, exist_ok=True)
+    source = os.path.join(folder, f'{asin}.source.jpg')
+
+    async def request():
+        response = await httpx_client.get(url, follow_redirects=True)
+        response.raise_for_status()
+        return response
+
+    resp = await scheduler.call(urllib.parse.urlparse(url).hostname, request)
+    with open(source, 'wb') as file:
+        file.write(resp.content)
+
+    try:
+        for size in variant_sizes(await _source_size(source)):
+            await _scale(source, size, os.path.join(folder, cover_filename(asin, size)))
+    finally:
+        os.remove(source)
+    _logger.debug(f'Stored the cover of {asin}')
+
+async def ensure_cover(httpx_client: httpx.AsyncClient, scheduler: RequestScheduler, metadata_folder: str, book_data: Dict) -> bool:
+    """Fetches the cover of a book unless it is already stored, a failed fetch is only logged. Returns if the book has a cover."""
+    asin = book_data['asin']
+    if has_cover(metadata_folder, asin):
+        return True
+    url = book_data.get('cover_url')
+    if not url:
+        return False
+    try:
+        await fetch_cover(httpx_client, scheduler, metadata_folder, asin, url)
+    except Exception as e:
+        _logger.warning(f'Failed to fetch the cover of {asin}: {e}')
+        return False
+    return True
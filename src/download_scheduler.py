@@ -0,0 +1,144 @@
+import asyncio
+import heapq
+import math
+import time
+from dataclasses import dataclass
+from datetime import datetime, time as time_of_day
+from typing import Any, Callable, Dict, List, Sequence
+
+def _purchase_timestamp(cur: Any) -> float:
+    if not cur.purchase_date:
+        return 0.0
+    return datetime.fromisoformat(cur.purchase_date.replace('Z', '+00:00')).timestamp()
+
+def _runtime(cur: Any) -> float:
+    # The chapter info of the license is the first place the length of a book is known
+    runtime = (cur.chapter_info or {}).get('runtime_length_ms')
+    return runtime if runtime is not None else math.inf
+
+def _sequence(series: Dict) -> float | None:
+    try:
+        return float(series['sequence'])
+    except (KeyError, TypeError, ValueError):
+        return None
+
+def series_progress(series: Dict[str, List[Dict]]) -> Dict[str, float]:
+    """Maps the asin of every series to the highest sequence of its books that are already in the library."""
+    progress = dict()
+    for asin, books in series.items():
+        sequences = [_sequence(s) for book in books for s in book['series'] if s['asin'] == asin]
+        sequences = [x for x in sequences if x is not None]
+        if sequences:
+            progress[asin] = max(sequences)
+    return progress
+
+def _series_distance(cur: Any, progress: Dict[str, float]) -> float:
+    # 1 for the next book of a series that was started, books of series without a book yet come last
+    distance = math.inf
+    for series in (cur.book_data or {}).get('series', []):
+        sequence = _sequence(series)
+        last = progress.get(series['asin'])
+        if sequence is not None and last is not None and sequence > last:
+            distance = min(distance, sequence - last)
+    return distance
+
+# Policy name -> key of a book, lower keys are downloaded first
+PRIORITY_POLICIES: Dict[str, Callable[[Any, Dict[str, float]], float]] = {
+    'newest': lambda cur, progress: -_purchase_timestamp(cur),
+    'oldest': lambda cur, progress: _purchase_timestamp(cur),
+    'smallest': lambda cur, progress: _runtime(cur),
+    'series': _series_distance,
+}
+
+def parse_priority(value: str) -> List[str]:
+    policies = [x.strip() for x in value.split(',') if x.strip()]
+    unknown = [x for x in policies if x not in PRIORITY_POLICIES]
+    if unknown:
+        raise ValueError(f'Unknown priority policies {", ".join(unknown)}, choose from {", ".join(PRIORITY_POLICIES)}')
+    return policies
+
+class PriorityQueue(asyncio.Queue):
+    """
+    A queue that hands out books by the keys of the policies, in the given order, ties in the order they were put.
+
+    It stands in front of the downloads, so the license and metadata requests can run up to maxsize books
+    ahead while the downloads always pick the most wanted one. The bound keeps the download links of the
+    waiting books from expiring.
+    """
+    def __init__(self, policies: Sequence[str], progress: Dict[str, float] | None = None, maxsize: int = 0):
+        self._policies = [PRIORITY_POLICIES[x] for x in policies]
+        self._progress = progress or dict()
+        super().__init__(maxsize)
+
+    def _init(self, maxsize: int):
+        self._queue = list()
+        self._count = 0
+
+    def _put(self, item: Any):
+        key = tuple(policy(item, self._progress) for policy in self._policies)
+        heapq.heappush(self._queue, (key, self._count, item))
+        self._count += 1
+
+    def _get(self) -> Any:
+        return heapq.heappop(self._queue)[2]
+
+@dataclass(frozen=True)
+class BandwidthWindow:
+    # None or equal for the whole day, a window with end before start spans midnight
+    start: time_of_day | None
+    end: time_of_day | None
+    rate: float
+
+    def contains(self, now: time_of_day) -> bool:
+        if self.start is None or self.start == self.end:
+            return True
+        if self.start <= self.end:
+            return self.start <= now < self.end
+        return now >= self.start or now < self.end
+
+_UNITS = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+
+def parse_rate(value: str) -> float:
+    """Parses bytes per second with an optional K, M or G suffix."""
+    value = value.strip().upper()
+    unit = value[-1] if value and value[-1] in _UNITS else ''
+    rate = float(value[:len(value) - len(unit)]) * _UNITS[unit]
+    if rate <= 0:
+        raise ValueError(f'Bandwidth limit must be positive: {value}')
+    return rate
+
+def parse_bandwidth_window(value: str) -> BandwidthWindow:
+    """Parses RATE for the whole day or HH:MM-HH:MM=RATE, e.g. 08:00-23:00=2M."""
+    window, separator, rate = value.rpartition('=')
+    if not separator:
+        return BandwidthWindow(start=None, end=None, rate=parse_rate(rate))
+    start, _, end = window.partition('-')
+    return BandwidthWindow(start=time_of_day.fromisoformat(start.strip()), end=time_of_day.fromisoformat(end.strip()), rate=parse_rate(rate))
+
+class BandwidthLimiter:
+    """
+    Caps the combined rate of all downloads, the first window that contains the local time sets the rate.
+
+    consume() is called after every received chunk and sleeps until the chunk would have arrived at the
+    allowed rate, the read pauses then slow the sender down through TCP flow control.
+    """
+    def __init__(self, windows: Sequence[BandwidthWindow] = ()):
+        self.windows = list(windows)
+        self._next = 0.0
+
+    def current_rate(self) -> float | None:
+        now = datetime.now().time()
+        for window in self.windows:
+            if window.contains(now):
+                return window.rate
+        return None
+
+    async def consume(self, amount: int):
+        if not self.windows:
+            return
+        rate = self.current_rate()
+        if rate is None:
+            return
+        now = time.monotonic()
+        self._next = max(self._next, now) + amount / rate
+        await asyncio.sleep(self._next - now)
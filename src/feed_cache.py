@@ -0,0 +1,188 @@
+import gzip
+import hashlib
+import threading
+import zlib
+from collections import OrderedDict
+from dataclasses import dataclass
+from datetime import datetime
+from email.utils import format_datetime, parsedate_to_datetime
+from typing import Callable, Dict, Hashable, Iterable, Iterator
+
+from starlette.requests import Request
+from starlette.responses import Response, StreamingResponse
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+@dataclass(frozen=True)
+class RenderedFeed:
+    body: bytes
+    media_type: str
+    etag: str
+    last_modified: datetime
+    # Content-Encoding -> compressed body, only contains encodings that are smaller than the plain body
+    encoded_bodies: Dict[str, bytes]
+
+def _compress(body: bytes) -> Dict[str, bytes]:
+    encoded_bodies = {'gzip': gzip.compress(body, mtime=0)}
+    if brotli is not None:
+        encoded_bodies['br'] = brotli.compress(body, mode=brotli.MODE_TEXT)
+    return {encoding: data for encoding, data in encoded_bodies.items() if len(data) < len(body)}
+
+class FeedCache:
+    """
+    Keeps rendered feeds in memory until the library generation changes.
+
+    The compressed variants are created once when a feed is rendered, so serving them costs no compression.
+
+    Keys should contain everything the rendered body depends on besides the library, e.g. the route,
+    the asin and the url prefix. The url prefix comes from request headers, so at most max_feeds feeds are
+    kept and the least recently used one is dropped first.
+    """
+    def __init__(self, max_feeds: int = 1024):
+        self.max_feeds = max_feeds
+        self._feeds: OrderedDict[Hashable, RenderedFeed] = OrderedDict()
+        self._generation: int | None = None
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable, generation: int, last_modified: datetime, media_type: str, render: Callable[[], str]) -> RenderedFeed:
+        with self._lock:
+            if generation != self._generation:
+                self._feeds.clear()
+                self._generation = generation
+            feed = self._feeds.get(key)
+            if feed is not None:
+                self._feeds.move_to_end(key)
+
+        if feed is not None:
+            return feed
+
+        body = render().encode('utf-8')
+        feed = RenderedFeed(
+            body=body,
+            media_type=media_type,
+            etag=f'"{hashlib.sha256(body).hexdigest()[:32]}"',
+            last_modified=last_modified,
+            encoded_bodies=_compress(body),
+        )
+
+        with self._lock:
+            if generation == self._generation:
+                self._feeds[key] = feed
+                while len(self._feeds) > self.max_feeds:
+                    self._feeds.popitem(last=False)
+        return feed
+
+def is_not_modified(request: Request, etag: str, last_modified: datetime) -> bool:
+    if_none_match = request.headers.get('if-none-match')
+    if if_none_match is not None:
+        if if_none_match.strip() == '*':
+            return True
+        # If-None-Match uses the weak comparison
+        return etag in [x.strip().removeprefix('W/') for x in if_none_match.split(',')]
+
+    if_modified_since = request.headers.get('if-modified-since')
+    if if_modified_since is not None:
+        try:
+            return last_modified <= parsedate_to_datetime(if_modified_since)
+        except (TypeError, ValueError):
+            return False
+
+    return False
+
+def _accepted_encodings(accept_encoding: str) -> Dict[str, float]:
+    accepted = dict()
+    for coding in accept_encoding.split(','):
+        name, _, params = coding.partition(';')
+        quality = 1.0
+        for param in params.split(';'):
+            key, _, value = param.partition('=')
+            if key.strip().lower() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        if name.strip():
+            accepted[name.strip().lower()] = quality
+    return accepted
+
+def _select_encoding(request: Request, feed: RenderedFeed) -> str | None:
+    accepted = _accepted_encodings(request.headers.get('accept-encoding', ''))
+    best = None
+    # Prefer brotli over gzip if the client accepts both equally
+    for encoding in ('br', 'gzip'):
+        quality = accepted.get(encoding, accepted.get('*', 0.0))
+        if encoding in feed.encoded_bodies and quality > 0 and (best is None or quality > best[1]):
+            best = (encoding, quality)
+    return best[0] if best else None
+
+def feed_response(request: Request, feed: RenderedFeed) -> Response:
+    encoding = _select_encoding(request, feed)
+    # Each encoding is a different representation and needs its own strong ETag
+    etag = f'{feed.etag[:-1]}-{encoding}"' if encoding else feed.etag
+    headers = {
+        'ETag': etag,
+        'Last-Modified': format_datetime(feed.last_modified, usegmt=True),
+        'Vary': 'Accept-Encoding',
+    }
+    if is_not_modified(request, etag, feed.last_modified):
+        return Response(status_code=304, headers=headers)
+    if encoding is None:
+        return Response(feed.body, media_type=feed.media_type, headers=headers)
+    headers['Content-Encoding'] = encoding
+    return Response(feed.encoded_bodies[encoding], media_type=feed.media_type, headers=headers)
+
+# Streamed feeds are sent in chunks of at least this size instead of every small piece the template yields
+STREAM_CHUNK_SIZE = 64 * 1024
+
+def streamed_feed_etag(key: Hashable, generation: int, last_modified: datetime) -> str:
+    """
+    A streamed feed is only known after it was sent, so its ETag is derived from what it's rendered from.
+
+    last_modified is part of it because generations start over when the server restarts.
+    """
+    return f'"{hashlib.sha256(repr((key, generation, last_modified.timestamp())).encode()).hexdigest()[:32]}"'
+
+def _buffered(chunks: Iterable[str]) -> Iterator[bytes]:
+    buffer = list()
+    length = 0
+    for chunk in chunks:
+        data = chunk.encode('utf-8')
+        buffer.append(data)
+        length += len(data)
+        if length >= STREAM_CHUNK_SIZE:
+            yield b''.join(buffer)
+            buffer.clear()
+            length = 0
+    if buffer:
+        yield b''.join(buffer)
+
+def _gzip_stream(chunks: Iterable[bytes]) -> Iterator[bytes]:
+    compressor = zlib.compressobj(wbits=31)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+def streamed_feed_response(request: Request, etag: str, last_modified: datetime, media_type: str, render: Callable[[], Iterable[str]]) -> Response:
+    """Sends the feed while it's rendered, gzip compressed if the client accepts it."""
+    accepted = _accepted_encodings(request.headers.get('accept-encoding', ''))
+    use_gzip = accepted.get('gzip', accepted.get('*', 0.0)) > 0
+    if use_gzip:
+        etag = f'{etag[:-1]}-gzip"'
+    headers = {
+        'ETag': etag,
+        'Last-Modified': format_datetime(last_modified, usegmt=True),
+        'Vary': 'Accept-Encoding',
+    }
+    if is_not_modified(request, etag, last_modified):
+        return Response(status_code=304, headers=headers)
+
+    chunks = _buffered(render())
+    if use_gzip:
+        headers['Content-Encoding'] = 'gzip'
+        chunks = _gzip_stream(chunks)
+    return StreamingResponse(chunks, media_type=media_type, headers=headers)
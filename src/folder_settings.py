@@ -1,3 +1,5 @@
 METADATA_FOLDER: str
 AUDIO_FOLDER: str
 DOWNLOAD_FOLDER: str
+METADATA_BACKEND: str = 'json'
+METADATA_CATALOG: str
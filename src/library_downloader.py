@@ -1,10 +1,16 @@
 import argparse
+import collections
+import dataclasses
+import functools
 import json
 import os
+import random
 import re
+import signal
+import time
 import urllib.parse
 from dataclasses import dataclass
-from typing import List, Any, Callable
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Sequence, Set
 
 import audible
 from audible.aescipher import decrypt_voucher_from_licenserequest
@@ -12,10 +18,26 @@ import asyncio
 import httpx
 from pathlib import Path
 import logging
+import multiprocessing
+from concurrent.futures import Executor, ProcessPoolExecutor
 
+from audible.client import convert_response_content, raise_for_status
 from audible.exceptions import NotFoundError
 
+import aax_decrypter
+import accounts
+import chapter_split
+import cover_art
+import download_scheduler
 import folder_settings
+import mp4
+from audio_store import AudioFile, scan_audio_folder
+from download_scheduler import BandwidthLimiter, PriorityQueue
+from media_probe import probe_and_store, read_media_info
+from metadata_store import get_metadata_store, import_json_folder, write_if_changed, SqliteMetadataStore
+from pipeline_stats import BookStats, PipelineStats, TransferProgress
+from request_scheduler import AUDIBLE_API_HOST, HostLimits, RequestScheduler, ScheduledAudibleClient
+from sync_state import SyncState
 get_set_of_asins = Callable[[str], set]
 
 _logger = logging.getLogger(__name__)
@@ -27,6 +49,9 @@ class ProcessingBook:
     download_link: str | None = None
     filename: str | None = None
     decryption_voucher: dict[str, Any] | None = None
+    chapter_info: dict[str, Any] | None = None
+    purchase_date: str | None = None
+    stats: BookStats = dataclasses.field(default_factory=BookStats)
 
 def _make_minimal_series(series: dict):
     return {
@@ -44,7 +69,7 @@ def _make_minimal_podcast(podcast: dict):
 
 async def get_non_owned_book_data(audible_client: audible.AsyncClient, asin: str) -> dict:
     try:
-        resp = await audible_client.get(f"/1.0/catalog/products/{asin}", params={"response_groups": "contributors, media, price, product_attrs, product_desc, product_details, product_extended_attrs, product_plan_details, product_plans, rating, sample, sku, series, reviews, relationships, review_attrs, category_ladders, claim_code_url, provided_review, rights, customer_rights, goodreads_ratings"})
+        resp = await audible_client.get(f"/1.0/catalog/products/{asin}", params={"response_groups": "contributors, media, price, product_attrs, product_desc, product_details, product_extended_attrs, product_plan_details, product_plans, rating, sample, sku, series, reviews, relationships, review_attrs, category_ladders, claim_code_url, provided_review, rights, customer_rights, goodreads_ratings, product_images", "image_sizes": IMAGE_SIZES})
 
         item = resp['product']
 
@@ -69,64 +94,200 @@ async def get_non_owned_book_data(audible_client: audible.AsyncClient, asin: str
                 series.append(_make_minimal_series(s))
             audible_book['series'] = series
 
+        cover_url = cover_art.cover_url_from_item(item)
+        if cover_url:
+            audible_book['cover_url'] = cover_url
+
         return audible_book
     except Exception as e:
         _logger.error(f'Failed to get non-owned book data: {e}')
 
-async def get_book_data(audible_client: audible.AsyncClient, asin: str):
-    try:
+LIBRARY_RESPONSE_GROUPS = "series, product_desc, media, relationships, product_images"
+IMAGE_SIZES = str(cover_art.COVER_SIZES[0])
 
-        resp = await audible_client.get(f"/1.0/library/{asin}", params={"response_groups": "series, product_desc, media, relationships"})
-        item = resp['item']
+def _make_book_data(item: dict) -> dict:
+    """Builds the minimal metadata from an item of the library api."""
+    audible_book = {
+        'asin': item['asin'],
+        'title': item['title'],
+        'lang': item['language'],
+        'release_date': item['release_date']
+    }
 
-        audible_book = {
-            'asin': item['asin'],
-            'title': item['title'],
-            'lang': item['language'],
-            'release_date': item['release_date']
-        }
+    if item['relationships']:
+        podcasts = list()
+        for r in item['relationships']:
+            if 'content_delivery_type' in r and r['content_delivery_type'] == 'PodcastParent':
+                podcasts.append(_make_minimal_podcast(r))
+        if len(podcasts) > 0:
+            audible_book['podcasts'] = podcasts
 
-        if item['relationships']:
-            podcasts = list()
-            for r in item['relationships']:
-                if 'content_delivery_type' in r and r['content_delivery_type'] == 'PodcastParent':
-                    podcasts.append(_make_minimal_podcast(r))
-            if len(podcasts) > 0:
-                audible_book['podcasts'] = podcasts
+    if item['series']:
+        series = list()
+        for s in item['series']:
+            series.append(_make_minimal_series(s))
+        audible_book['series'] = series
 
-        if item['series']:
-            series = list()
-            for s in item['series']:
-                series.append(_make_minimal_series(s))
-            audible_book['series'] = series
+    cover_url = cover_art.cover_url_from_item(item)
+    if cover_url:
+        audible_book['cover_url'] = cover_url
 
-        return audible_book
+    return audible_book
+
+async def get_book_data(audible_client: audible.AsyncClient, asin: str):
+    try:
+
+        resp = await audible_client.get(f"/1.0/library/{asin}", params={"response_groups": LIBRARY_RESPONSE_GROUPS, "image_sizes": IMAGE_SIZES})
+        return _make_book_data(resp['item'])
 
     except NotFoundError:
         return await get_non_owned_book_data(audible_client, asin)
     except Exception as e:
         _logger.error(f'Failed to get owned book data: {e}')
 
-async def metadata_downloader(in_queue: asyncio.Queue, out_queue: asyncio.Queue, audible_client: audible.AsyncClient):
-    while True:
-        cur = await in_queue.get()
+class Stage:
+    """
+    A pipeline stage running a fixed number of workers that process the items put into the stage.
+
+    Exceptions while processing an item are logged and the item is dropped, so one failing book
+    doesn't stop the stage. close() waits for all queued items and then stops the workers.
+    """
+    def __init__(self, name: str, workers: int, process: Callable[[ProcessingBook], Awaitable[None]], queue: asyncio.Queue | None = None):
+        self.name = name
+        self.process = process
+        self.queue = queue if queue is not None else asyncio.Queue(maxsize=workers)
+        self.busy = 0
+        self.tasks = [asyncio.create_task(self._worker()) for _ in range(workers)]
+
+    async def _worker(self):
+        while True:
+            cur: ProcessingBook = await self.queue.get()
+            self.busy += 1
+            try:
+                await self.process(cur)
+            except Exception as e:
+                _logger.error(f'{self.name} failed for {cur.asin}: {e}')
+            finally:
+                self.busy -= 1
+                self.queue.task_done()
 
-        if cur is None:
-            await in_queue.put(None)
-            break
+    async def put(self, cur: ProcessingBook):
+        await self.queue.put(cur)
 
-        cur.book_data = await get_book_data(audible_client, cur.asin)
+    async def close(self):
+        await self.queue.join()
+        await self.cancel()
 
-        await out_queue.put(cur)
+    async def cancel(self):
+        """Stops the workers without waiting for the queued items."""
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
 
-    await out_queue.put(None)
+@dataclass
+class Concurrency:
+    metadata: int = 4
+    download: int = 4
+    decrypt: int = os.cpu_count() or 1
+    # Parallel connections used for a single download
+    download_segments: int = 1
+
+async def license_requester(cur: ProcessingBook, out_stage: Stage, audible_client: audible.AsyncClient):
+    with cur.stats.measure('license'):
+        cur.download_link, cur.decryption_voucher, cur.chapter_info = await get_download_license(audible_client, cur.asin)
+    cur.filename = generate_download_filename(cur.asin, cur.download_link)
+
+    await out_stage.put(cur)
+
+async def metadata_downloader(cur: ProcessingBook, out_stage: Stage, audible_client: audible.AsyncClient, httpx_client: httpx.AsyncClient | None = None, scheduler: RequestScheduler | None = None):
+    # Books from the library listing already come with their metadata
+    if cur.book_data is None:
+        with cur.stats.measure('metadata') as timing:
+            cur.book_data = await get_book_data(audible_client, cur.asin)
+            timing.failed = cur.book_data is None
+    if cur.book_data is None:
+        return
+    cur.stats.title = cur.book_data['title']
+
+    # The cover is fetched once and served from the metadata folder, a missing cover doesn't stop the book
+    if httpx_client is not None and cur.book_data.get('cover_url') and not cover_art.has_cover(folder_settings.METADATA_FOLDER, cur.asin):
+        with cur.stats.measure('cover') as timing:
+            timing.failed = not await cover_art.ensure_cover(httpx_client, scheduler or RequestScheduler(), folder_settings.METADATA_FOLDER, cur.book_data)
+
+    await out_stage.put(cur)
+
+@dataclass
+class DownloadSegment:
+    start: int
+    # Inclusive, like in the Range header
+    end: int
+    downloaded: int = 0
+
+    @property
+    def remaining(self) -> int:
+        return self.end - self.start + 1 - self.downloaded
+
+class SegmentState:
+    """Per segment progress of a segmented download, persisted next to the .part file."""
+    SAVE_INTERVAL = 1.0
+
+    def __init__(self, path: Path, size: int, segments: List[DownloadSegment]):
+        self.path = path
+        self.size = size
+        self.segments = segments
+        self._last_save = 0.0
+
+    @classmethod
+    def load(cls, path: Path, size: int) -> 'SegmentState | None':
+        try:
+            with open(path, 'r') as file:
+                data = json.load(file)
+        except (OSError, ValueError):
+            return None
+        if data.get('size') != size:
+            return None
+        return cls(path, size, [DownloadSegment(**x) for x in data['segments']])
+
+    @classmethod
+    def split(cls, path: Path, size: int, count: int, already_downloaded: int) -> 'SegmentState':
+        """Splits size bytes into count segments, the first already_downloaded bytes are counted as done."""
+        segment_size = max(-(-size // count), Downloader.MIN_SEGMENT_SIZE)
+        segments = list()
+        for start in range(0, size, segment_size):
+            end = min(start + segment_size, size) - 1
+            downloaded = min(max(already_downloaded - start, 0), end - start + 1)
+            segments.append(DownloadSegment(start=start, end=end, downloaded=downloaded))
+        return cls(path, size, segments)
+
+    def save(self, force: bool = False):
+        now = time.monotonic()
+        if not force and now - self._last_save < self.SAVE_INTERVAL:
+            return
+        self._last_save = now
+        tmp_path = self.path.with_suffix(self.path.suffix + '.tmp')
+        with open(tmp_path, 'w') as file:
+            json.dump({'size': self.size, 'segments': [dataclasses.asdict(x) for x in self.segments]}, file)
+        os.replace(tmp_path, self.path)
+
+def _content_range_start(response: httpx.Response) -> int | None:
+    """Returns the first byte of a Content-Range header like bytes 100-199/1000."""
+    match = re.fullmatch(r'bytes (\d+)-\d+/(\d+|\*)', response.headers.get("Content-Range", "").strip())
+    return int(match.group(1)) if match else None
 
 class Downloader:
-    def __init__(self, client: httpx.AsyncClient, url: str, dest_folder: str, file_name: str):
+    CHUNK_SIZE = 1024 * 1024
+    MIN_SEGMENT_SIZE = 16 * 1024 * 1024
+
+    def __init__(self, client: httpx.AsyncClient, url: str, dest_folder: str, file_name: str, segments: int = 1, scheduler: RequestScheduler | None = None, progress: TransferProgress | None = None, bandwidth: BandwidthLimiter | None = None):
         self.client = client
         self.url = url
         self.dest_folder = dest_folder
         self.file_name = file_name
+        self.segments = segments
+        self.scheduler = scheduler or RequestScheduler()
+        self.progress = progress or TransferProgress()
+        self.bandwidth = bandwidth or BandwidthLimiter()
+        self.host = httpx.URL(url).host
         self.ensure_directory_exists()
 
     def ensure_directory_exists(self):
@@ -137,8 +298,7 @@ class Downloader:
         """Checks if the completed file exists and matches the expected size using a HEAD request."""
         if dest_path.exists():
             try:
-                response = await self.client.head(self.url, follow_redirects=True)
-                response.raise_for_status()
+                response = await self.head()
 
                 content_length = int(response.headers.get("Content-Length", 0))
                 if dest_path.stat().st_size == content_length:
@@ -148,131 +308,443 @@ class Downloader:
                 _logger.error(f"Failed to validate existing file: {e}")
         return False
 
-    async def download(self):
-        """Downloads the file from the given URL to the destination folder, with resume capability and chunked writing for large files."""
+    async def head(self) -> httpx.Response:
+        async def request():
+            response = await self.client.head(self.url, follow_redirects=True)
+            response.raise_for_status()
+            return response
+
+        return await self.scheduler.call(self.host, request)
+
+    async def ranged_content_length(self) -> int | None:
+        """Returns the Content-Length from a HEAD request, if the server supports range requests."""
+        response = await self.head()
+
+        if response.headers.get("Accept-Ranges", "").lower() != "bytes" or "Content-Length" not in response.headers:
+            return None
+        return int(response.headers["Content-Length"])
+
+    async def download(self) -> bool:
+        """Downloads the file from the given URL to the destination folder, with resume capability and chunked writing for large files. Returns True once the file is complete."""
         try:
             dest_path = Path(self.dest_folder) / self.file_name
             temp_path = dest_path.with_suffix(dest_path.suffix + ".part")
+            state_path = dest_path.with_suffix(dest_path.suffix + ".segments")
 
             # Check if the completed file already exists and is valid
             if await self.file_already_downloaded(dest_path):
-                return
-
-            # Check if the file already exists and get its size
-            existing_file_size = temp_path.stat().st_size if temp_path.exists() else 0
-
-            # Set headers to resume download if the file partially exists
-            headers = {"Range": f"bytes={existing_file_size}-"} if existing_file_size > 0 else {}
-
-            # Perform the request
-            async with self.client.stream("GET", self.url, headers=headers, follow_redirects=True) as response:
-                response.raise_for_status()
+                return True
+
+            # An interrupted segmented download has to be finished segmented, the .part file is preallocated
+            if self.segments > 1 or state_path.exists():
+                content_length = await self.ranged_content_length()
+                if content_length is not None:
+                    await self.download_segmented(temp_path, state_path, content_length)
+                    temp_path.rename(dest_path)
+                    state_path.unlink()
+                    _logger.debug(f"Downloaded: {self.url} to {dest_path}")
+                    return True
+                state_path.unlink(missing_ok=True)
+                if temp_path.exists():
+                    temp_path.unlink()
 
-                # Append to the temp file if resuming, otherwise write a new temp file
-                with open(temp_path, "ab" if existing_file_size > 0 else "wb") as file:
-                    async for chunk in response.aiter_bytes(chunk_size=1024 * 1024):  # 1MB chunks
-                        file.write(chunk)
+            # Interrupted attempts are retried, each one resumes from the size of the temp file
+            await self.scheduler.call(self.host, lambda: self.download_single(temp_path))
 
             # Rename temp file to final file name upon completion
             temp_path.rename(dest_path)
 
             _logger.debug(f"Downloaded: {self.url} to {dest_path}")
+            return True
         except Exception as e:
             _logger.error(f"Failed to download {self.url}: {e}")
+            return False
+
+    async def download_single(self, temp_path: Path):
+        # Check if the file already exists and get its size
+        existing_file_size = temp_path.stat().st_size if temp_path.exists() else 0
+
+        # Set headers to resume download if the file partially exists
+        headers = {"Range": f"bytes={existing_file_size}-"} if existing_file_size > 0 else {}
+
+        # Perform the request
+        async with self.client.stream("GET", self.url, headers=headers, follow_redirects=True) as response:
+            response.raise_for_status()
+            if existing_file_size > 0 and (response.status_code != 206 or _content_range_start(response) != existing_file_size):
+                if response.status_code != 200:
+                    # A part from another offset can't be appended, the retry starts over
+                    temp_path.unlink()
+                    raise httpx.RemoteProtocolError(f"Server sent {response.headers.get('Content-Range')} instead of bytes {existing_file_size}-")
+                # A server that ignores the range sends the whole file
+                _logger.debug(f"Server ignored the range request, restarting the download of {self.url}")
+                existing_file_size = 0
+            content_length = response.headers.get("Content-Length")
+            self.progress.start(existing_file_size + int(content_length) if content_length else None, existing_file_size)
+
+            # Append to the temp file if resuming, otherwise write a new temp file
+            with open(temp_path, "ab" if existing_file_size > 0 else "wb") as file:
+                async for chunk in response.aiter_bytes(chunk_size=self.CHUNK_SIZE):
+                    file.write(chunk)
+                    self.progress.add(len(chunk))
+                    await self.bandwidth.consume(len(chunk))
+
+    async def download_segmented(self, temp_path: Path, state_path: Path, content_length: int):
+        """Downloads byte ranges of the file in parallel, each written at its offset of the preallocated temp file."""
+        state = SegmentState.load(state_path, content_length) if temp_path.exists() else None
+        if state is None:
+            if state_path.exists():
+                # The preallocated .part of a segmented download that can't be resumed has holes, it starts over
+                temp_path.unlink(missing_ok=True)
+                already_downloaded = 0
+            else:
+                # A .part file left by a single connection download is a valid prefix
+                already_downloaded = temp_path.stat().st_size if temp_path.exists() else 0
+            state = SegmentState.split(state_path, content_length, self.segments, min(already_downloaded, content_length))
+            # Saved before preallocating, so a .part with holes never exists without its state
+            state.save(force=True)
+            with open(temp_path, "ab") as file:
+                file.truncate(content_length)
+        self.progress.start(content_length, sum(x.end - x.start + 1 - x.remaining for x in state.segments))
+
+        fd = os.open(temp_path, os.O_WRONLY)
+        try:
+            async with asyncio.TaskGroup() as task_group:
+                for segment in state.segments:
+                    if segment.remaining > 0:
+                        task_group.create_task(self.scheduler.call(self.host, functools.partial(self.download_segment, fd, segment, state)))
+        except ExceptionGroup as e:
+            # The other segments keep their progress, report the first failure
+            raise e.exceptions[0]
+        finally:
+            os.close(fd)
+            state.save(force=True)
+
+    async def download_segment(self, fd: int, segment: DownloadSegment, state: SegmentState):
+        offset = segment.start + segment.downloaded
+        headers = {"Range": f"bytes={offset}-{segment.end}"}
+
+        async with self.client.stream("GET", self.url, headers=headers, follow_redirects=True) as response:
+            response.raise_for_status()
+            if response.status_code != 206:
+                raise RuntimeError(f"Server ignored the range request for bytes {offset}-{segment.end}")
+            if _content_range_start(response) != offset:
+                raise RuntimeError(f"Server sent {response.headers.get('Content-Range')} instead of bytes {offset}-{segment.end}")
+
+            async for chunk in response.aiter_bytes(chunk_size=self.CHUNK_SIZE):
+                chunk = chunk[:segment.remaining]
+                os.pwrite(fd, chunk, offset)
+                offset += len(chunk)
+                segment.downloaded += len(chunk)
+                self.progress.add(len(chunk))
+                state.save()
+                await self.bandwidth.consume(len(chunk))
+
+        if segment.remaining > 0:
+            raise httpx.RemoteProtocolError(f"Connection closed before bytes {offset}-{segment.end} were received")
+
+async def book_downloader(cur: ProcessingBook, out_stage: Stage, httpx_client: httpx.AsyncClient, segments: int, sync_state: SyncState, scheduler: RequestScheduler, stream_decrypt: bool, bandwidth: BandwidthLimiter):
+    _logger.info(f'Downloading "{cur.book_data["title"]}"')
+    progress = cur.stats.transfer()
+    if stream_decrypt:
+        with cur.stats.measure('stream_decrypt') as timing:
+            try:
+                decrypted = await stream_download_and_decrypt(cur, httpx_client, scheduler, bandwidth)
+            finally:
+                progress.finished = True
+                timing.bytes = progress.transferred
+        if decrypted:
+            await _finish_book(cur, sync_state)
+            return
+        # The file was spooled to the download folder instead and is decrypted as usual
+        sync_state.mark(cur.asin, downloaded=True)
+        await out_stage.put(cur)
+        return
 
-async def book_downloader(in_queue: asyncio.Queue, out_queue: asyncio.Queue):
-    httpx_client = httpx.AsyncClient(headers= {"User-Agent": "Audible/671 CFNetwork/1240.0.4 Darwin/20.6.0"})
-
-    while True:
-        cur: ProcessingBook = await in_queue.get()
-        if cur is None:
-            await in_queue.put(None)
-            break
-
-        _logger.info(f'Downloading "{cur.book_data["title"]}"')
-        downloader = Downloader(httpx_client, cur.download_link, folder_settings.DOWNLOAD_FOLDER, cur.filename)
-        await downloader.download()
-
-        await out_queue.put(cur)
-
-    await httpx_client.aclose()
-    await out_queue.put(None)
-
-async def book_converter(in_queue: asyncio.Queue):
-    while True:
-        cur: ProcessingBook = await in_queue.get()
-        if cur is None:
-            await in_queue.put(None)
-            break
-
-        tmp_filename = f'{folder_settings.AUDIO_FOLDER}/{cur.filename[:-4]}.m4a'
-        final_filename = f'{folder_settings.AUDIO_FOLDER}/{cur.filename[:-4]}.m4b'
-
-        args = [
-            '-y',
-            '-audible_key', cur.decryption_voucher['key'],
-            '-audible_iv', cur.decryption_voucher['iv'],
-            '-i', f'{folder_settings.DOWNLOAD_FOLDER}/{cur.filename}',
-            '-c', 'copy',
-            tmp_filename
-        ]
-
-        _logger.debug(f'Running ffmpeg with args: {" ".join(args)}')
-        proc = await asyncio.create_subprocess_exec(
-            'ffmpeg', *args,
-            stdout=asyncio.subprocess.DEVNULL,
-            stderr=asyncio.subprocess.DEVNULL
-        )
-
-        await proc.wait()
+    downloader = Downloader(httpx_client, cur.download_link, folder_settings.DOWNLOAD_FOLDER, cur.filename, segments, scheduler, progress, bandwidth)
+    with cur.stats.measure('download') as timing:
+        timing.failed = not await downloader.download()
+        progress.finished = True
+        timing.bytes = progress.transferred
+    if timing.failed:
+        return
+    sync_state.mark(cur.asin, downloaded=True)
 
-        if proc.returncode != 0:
-            _logger.error(f"Something went wrong trying to convert {cur.filename}")
-            continue
+    await out_stage.put(cur)
 
-        os.remove(f'{folder_settings.DOWNLOAD_FOLDER}/{cur.filename}')
-        os.rename(tmp_filename, final_filename)
+def _tmp_audio_filename(cur: ProcessingBook) -> str:
+    return f'{folder_settings.AUDIO_FOLDER}/{cur.filename[:-4]}.m4a'
 
-        with open(f'{folder_settings.METADATA_FOLDER}/{cur.asin}.json', 'w') as file:
-            file.write(json.dumps({'product': cur.book_data}))
+async def _probe_audio_file(filename: str) -> bool:
+    """Probes an audio file and stores the sidecar, a failure is only logged. Returns if the probe succeeded."""
+    stat = os.stat(f'{folder_settings.AUDIO_FOLDER}/{filename}')
+    audio_file = AudioFile(filename=filename, size=stat.st_size, mtime_ns=stat.st_mtime_ns)
+    try:
+        await probe_and_store(folder_settings.AUDIO_FOLDER, audio_file)
+    except Exception as e:
+        # The feeds work without duration and chapters, the probe command can fill them in later
+        _logger.warning(f'Probing {filename} failed: {e}')
+        return False
+    return True
+
+async def _finish_book(cur: ProcessingBook, sync_state: SyncState):
+    """Moves the decrypted file into place, probes it and writes the metadata, which makes the book visible to the feeds."""
+    filename = f'{cur.filename[:-4]}.m4b'
+    os.rename(_tmp_audio_filename(cur), f'{folder_settings.AUDIO_FOLDER}/{filename}')
+    with cur.stats.measure('probe') as timing:
+        timing.failed = not await _probe_audio_file(filename)
+
+    with cur.stats.measure('metadata_write'):
+        get_metadata_store().write(cur.book_data)
+    sync_state.mark(cur.asin, downloaded=True, decrypted=True, metadata=True)
+
+# Limit for the boxes before moov or mdat that are buffered while deciding if a download can be streamed
+STREAM_PROBE_LIMIT = 16 * 1024 * 1024
+
+def _flatten_chapters(chapters: list) -> list:
+    flat = list()
+    for chapter in chapters:
+        flat.append(chapter)
+        flat.extend(_flatten_chapters(chapter.get('chapters', [])))
+    return flat
+
+def _write_ffmetadata_chapters(chapter_info: dict, path: str):
+    def escape(value: str) -> str:
+        for c in '\\=;#\n':
+            value = value.replace(c, '\\' + c)
+        return value
+
+    with open(path, 'w') as file:
+        file.write(';FFMETADATA1\n')
+        for chapter in _flatten_chapters(chapter_info.get('chapters', [])):
+            file.write('[CHAPTER]\nTIMEBASE=1/1000\n')
+            file.write(f'START={chapter["start_offset_ms"]}\n')
+            file.write(f'END={chapter["start_offset_ms"] + chapter["length_ms"]}\n')
+            file.write(f'title={escape(chapter["title"])}\n')
+
+async def _pipe_to_ffmpeg(cur: ProcessingBook, head: bytes, chunks: AsyncIterator[bytes]):
+    args = [
+        '-y',
+        '-audible_key', cur.decryption_voucher['key'],
+        '-audible_iv', cur.decryption_voucher['iv'],
+        '-i', 'pipe:0',
+    ]
+
+    # ffmpeg can't seek in a pipe to read the chapter track, so the chapters come from the license instead
+    chapters_filename = f'{folder_settings.DOWNLOAD_FOLDER}/{cur.filename[:-4]}.chapters.txt'
+    has_chapters = cur.chapter_info is not None and len(cur.chapter_info.get('chapters', [])) > 0
+    if has_chapters:
+        Path(folder_settings.DOWNLOAD_FOLDER).mkdir(parents=True, exist_ok=True)
+        _write_ffmetadata_chapters(cur.chapter_info, chapters_filename)
+        args += ['-i', chapters_filename, '-map', '0:a', '-map_metadata', '0', '-map_chapters', '1']
+
+    args += ['-c', 'copy', _tmp_audio_filename(cur)]
+
+    _logger.debug(f'Running ffmpeg with args: {" ".join(args)}')
+    proc = await asyncio.create_subprocess_exec(
+        'ffmpeg', *args,
+        stdin=asyncio.subprocess.PIPE,
+        stdout=asyncio.subprocess.DEVNULL,
+        stderr=asyncio.subprocess.DEVNULL
+    )
 
-async def metadata_writer(in_queue: asyncio.Queue):
-    while True:
-        cur: ProcessingBook = await in_queue.get()
-        if cur is None:
-            await in_queue.put(None)
-            break
+    try:
+        try:
+            proc.stdin.write(head)
+            await proc.stdin.drain()
+            async for chunk in chunks:
+                proc.stdin.write(chunk)
+                await proc.stdin.drain()
+            proc.stdin.close()
+        except (BrokenPipeError, ConnectionResetError):
+            # ffmpeg exited early, the return code tells why
+            pass
+        await proc.wait()
+    except BaseException:
+        proc.kill()
+        await proc.wait()
+        raise
+    finally:
+        if has_chapters:
+            os.remove(chapters_filename)
+
+    if proc.returncode != 0:
+        raise RuntimeError(f'ffmpeg failed to decrypt the stream of {cur.filename}')
+
+async def _spool_to_download_folder(cur: ProcessingBook, head: bytes, chunks: AsyncIterator[bytes]):
+    Path(folder_settings.DOWNLOAD_FOLDER).mkdir(parents=True, exist_ok=True)
+    dest_path = Path(folder_settings.DOWNLOAD_FOLDER) / cur.filename
+    temp_path = dest_path.with_suffix(dest_path.suffix + ".part")
+
+    with open(temp_path, 'wb') as file:
+        file.write(head)
+        async for chunk in chunks:
+            file.write(chunk)
+
+    temp_path.rename(dest_path)
+
+async def stream_download_and_decrypt(cur: ProcessingBook, httpx_client: httpx.AsyncClient, scheduler: RequestScheduler, bandwidth: BandwidthLimiter | None = None) -> bool:
+    """
+    Feeds the download directly into ffmpeg, so only the decrypted file is written to disk.
+
+    That only works if the moov box comes before the audio data, otherwise ffmpeg would need to seek. In that
+    case the download is spooled to the download folder instead. Returns True if the book was decrypted.
+    """
+    progress = cur.stats.download or cur.stats.transfer()
+    bandwidth = bandwidth or BandwidthLimiter()
+
+    async def counted(chunks: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+        async for chunk in chunks:
+            progress.add(len(chunk))
+            await bandwidth.consume(len(chunk))
+            yield chunk
+
+    async def attempt() -> bool:
+        async with httpx_client.stream("GET", cur.download_link, follow_redirects=True) as response:
+            response.raise_for_status()
+            content_length = response.headers.get("Content-Length")
+            progress.start(int(content_length) if content_length else None, 0)
+            chunks = counted(response.aiter_bytes(chunk_size=Downloader.CHUNK_SIZE))
+
+            head = b''
+            first_box = None
+            async for chunk in chunks:
+                head += chunk
+                first_box = mp4.first_top_level_box(head, ('moov', 'mdat'))
+                if first_box is not None or len(head) > STREAM_PROBE_LIMIT:
+                    break
+
+            if first_box == 'moov':
+                await _pipe_to_ffmpeg(cur, head, chunks)
+                return True
+
+            _logger.info(f'Audio data of {cur.filename} comes before its metadata, spooling it to disk')
+            await _spool_to_download_folder(cur, head, chunks)
+            return False
+
+    return await scheduler.call(httpx.URL(cur.download_link).host, attempt)
+
+async def book_converter(cur: ProcessingBook, sync_state: SyncState, executor: Executor | None):
+    tmp_filename = _tmp_audio_filename(cur)
+    source_filename = f'{folder_settings.DOWNLOAD_FOLDER}/{cur.filename}'
+
+    with cur.stats.measure('decrypt') as timing:
+        timing.bytes = os.path.getsize(source_filename)
+        timing.failed = not await _decrypt(cur, source_filename, tmp_filename, executor)
+    if timing.failed:
+        return
 
-        with open(f'{folder_settings.METADATA_FOLDER}/{cur.asin}.json', 'w') as file:
-            file.write(json.dumps({'product': cur.book_data}))
+    os.remove(source_filename)
+    await _finish_book(cur, sync_state)
 
-async def owned_books_asins(audible_client: audible.AsyncClient):
-    page = 1
+async def _decrypt(cur: ProcessingBook, source_filename: str, tmp_filename: str, executor: Executor | None) -> bool:
+    if executor is not None:
+        try:
+            await asyncio.get_running_loop().run_in_executor(
+                executor, aax_decrypter.decrypt_file,
+                source_filename, tmp_filename, cur.decryption_voucher['key'], cur.decryption_voucher['iv']
+            )
+        except aax_decrypter.UnsupportedFile as e:
+            _logger.info(f'Decrypting {cur.filename} with ffmpeg instead: {e}')
+        else:
+            return True
+
+    args = [
+        '-y',
+        '-audible_key', cur.decryption_voucher['key'],
+        '-audible_iv', cur.decryption_voucher['iv'],
+        '-i', source_filename,
+        '-c', 'copy',
+        tmp_filename
+    ]
+
+    _logger.debug(f'Running ffmpeg with args: {" ".join(args)}')
+    proc = await asyncio.create_subprocess_exec(
+        'ffmpeg', *args,
+        stdout=asyncio.subprocess.DEVNULL,
+        stderr=asyncio.subprocess.DEVNULL
+    )
+
+    await proc.wait()
+
+    if proc.returncode != 0:
+        _logger.error(f"Something went wrong trying to convert {cur.filename}")
+        return False
+    return True
+
+async def metadata_writer(cur: ProcessingBook, counts: collections.Counter):
+    counts['updated' if write_if_changed(get_metadata_store(), cur.book_data) else 'unchanged'] += 1
+
+LIBRARY_PAGE_SIZE = 100
+
+async def _get_library_page(audible_client: audible.AsyncClient, page: int, sort_by: str) -> tuple[list, int | None]:
+    """Returns the items of a library page and the total number of items in the library, if the api sent it."""
+    def parse_response(resp: httpx.Response):
+        raise_for_status(resp)
+        total_count = resp.headers.get('Total-Count')
+        return convert_response_content(resp)['items'], int(total_count) if total_count else None
+
+    return await audible_client.get('1.0/library', params={
+        'num_results': LIBRARY_PAGE_SIZE,
+        'sort_by': sort_by,
+        'page': page,
+        'response_groups': LIBRARY_RESPONSE_GROUPS,
+        'image_sizes': IMAGE_SIZES,
+    }, response_callback=parse_response)
+
+async def owned_books(audible_client: audible.AsyncClient, concurrency: int, sort_by: str = 'PurchaseDate'):
+    """
+    Yields the library items including the metadata response groups.
+
+    Once the first page tells the total number of items, the remaining pages are fetched concurrently.
+    With a concurrency of 1 the pages are only requested as the items are consumed.
+    """
+    items, total_count = await _get_library_page(audible_client, 1, sort_by)
+    for item in items:
+        yield item
+
+    if total_count is None or concurrency <= 1:
+        page = 2
+        while len(items) > 0 and (total_count is None or (page - 1) * LIBRARY_PAGE_SIZE < total_count):
+            items, _ = await _get_library_page(audible_client, page, sort_by)
+            page += 1
+            for item in items:
+                yield item
+        return
 
-    while True:
-        resp = await audible_client.get('1.0/library', params={'num_results': 100, 'sort_by': 'PurchaseDate', 'page': page})
-        page += 1
+    semaphore = asyncio.Semaphore(concurrency)
 
-        for item in resp['items']:
-            yield item['asin']
+    async def get_page(page: int):
+        async with semaphore:
+            return await _get_library_page(audible_client, page, sort_by)
 
-        if len(resp['items']) == 0:
-            break
+    last_page = -(-total_count // LIBRARY_PAGE_SIZE)
+    pages = [asyncio.create_task(get_page(page)) for page in range(2, last_page + 1)]
+    try:
+        for page in pages:
+            items, _ = await page
+            for item in items:
+                yield item
+    finally:
+        for page in pages:
+            page.cancel()
+
+def _book_from_library_item(item: dict) -> ProcessingBook:
+    try:
+        book_data = _make_book_data(item)
+    except KeyError:
+        # Incomplete items get their metadata from the per book request, with the catalog fallback
+        book_data = None
+    return ProcessingBook(asin=item['asin'], book_data=book_data, purchase_date=item.get('purchase_date'))
 
 async def get_download_license(audible_client: audible.AsyncClient, asin: str):
     resp = await audible_client.post(f"/1.0/content/{asin}/licenserequest",
-                       body={"quality": "High", "consumption_type": "Download", "drm_type": "Adrm"})
+                       body={"quality": "High", "consumption_type": "Download", "drm_type": "Adrm", "response_groups": "chapter_info"})
 
     dlr = decrypt_voucher_from_licenserequest(audible_client.auth, resp)
     download_link = resp['content_license']['content_metadata']['content_url']['offline_url']
+    chapter_info = resp['content_license']['content_metadata'].get('chapter_info')
 
-    return download_link, dlr
-
-def _find_m4b_file(book_asin: str, filelist: List):
-    try:
-        return [x for x in filelist if re.fullmatch(rf".*_?{book_asin}_.*\.m4b", x)][0]
-    except IndexError:
-        return None
+    return download_link, dlr, chapter_info
 
 def generate_download_filename(asin: str, download_link: str):
     url = urllib.parse.urlparse(download_link)
@@ -280,87 +752,481 @@ def generate_download_filename(asin: str, download_link: str):
 
     return asin + '_' + match.group(0).upper() + '.aax'
 
-async def download_books_and_metadata(audible_client: audible.AsyncClient):
-    existing_metadata = get_set_of_asins()
-    filelist = os.listdir(folder_settings.AUDIO_FOLDER)
-
-    metadata_input_queue = asyncio.Queue(maxsize=1)
-    downloader_input_queue = asyncio.Queue(maxsize=1)
-    ffmpeg_input_queue = asyncio.Queue(maxsize=1)
-
-    metadata = asyncio.create_task(metadata_downloader(metadata_input_queue, downloader_input_queue, audible_client))
-    downloader = asyncio.create_task(book_downloader(downloader_input_queue, ffmpeg_input_queue))
-    converter = asyncio.create_task(book_converter(ffmpeg_input_queue))
-
-    async for asin in owned_books_asins(audible_client):
-        _logger.debug(f'Checking {asin}')
-        if asin not in existing_metadata or not _find_m4b_file(asin, filelist):
-            url, dlr = await get_download_license(audible_client, asin)
-            filename = generate_download_filename(asin, url)
-            await metadata_input_queue.put(ProcessingBook(asin=asin, download_link=url, decryption_voucher=dlr, filename=filename))
-
-    await metadata_input_queue.put(None)
-    await metadata
-    await downloader
-    await converter
+# Licensed books that wait for a download worker and are ordered by priority
+PRIORITY_LOOKAHEAD = 50
+
+DOWNLOAD_HEADERS = {"User-Agent": "Audible/671 CFNetwork/1240.0.4 Darwin/20.6.0"}
+
+def _create_decrypt_executor(concurrency: Concurrency, native_decrypt: bool) -> Executor | None:
+    # The native decrypter is cpu bound python, it needs processes to use more than one core
+    if native_decrypt and aax_decrypter.is_available():
+        return ProcessPoolExecutor(concurrency.decrypt, mp_context=multiprocessing.get_context('spawn'))
+    return None
+
+async def download_books_and_metadata(audible_client: audible.AsyncClient, concurrency: Concurrency = Concurrency(), sync_state_path: str | None = None, full_sync: bool = False, scheduler: RequestScheduler | None = None, stream_decrypt: bool = False, native_decrypt: bool = True, report_path: str | None = None, split_chapters: bool = False, sync_state: SyncState | None = None, httpx_client: httpx.AsyncClient | None = None, decrypt_executor: Executor | None = None, priority: Sequence[str] = ('newest',), bandwidth: BandwidthLimiter | None = None, account: str | None = None, claimed: Set[str] | None = None) -> SyncState:
+    """
+    Downloads, decrypts and stores the metadata of all books that aren't synced yet.
+
+    With a complete sync state from a previous run, the library is paged newest first and the walk stops at
+    the first book that is already synced or was purchased before the newest purchase of the previous run. Otherwise, or with full_sync, the whole library is checked against
+    the metadata store and audio folder. The stage timings of every book are written to report_path as json.
+    With split_chapters, the books are split into one file per chapter afterwards.
+
+    Licensed books wait for a download worker in the order of the priority policies of download_scheduler,
+    bandwidth caps the combined rate of the downloads.
+
+    A sync state, http client and decrypt executor that are passed in are reused instead of loaded or created,
+    and left open. Returns the sync state for the next run.
+
+    The asins of the library of a named account are recorded for its feeds. Books in claimed are skipped, the
+    processed ones are added, so concurrent runs for other accounts don't download them twice.
+    """
+    if sync_state is None and sync_state_path:
+        sync_state = SyncState.load(sync_state_path)
+    incremental = sync_state is not None and not sync_state.has_incomplete() and not full_sync
+
+    if incremental:
+        _logger.debug(f'Incremental sync, last purchase {sync_state.last_asin} at {sync_state.last_purchase_date}')
+    else:
+        existing_metadata = get_set_of_asins()
+        audio_files = scan_audio_folder(folder_settings.AUDIO_FOLDER)
+        if sync_state is None:
+            sync_state = SyncState.bootstrap(sync_state_path, existing_metadata, audio_files.keys())
+
+    progress = dict()
+    if 'series' in priority:
+        store = get_metadata_store()
+        store.refresh()
+        progress = download_scheduler.series_progress(store.grouped_products()[1])
+
+    own_httpx_client = httpx_client is None
+    if own_httpx_client:
+        httpx_client = httpx.AsyncClient(headers=DOWNLOAD_HEADERS)
+    own_decrypt_executor = decrypt_executor is None
+    if own_decrypt_executor:
+        decrypt_executor = _create_decrypt_executor(concurrency, native_decrypt)
+
+    scheduler = scheduler or RequestScheduler()
+
+    # Stages are created back to front, each one needs the stage it hands its books to
+    converter = Stage('Decrypting', concurrency.decrypt, functools.partial(book_converter, sync_state=sync_state, executor=decrypt_executor))
+    downloader = Stage('Downloading', concurrency.download, functools.partial(book_downloader, out_stage=converter, httpx_client=httpx_client, segments=concurrency.download_segments, sync_state=sync_state, scheduler=scheduler, stream_decrypt=stream_decrypt, bandwidth=bandwidth or BandwidthLimiter()), PriorityQueue(priority, progress, PRIORITY_LOOKAHEAD))
+    metadata = Stage('Fetching metadata', concurrency.metadata, functools.partial(metadata_downloader, out_stage=downloader, audible_client=audible_client, httpx_client=httpx_client, scheduler=scheduler))
+    licenses = Stage('Requesting license', concurrency.metadata, functools.partial(license_requester, out_stage=metadata, audible_client=audible_client))
+
+    stages = (licenses, metadata, downloader, converter)
+    stats = PipelineStats()
+    stats.watch(stages)
+
+    if incremental:
+        library = owned_books(audible_client, 1, sort_by='-PurchaseDate')
+    else:
+        # The lookahead only reorders nearby books, newest first has to page that way too
+        library = owned_books(audible_client, concurrency.metadata, sort_by='-PurchaseDate' if list(priority[:1]) == ['newest'] else 'PurchaseDate')
+
+    seen = set()
+    queued = list()
+    drained = False
+    # Everything purchased before this was seen by an earlier walk
+    resume_after = sync_state.last_purchase_date
+    try:
+        async for item in library:
+            asin = item['asin']
+            _logger.debug(f'Checking {asin}')
+            seen.add(asin)
+            sync_state.saw_purchase(item)
+            if incremental:
+                if sync_state.is_complete(asin):
+                    _logger.debug(f'{asin} is already synced, stopping')
+                    break
+                purchase_date = item.get('purchase_date')
+                if resume_after is not None and purchase_date is not None and purchase_date < resume_after:
+                    _logger.debug(f'{asin} was purchased before the last run, stopping')
+                    break
+            elif asin in existing_metadata and asin in audio_files:
+                # A state left incomplete by an interrupted run would otherwise never become complete
+                if not sync_state.is_complete(asin):
+                    sync_state.mark(asin, metadata=True, downloaded=True, decrypted=True)
+                continue
+            if not full_sync and not sync_state.retry_due(asin):
+                _logger.debug(f'{asin} failed recently, retrying it later')
+                continue
+            if claimed is not None:
+                if asin in claimed:
+                    _logger.debug(f'{asin} is synced by another account')
+                    continue
+                claimed.add(asin)
+
+            sync_state.status(asin)
+            cur = _book_from_library_item(item)
+            stats.track(asin, cur.stats)
+            queued.append(asin)
+            await licenses.put(cur)
+        await library.aclose()
+
+        for stage in stages:
+            await stage.close()
+        drained = True
+
+        # Books that failed somewhere in the pipeline stay incomplete and make the next due run check everything
+        for asin in queued:
+            if not sync_state.is_complete(asin):
+                sync_state.failed(asin)
+    finally:
+        # A failed or cancelled run stops the workers instead of draining the queues, so nothing keeps running after it
+        if not drained:
+            for stage in stages:
+                await stage.cancel()
+            await library.aclose()
+        await stats.stop()
+        sync_state.save()
+        if own_decrypt_executor and decrypt_executor is not None:
+            # Waiting for a decrypt that is still running would block the event loop
+            decrypt_executor.shutdown(wait=drained, cancel_futures=True)
+        if own_httpx_client:
+            await httpx_client.aclose()
+
+    if account is not None:
+        # An incremental walk only saw the newest purchases
+        if incremental:
+            seen |= accounts.read_account_library(folder_settings.METADATA_FOLDER, account)
+        accounts.write_account_library(folder_settings.METADATA_FOLDER, account, seen)
+
+    stats.log_summary()
+    if report_path is not None:
+        stats.write_report(report_path)
+
+    if split_chapters:
+        await split_audio_files(concurrency)
     _logger.debug("Done Processing Books")
+    return sync_state
+
+async def _gather_accounts(*coros):
+    """Runs the coroutines of the accounts until all are done, then raises the first error. One failed account doesn't stop the others."""
+    results = await asyncio.gather(*coros, return_exceptions=True)
+    for result in results:
+        if isinstance(result, BaseException):
+            raise result
+    return results
+
+async def download_accounts(audible_clients: Dict[str | None, audible.AsyncClient], concurrency: Concurrency = Concurrency(), sync_state_path: str | None = None, full_sync: bool = False, native_decrypt: bool = True, report_path: str | None = None, split_chapters: bool = False, sync_state: SyncState | None = None, httpx_client: httpx.AsyncClient | None = None, decrypt_executor: Executor | None = None, **download_options) -> SyncState:
+    """
+    Syncs the libraries of all accounts concurrently into the same folders, see download_books_and_metadata.
+
+    The accounts share the sync state, the http connections, the decrypt processes and the bandwidth limit. A
+    book in more than one library is only downloaded by the account that gets to it first. With more than one
+    account, the report of every account is written next to report_path with the account name added.
+    """
+    if sync_state is None and sync_state_path:
+        sync_state = SyncState.load(sync_state_path)
+    if sync_state is None:
+        # A new state has no incomplete books, the first run still has to check everything
+        sync_state = SyncState.bootstrap(sync_state_path, get_set_of_asins(), scan_audio_folder(folder_settings.AUDIO_FOLDER).keys())
+        full_sync = True
+
+    own_httpx_client = httpx_client is None
+    if own_httpx_client:
+        httpx_client = httpx.AsyncClient(headers=DOWNLOAD_HEADERS)
+    own_decrypt_executor = decrypt_executor is None
+    if own_decrypt_executor:
+        decrypt_executor = _create_decrypt_executor(concurrency, native_decrypt)
+
+    def account_report_path(account: str | None) -> str | None:
+        if report_path is None or len(audible_clients) == 1:
+            return report_path
+        root, ext = os.path.splitext(report_path)
+        return f'{root}.{account}{ext}'
+
+    claimed = set()
+    try:
+        await _gather_accounts(*(
+            download_books_and_metadata(
+                audible_client, concurrency, sync_state_path=sync_state_path, full_sync=full_sync, native_decrypt=native_decrypt,
+                report_path=account_report_path(account), sync_state=sync_state, httpx_client=httpx_client,
+                decrypt_executor=decrypt_executor, account=account, claimed=claimed, **download_options,
+            )
+            for account, audible_client in audible_clients.items()
+        ))
+    finally:
+        if own_decrypt_executor and decrypt_executor is not None:
+            decrypt_executor.shutdown()
+        if own_httpx_client:
+            await httpx_client.aclose()
+
+    if split_chapters:
+        await split_audio_files(concurrency)
+    return sync_state
+
+async def run_daemon(audible_clients: Dict[str | None, audible.AsyncClient], concurrency: Concurrency = Concurrency(), interval: float = 1800.0, jitter: float = 300.0, trigger_socket: str | None = None, sync_state_path: str | None = None, native_decrypt: bool = True, **download_options):
+    """
+    Syncs the libraries right away and then every interval plus up to jitter seconds, until SIGTERM or SIGINT.
+
+    The authenticated client, the http connections, the decrypt processes and the sync state stay alive between
+    runs, so a poll without new purchases is a single library request. SIGUSR1 or a connection to the unix socket
+    trigger_socket starts a sync right away, the socket answers with the result once that sync is done.
+    """
+    loop = asyncio.get_running_loop()
+    wake = asyncio.Event()
+    stop = asyncio.Event()
+    # Socket connections waiting for the result of the next sync
+    waiting: List[asyncio.Future] = list()
+
+    def request_stop():
+        stop.set()
+        wake.set()
+
+    loop.add_signal_handler(signal.SIGUSR1, wake.set)
+    loop.add_signal_handler(signal.SIGTERM, request_stop)
+    loop.add_signal_handler(signal.SIGINT, request_stop)
+
+    async def handle_trigger(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        result = loop.create_future()
+        waiting.append(result)
+        wake.set()
+        try:
+            writer.write(f'{await result}\n'.encode())
+            await writer.drain()
+        finally:
+            writer.close()
+
+    server = None
+    if trigger_socket is not None:
+        if os.path.exists(trigger_socket):
+            os.remove(trigger_socket)
+        server = await asyncio.start_unix_server(handle_trigger, trigger_socket)
+
+    httpx_client = httpx.AsyncClient(headers=DOWNLOAD_HEADERS)
+    decrypt_executor = _create_decrypt_executor(concurrency, native_decrypt)
+    sync_state = None
+    sync = None
+    stopped = asyncio.create_task(stop.wait())
+    try:
+        while not stop.is_set():
+            wake.clear()
+            waiters = waiting[:]
+            waiting.clear()
+
+            sync = asyncio.create_task(download_accounts(
+                audible_clients, concurrency, sync_state_path=sync_state_path, native_decrypt=native_decrypt,
+                sync_state=sync_state, httpx_client=httpx_client, decrypt_executor=decrypt_executor, **download_options,
+            ))
+            await asyncio.wait([sync, stopped], return_when=asyncio.FIRST_COMPLETED)
+            if not sync.done():
+                # Cancelled below, finished books are already marked in the sync state and the next start continues with the rest
+                break
 
-async def update_metadata(audible_client: audible.AsyncClient):
-    existing_metadata = get_set_of_asins()
+            try:
+                sync_state = sync.result()
+                result = 'ok'
+            except Exception:
+                _logger.exception('Sync failed')
+                result = 'failed'
+            for waiter in waiters:
+                if not waiter.done():
+                    waiter.set_result(result)
+
+            delay = interval + random.uniform(0, jitter)
+            _logger.debug(f'Next sync in {delay:.0f}s')
+            try:
+                await asyncio.wait_for(wake.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+    finally:
+        # The shared client and decrypt processes are released only after the pipelines are torn down
+        if sync is not None:
+            sync.cancel()
+            await asyncio.gather(sync, return_exceptions=True)
+        stopped.cancel()
+        for waiter in waiting:
+            if not waiter.done():
+                waiter.set_result('stopped')
+        if server is not None:
+            server.close()
+            os.remove(trigger_socket)
+        if decrypt_executor is not None:
+            decrypt_executor.shutdown()
+        await httpx_client.aclose()
+    _logger.debug('Daemon stopped')
+
+async def audio_file_prober(cur: ProcessingBook):
+    await _probe_audio_file(f'{cur.filename[:-4]}.m4b')
+
+async def probe_audio_files(concurrency: Concurrency = Concurrency()):
+    """Probes every audio file without an up to date probe sidecar."""
+    prober = Stage('Probing', concurrency.decrypt, audio_file_prober)
+
+    for asin, audio_file in scan_audio_folder(folder_settings.AUDIO_FOLDER).items():
+        if read_media_info(folder_settings.AUDIO_FOLDER, audio_file) is None:
+            _logger.info(f'Probing {audio_file.filename}')
+            await prober.put(ProcessingBook(asin=asin, filename=f'{audio_file.filename[:-4]}.aax'))
+
+    await prober.close()
+
+async def split_audio_files(concurrency: Concurrency = Concurrency()):
+    """Splits every audio file with more than one chapter that has no up to date split yet, the chapters of a book are split in parallel."""
+    semaphore = asyncio.Semaphore(concurrency.decrypt)
+    for audio_file in scan_audio_folder(folder_settings.AUDIO_FOLDER).values():
+        media_info = read_media_info(folder_settings.AUDIO_FOLDER, audio_file)
+        if media_info is None or len(media_info.chapters) < 2:
+            continue
+        if chapter_split.read_chapter_files(folder_settings.AUDIO_FOLDER, audio_file) is not None:
+            continue
 
-    metadata_input_queue = asyncio.Queue(maxsize=1)
-    metadata_output_queue = asyncio.Queue(maxsize=1)
+        _logger.info(f'Splitting {audio_file.filename} into {len(media_info.chapters)} chapters')
+        try:
+            await chapter_split.split_book(semaphore, folder_settings.AUDIO_FOLDER, audio_file, media_info)
+        except Exception:
+            _logger.exception(f'Failed to split {audio_file.filename}')
 
-    metadata_in = asyncio.create_task(metadata_downloader(metadata_input_queue, metadata_output_queue, audible_client))
-    metadata_out = asyncio.create_task(metadata_writer(metadata_output_queue))
+async def update_metadata(audible_client: audible.AsyncClient, concurrency: Concurrency = Concurrency()) -> Dict[str, int]:
+    return await update_accounts_metadata({None: audible_client}, concurrency)
 
-    for asin in existing_metadata:
-        _logger.debug(f'Checking {asin}')
-        await metadata_input_queue.put(
-            ProcessingBook(asin=asin, download_link=None, decryption_voucher=None, filename=None))
+async def update_accounts_metadata(audible_clients: Dict[str | None, audible.AsyncClient], concurrency: Concurrency = Concurrency(), scheduler: RequestScheduler | None = None) -> Dict[str, int]:
+    """
+    Refreshes the metadata of every book in the metadata store, only records that changed are written.
+    Covers that are missing are fetched.
 
-    await metadata_input_queue.put(None)
-    await metadata_in
-    await metadata_out
+    The libraries of all accounts are listed concurrently and recorded for the feeds of the named accounts.
+    Returns how many records were unchanged, updated or failed to fetch or write.
+    """
+    existing_metadata = get_set_of_asins()
+    total = len(existing_metadata)
+    counts = collections.Counter()
+
+    httpx_client = httpx.AsyncClient(headers=DOWNLOAD_HEADERS)
+    scheduler = scheduler or RequestScheduler()
+    writer = Stage('Writing metadata', 1, functools.partial(metadata_writer, counts=counts))
+    stages = {
+        account: Stage('Fetching metadata', concurrency.metadata, functools.partial(metadata_downloader, out_stage=writer, audible_client=audible_client, httpx_client=httpx_client, scheduler=scheduler))
+        for account, audible_client in audible_clients.items()
+    }
 
-    _logger.debug("Done Processing Books")
+    async def list_library(account: str | None, audible_client: audible.AsyncClient):
+        seen = set()
+        async for item in owned_books(audible_client, concurrency.metadata):
+            seen.add(item['asin'])
+            # Books in more than one library are fetched by the account that lists them first
+            if item['asin'] in existing_metadata:
+                existing_metadata.remove(item['asin'])
+                await stages[account].put(_book_from_library_item(item))
+        if account is not None:
+            accounts.write_account_library(folder_settings.METADATA_FOLDER, account, seen)
+
+    drained = False
+    try:
+        await _gather_accounts(*(list_library(account, audible_client) for account, audible_client in audible_clients.items()))
+
+        # Books no longer in any library are looked up one by one, falling back to the catalog
+        metadata = next(iter(stages.values()))
+        for asin in existing_metadata:
+            _logger.debug(f'Checking {asin}')
+            await metadata.put(ProcessingBook(asin=asin))
+
+        for stage in (*stages.values(), writer):
+            await stage.close()
+        drained = True
+    finally:
+        if not drained:
+            for stage in (*stages.values(), writer):
+                await stage.cancel()
+        await httpx_client.aclose()
+
+    # Books that failed in a stage were dropped without being counted
+    result = {'unchanged': counts['unchanged'], 'updated': counts['updated'], 'failed': total - counts['unchanged'] - counts['updated']}
+    _logger.info(f'Metadata: {result["updated"]} updated, {result["unchanged"]} unchanged, {result["failed"]} failed')
+    return result
 
 def main():
     parser = argparse.ArgumentParser(description='Audible cli download tool')
     parser.add_argument("--audio-folder", default="audio_files", type=str, help="Path to the audio folder")
     parser.add_argument("--metadata-folder", default="metadata_files", type=str, help="Path to the metadata folder")
     parser.add_argument("--download-folder", default="downloads", type=str, help="Path to the temp download folder")
-    parser.add_argument("--auth-file", default="audible_auth", type=str, help="Path to the auth file")
+    parser.add_argument("--auth-file", default=[], action='append', type=accounts.parse_auth_file, help="Path to the auth file, NAME=PATH names the account for its own feeds. Can be repeated to sync several accounts, then every one needs a name")
+    parser.add_argument("--metadata-backend", default="json", choices=["json", "sqlite"], help="Store metadata as one json file per book or in a SQLite catalog")
+    parser.add_argument("--metadata-catalog", default=None, type=str, help="Path to the SQLite catalog, defaults to catalog.sqlite3 in the metadata folder")
+    parser.add_argument("--metadata-workers", default=Concurrency.metadata, type=int, help="Number of concurrent license and metadata requests")
+    parser.add_argument("--download-workers", default=Concurrency.download, type=int, help="Number of concurrent downloads")
+    parser.add_argument("--decrypt-workers", default=Concurrency.decrypt, type=int, help="Number of concurrent decryptions, defaults to the cpu count")
+    parser.add_argument("--download-segments", default=Concurrency.download_segments, type=int, help="Download each file in this many parallel byte ranges")
+    parser.add_argument("--api-rate", default=5.0, type=float, help="Maximum audible api requests per second, lowered automatically when throttled")
+    parser.add_argument("--max-connections-per-host", default=8, type=int, help="Maximum requests in flight per host")
+    parser.add_argument("--max-retries", default=5, type=int, help="Retries for throttled, failed or interrupted requests")
+    parser.add_argument("--sync-state", default=None, type=str, help="Path to the sync state, defaults to .sync_state in the metadata folder")
     subparsers = parser.add_subparsers(dest='command', required=True)
 
-    parser_download = subparsers.add_parser('download', help='Download books and metadata')
-    parser_metadata = subparsers.add_parser('metadata', help='Update metadata of downloaded books')
+    download_options = argparse.ArgumentParser(add_help=False)
+    download_options.add_argument("--decrypter", choices=['native', 'ffmpeg'], default='native', help="Decrypt in worker processes when the cryptography package is installed, ffmpeg is used for files the native decrypter can't handle")
+    download_options.add_argument("--stream-decrypt", action='store_true', help="Decrypt while downloading instead of storing the encrypted file first, ffmpeg then runs in the download workers")
+    download_options.add_argument("--split-chapters", action='store_true', help="Also split the downloaded books into one file per chapter for the ?chapters=1 feeds")
+    download_options.add_argument("--priority", default=['newest'], type=download_scheduler.parse_priority, help=f"Comma separated order in which licensed books are downloaded, later policies break ties: {', '.join(download_scheduler.PRIORITY_POLICIES)}")
+    download_options.add_argument("--bandwidth-limit", default=[], action='append', type=download_scheduler.parse_bandwidth_window, help="Combined download rate in bytes per second with an optional K, M or G suffix, e.g. 5M, or for a time of day HH:MM-HH:MM=RATE. Can be repeated, the first matching window applies")
+    download_options.add_argument("--report", default=None, type=str, help="Write the per book and per stage timings, transferred bytes and queue depths of the run to this json file")
+
+    parser_download = subparsers.add_parser('download', parents=[download_options], help='Download books and metadata')
+    parser_download.add_argument("--full", action='store_true', help="Check the whole library instead of stopping at the first already synced purchase")
+    parser_daemon = subparsers.add_parser('daemon', parents=[download_options], help='Keep running and download new books on an interval')
+    parser_daemon.add_argument("--interval", default=1800.0, type=float, help="Seconds between syncs")
+    parser_daemon.add_argument("--jitter", default=300.0, type=float, help="Random extra seconds added to every interval")
+    parser_daemon.add_argument("--trigger-socket", default=None, type=str, help="Unix socket that starts a sync when connected to, SIGUSR1 does the same")
+    parser_metadata = subparsers.add_parser('metadata', help='Update metadata and fetch missing covers of downloaded books')
+    parser_import_catalog = subparsers.add_parser('import-catalog', help='Import the json metadata files into the SQLite catalog')
+    parser_probe = subparsers.add_parser('probe', help='Read duration and chapters of audio files that have not been probed yet')
+    parser_split = subparsers.add_parser('split', help='Split probed audio files into one file per chapter, without re-encoding')
 
     args = parser.parse_args()
 
     folder_settings.AUDIO_FOLDER = args.audio_folder
     folder_settings.METADATA_FOLDER = args.metadata_folder
     folder_settings.DOWNLOAD_FOLDER = args.download_folder
+    folder_settings.METADATA_BACKEND = args.metadata_backend
+    folder_settings.METADATA_CATALOG = args.metadata_catalog or os.path.join(args.metadata_folder, 'catalog.sqlite3')
 
     import book_store
     global get_set_of_asins
     get_set_of_asins = book_store.get_set_of_asins
 
+    if args.command == 'import-catalog':
+        count = import_json_folder(folder_settings.METADATA_FOLDER, SqliteMetadataStore(folder_settings.METADATA_CATALOG))
+        _logger.info(f'Imported {count} books into {folder_settings.METADATA_CATALOG}')
+        return
+
+    concurrency = Concurrency(metadata=args.metadata_workers, download=args.download_workers, decrypt=args.decrypt_workers, download_segments=args.download_segments)
+
+    if args.command == 'probe':
+        asyncio.run(probe_audio_files(concurrency))
+        return
+
+    if args.command == 'split':
+        asyncio.run(split_audio_files(concurrency))
+        return
+
+    scheduler = RequestScheduler(
+        limits={AUDIBLE_API_HOST: HostLimits(rate=args.api_rate, burst=args.metadata_workers, max_in_flight=args.max_connections_per_host)},
+        default_limits=HostLimits(max_in_flight=args.max_connections_per_host),
+        max_retries=args.max_retries,
+    )
+
     to_run = None
 
     match args.command:
         case 'download':
-            to_run = download_books_and_metadata
+            to_run = functools.partial(download_accounts, sync_state_path=args.sync_state or os.path.join(args.metadata_folder, '.sync_state'), full_sync=args.full, scheduler=scheduler, stream_decrypt=args.stream_decrypt, native_decrypt=args.decrypter == 'native', report_path=args.report, split_chapters=args.split_chapters, priority=args.priority, bandwidth=BandwidthLimiter(args.bandwidth_limit))
+        case 'daemon':
+            to_run = functools.partial(run_daemon, interval=args.interval, jitter=args.jitter, trigger_socket=args.trigger_socket, sync_state_path=args.sync_state or os.path.join(args.metadata_folder, '.sync_state'), scheduler=scheduler, stream_decrypt=args.stream_decrypt, native_decrypt=args.decrypter == 'native', report_path=args.report, split_chapters=args.split_chapters, priority=args.priority, bandwidth=BandwidthLimiter(args.bandwidth_limit))
         case 'metadata':
-            to_run = update_metadata
+            to_run = functools.partial(update_accounts_metadata, scheduler=scheduler)
 
-    auth = audible.Authenticator.from_file(args.auth_file)
-    client = audible.AsyncClient(auth=auth)
+    auth_files = args.auth_file or [(None, 'audible_auth')]
+    if len(auth_files) > 1 and any(name is None for name, _ in auth_files):
+        parser.error('Every auth file needs a name, NAME=PATH, when syncing several accounts')
+    if len({name for name, _ in auth_files}) < len(auth_files):
+        parser.error('Account names have to be unique')
+    clients = {name: ScheduledAudibleClient(audible.AsyncClient(auth=audible.Authenticator.from_file(path)), scheduler) for name, path in auth_files}
 
     if to_run is None:
         return
 
-    asyncio.run(to_run(client))
+    asyncio.run(to_run(clients, concurrency))
 
 if __name__ == "__main__":
     logging.basicConfig(level=logging.INFO, format='%(message)s')
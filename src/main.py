@@ -1,12 +1,16 @@
 import base64
 import binascii
 import logging
+import math
 import os
 import hashlib
+import hmac
+import json
 import random
 import string
 
-from typing import Any
+from dataclasses import dataclass
+from typing import Callable, Dict, List
 from datetime import datetime, timedelta
 from email.utils import format_datetime
 
@@ -16,12 +20,13 @@ from starlette.applications import Starlette
 from starlette.middleware import Middleware
 from starlette.middleware.authentication import AuthenticationMiddleware
 from starlette.requests import Request
+from starlette.responses import PlainTextResponse
 from starlette.routing import Route, Mount
-from starlette.staticfiles import StaticFiles
 from starlette.templating import Jinja2Templates
 from starlette.config import Config
 
 import folder_settings
+from metrics import CONTENT_TYPE, REGISTRY, Counter, MetricsMiddleware
 
 config = Config(".env")
 
@@ -29,6 +34,12 @@ PODCAST_FEED_IMAGE = config.get("PODCAST_FEED_IMAGE")
 HASH_SALT = bytes(config.get("PODCAST_HASH_SALT", default=''.join(random.choices(string.ascii_letters + string.digits, k=16))), 'utf-8')
 AUTH_ENABLED = config.get("AUTH_ENABLED", cast=bool, default=True)
 HTTP_USER = config.get("HTTP_USERNAME", default="user")
+AUDIO_CACHE_MAX_AGE = config.get("AUDIO_CACHE_MAX_AGE", cast=int, default=30 * 24 * 3600)
+AUDIO_MAX_OPEN_FILES = config.get("AUDIO_MAX_OPEN_FILES", cast=int, default=64)
+COVER_CACHE_MAX_AGE = config.get("COVER_CACHE_MAX_AGE", cast=int, default=365 * 24 * 3600)
+FEED_PAGE_SIZE = config.get("FEED_PAGE_SIZE", cast=int, default=0)
+FEED_STREAM_THRESHOLD = config.get("FEED_STREAM_THRESHOLD", cast=int, default=0)
+FEED_CACHE_MAX_FEEDS = config.get("FEED_CACHE_MAX_FEEDS", cast=int, default=1024)
 
 try:
     HTTP_PASSWORD = config.get("HTTP_PASSWORD")
@@ -38,6 +49,10 @@ except KeyError as exc:
 
 folder_settings.AUDIO_FOLDER = config.get("AUDIO_FOLDER", default="audio_files")
 folder_settings.METADATA_FOLDER = config.get("METADATA_FOLDER", default="metadata_files")
+folder_settings.METADATA_BACKEND = config.get("METADATA_BACKEND", default="json")
+folder_settings.METADATA_CATALOG = config.get("METADATA_CATALOG", default=os.path.join(folder_settings.METADATA_FOLDER, "catalog.sqlite3"))
+
+AUTH_FAILURES = Counter('audible_feed_auth_failures_total', 'Requests with basic auth credentials that were rejected.', ['reason'])
 
 class BasicAuthBackend(AuthenticationBackend):
     async def authenticate(self, conn):
@@ -51,15 +66,20 @@ class BasicAuthBackend(AuthenticationBackend):
                 return
             decoded = base64.b64decode(credentials).decode("ascii")
         except (ValueError, UnicodeDecodeError, binascii.Error) as exc:
+            AUTH_FAILURES.inc('malformed')
             raise AuthenticationError('Invalid basic auth credentials')
 
         username, _, password = decoded.partition(":")
         if username != HTTP_USER or password != HTTP_PASSWORD:
+            AUTH_FAILURES.inc('wrong_credentials')
             return
         return AuthCredentials(["authenticated"]), SimpleUser(username)
 
 from folder_settings import AUDIO_FOLDER
-from book_store import get_all_individual_books, get_series_by_asin, get_podcast_by_asin, get_series, get_podcasts
+from book_store import Book, Library, get_library
+from feed_cache import FeedCache, feed_response, streamed_feed_etag, streamed_feed_response
+from audio_server import AudioFileServer, CoverFileServer, cover_hash
+from cover_art import cover_filename, covers_folder
 
 templates = Jinja2Templates(directory='templates')
 routes = []
@@ -67,43 +87,6 @@ routes = []
 def get_salted_hash(path: str) -> str:
     return hashlib.sha256(HASH_SALT + bytes(path, 'utf-8')).hexdigest()
 
-# Copied from starlette utils
-def get_route_path(scope: dict[str, Any]) -> str:
-    path: str = scope["path"]
-    root_path = scope.get("root_path", "")
-    if not root_path:
-        return path
-
-    if not path.startswith(root_path):
-        return path
-
-    if path == root_path:
-        return ""
-
-    if path[len(root_path)] == "/":
-        return path[len(root_path) :]
-
-    return path
-
-class SaltHashStaticfiles(StaticFiles):
-    def get_path(self, scope: dict[str, Any]) -> str:
-        """
-        Given the ASGI scope, return the `path` string to serve up,
-        with OS specific path separators, and any '..', '.' components removed.
-        """
-        route_path: str = get_route_path(scope)
-        first_path_seperator = route_path.find("/", 1)
-        if len(route_path) <= 1 or first_path_seperator == -1:
-            raise HTTPException(status_code=404)
-        hash_from_url = route_path[1:first_path_seperator]
-        route_path = route_path[first_path_seperator:]
-        computed_hash = get_salted_hash(route_path[1:])
-        if hash_from_url != computed_hash:
-            raise HTTPException(status_code=404)
-        route_path.find("/")
-
-        return os.path.normpath(os.path.join(*route_path.split("/")))
-
 def add_route(path):
     def decorator(f):
         routes.append(Route(path=path, endpoint=f))
@@ -131,128 +114,324 @@ def generate_auth_url_prefix(request: Request):
     url_prefix = f'{scheme}://{HTTP_USER}:{HTTP_PASSWORD}@{host}:{port}' if port else f'{scheme}://{HTTP_USER}:{HTTP_PASSWORD}@{host}'
     return url_prefix
 
+def generate_chapters_url(url_prefix: str, book: Book) -> str | None:
+    if book.media_info is None or not book.media_info.chapters:
+        return None
+    return f'{url_prefix}/chapters/{get_salted_hash(book.audio_file)}/{book.asin}.json'
+
+def cover_image(url_prefix: str, book: Book) -> Dict[str, str]:
+    """The itunes image and the srcset of all cover variants of a book, empty if the book has no cover."""
+    if not book.has_cover:
+        return dict()
+    book_hash = cover_hash(get_salted_hash, book.asin)
+    urls = {size: f'{url_prefix}/cover/{book_hash}/{cover_filename(book.asin, size)}' for size in book.cover_sizes}
+    return {
+        'image_url': urls[book.cover_sizes[0]],
+        'image_srcset': ', '.join(f'{url} {size}w' for size, url in urls.items()),
+    }
+
+def feed_image(url_prefix: str, books: List[Book]) -> Dict[str, str]:
+    """The channel image of a series or podcast is the cover of its first book that has one."""
+    for book in books:
+        if book.has_cover:
+            return cover_image(url_prefix, book)
+    return {'image_url': PODCAST_FEED_IMAGE}
+
 def auth_check(request: Request):
     if AUTH_ENABLED and not request.user.is_authenticated:
         raise HTTPException(status_code=401, headers={'WWW-Authenticate': 'Basic realm="audiobook podcasts"'})
 
+def get_request_library(request: Request) -> Library:
+    """The library of the account in the path of the feed, the merged library of all accounts otherwise."""
+    library = get_library()
+    account = request.path_params.get('account')
+    if account is None:
+        return library
+    if account not in library.accounts:
+        raise HTTPException(status_code=404)
+    return library.accounts[account]
+
+def account_path(request: Request) -> str:
+    account = request.path_params.get('account')
+    return f'/accounts/{account}' if account is not None else ''
+
+feed_cache = FeedCache(FEED_CACHE_MAX_FEEDS)
+
+@dataclass(frozen=True)
+class FeedPage:
+    number: int
+    start: int
+    end: int
+    # RFC 5005 link relation -> url of the page
+    links: Dict[str, str]
+
+def get_feed_page(request: Request, url_prefix: str, item_count: int) -> FeedPage:
+    if FEED_PAGE_SIZE <= 0:
+        return FeedPage(number=1, start=0, end=item_count, links={})
+
+    page_count = max(math.ceil(item_count / FEED_PAGE_SIZE), 1)
+    try:
+        number = int(request.query_params.get('page', '1'))
+    except ValueError:
+        raise HTTPException(status_code=404)
+    if not 1 <= number <= page_count:
+        raise HTTPException(status_code=404)
+
+    query = '?chapters=1&' if use_chapter_episodes(request) else '?'
+
+    def page_url(n: int) -> str:
+        return f'{url_prefix}{request.url.path}{query}page={n}'
+
+    links = {'first': page_url(1), 'last': page_url(page_count)}
+    if number > 1:
+        links['previous'] = page_url(number - 1)
+    if number < page_count:
+        links['next'] = page_url(number + 1)
+
+    start = (number - 1) * FEED_PAGE_SIZE
+    return FeedPage(number=number, start=start, end=min(start + FEED_PAGE_SIZE, item_count), links=links)
+
+def use_chapter_episodes(request: Request) -> bool:
+    return request.query_params.get('chapters') == '1'
+
+def chapter_episode_count(books: List[Book]) -> int:
+    return sum(len(book.chapter_files) if book.chapter_files else 1 for book in books)
+
+def chapter_episodes(url_prefix: str, books: List[Book], page: FeedPage):
+    """Yields the items of a page of a feed with one episode per chapter, books that weren't split are one episode."""
+    episode = 0
+    for book in books:
+        count = len(book.chapter_files) if book.chapter_files else 1
+        if episode + count <= page.start:
+            episode += count
+            continue
+
+        book_hash = get_salted_hash(book.audio_file)
+        image = cover_image(url_prefix, book)
+        pub_date = datetime.strptime(book.pub_date, "%Y-%m-%d")
+        for number, chapter in enumerate(book.chapter_files or [None], start=1):
+            if episode >= page.end:
+                return
+            if episode >= page.start:
+                if chapter is None:
+                    item = {
+                        'title': book.title,
+                        'audio_url': f'{url_prefix}/audio_file/{book_hash}/{book.audio_file}',
+                        'byte_size': book.byte_size,
+                        'duration': round(book.media_info.duration) if book.media_info else None,
+                        'chapters_url': generate_chapters_url(url_prefix, book),
+                        'guid': book.asin,
+                    }
+                else:
+                    item = {
+                        'title': f'{book.title}: {chapter.title}',
+                        'audio_url': f'{url_prefix}/audio_file/{book_hash}/{chapter.filename}',
+                        'byte_size': chapter.size,
+                        'duration': round(chapter.end - chapter.start),
+                        'chapters_url': None,
+                        'guid': f'{book.asin}/{number}',
+                    }
+                # The minutes keep the chapters in order in apps that sort by date
+                yield {
+                    **item,
+                    **image,
+                    'type': 'audio/x-m4a',
+                    'episode': episode,
+                    'pub_date': format_datetime(pub_date + timedelta(minutes=episode)),
+                }
+            episode += 1
+
+def cached_feed_response(request: Request, key: tuple, library: Library, template: str, media_type: str, render_data: Callable[[], dict], item_count: int = 0):
+    # The feeds of an account share the generation of the merged library
+    key = (request.path_params.get('account'),) + key
+    # Large feeds can be streamed instead of cached, so they are never held in memory as a whole. That costs a render
+    # and compression per request, so it's off by default
+    if FEED_STREAM_THRESHOLD and item_count > FEED_STREAM_THRESHOLD:
+        etag = streamed_feed_etag(key, library.generation, library.last_modified)
+        return streamed_feed_response(request, etag, library.last_modified, media_type, lambda: templates.get_template(template).generate(render_data()))
+
+    def render():
+        return templates.get_template(template).render(render_data())
+
+    feed = feed_cache.get(key, library.generation, library.last_modified, media_type, render)
+    return feed_response(request, feed)
+
 @add_route(path='/individual_books')
 def individual_books(request: Request):
     auth_check(request)
-    books = get_all_individual_books()
+    library = get_request_library(request)
 
     url_prefix = generate_book_url_prefix(request)
-
-    items = list()
-
-    for book in books:
-
-        url = f'{url_prefix}/audio_file/{get_salted_hash(book.audio_file)}/{book.audio_file}'
-
-        items.append({
-            'title': book.title,
-            'audio_url': url,
-            'byte_size':  os.stat(f'{AUDIO_FOLDER}/{book.audio_file}').st_size,
-            'type': 'audio/x-m4a',
-            'guid': book.asin,
-            'pub_date': format_datetime(datetime.strptime(book.pub_date, "%Y-%m-%d")),
-        })
-
-    data = {
-        'title': 'Audiobooks not in any series',
-        'description': 'Audiobooks provided as a Podcast Feed for use in Podcast Apps',
-        'image_url': PODCAST_FEED_IMAGE,
-        'items': items
-    }
-    return templates.TemplateResponse(request, 'podcast.xml.j2', data, media_type='text/xml')
+    chapter_mode = use_chapter_episodes(request)
+    page = get_feed_page(request, url_prefix, chapter_episode_count(library.individual_books) if chapter_mode else len(library.individual_books))
+
+    def render_data():
+        def items():
+            for book in library.individual_books[page.start:page.end]:
+
+                url = f'{url_prefix}/audio_file/{get_salted_hash(book.audio_file)}/{book.audio_file}'
+
+                yield {
+                    'title': book.title,
+                    'audio_url': url,
+                    'byte_size': book.byte_size,
+                    'duration': round(book.media_info.duration) if book.media_info else None,
+                    'chapters_url': generate_chapters_url(url_prefix, book),
+                    'type': 'audio/x-m4a',
+                    'guid': book.asin,
+                    'pub_date': format_datetime(datetime.strptime(book.pub_date, "%Y-%m-%d")),
+                    **cover_image(url_prefix, book),
+                }
+
+        return {
+            'title': 'Audiobooks not in any series',
+            'description': 'Audiobooks provided as a Podcast Feed for use in Podcast Apps',
+            'image_url': PODCAST_FEED_IMAGE,
+            'page_links': page.links,
+            'items': chapter_episodes(url_prefix, library.individual_books, page) if chapter_mode else items()
+        }
+
+    return cached_feed_response(request, ('individual_books', url_prefix, page.number, chapter_mode), library, 'podcast.xml.j2', 'text/xml', render_data, page.end - page.start)
 
 @add_route(path='/podcast/{asin}')
 def podcast_series(request: Request):
     auth_check(request)
     asin = request.path_params['asin']
-    podcast = get_podcast_by_asin(asin)
-
-    items = list()
+    library = get_request_library(request)
+    if asin not in library.podcasts:
+        raise HTTPException(status_code=404)
+    podcast = library.podcasts[asin]
 
     url_prefix = generate_book_url_prefix(request)
-
-    counter = 0
-    for book in podcast.books:
-
-        url = f'{url_prefix}/audio_file/{get_salted_hash(book.audio_file)}/{book.audio_file}'
-
-        items.append({
-            'title': book.title,
-            'audio_url': url,
-            'byte_size':  os.stat(f'{AUDIO_FOLDER}/{book.audio_file}').st_size,
-            'type': 'audio/x-m4a',
-            'guid': book.asin,
-            'episode': counter,
-            'pub_date': format_datetime(datetime.strptime(book.pub_date, "%Y-%m-%d") + timedelta(minutes=counter)),
-        })
-        counter += 1
-
-    data = {
-        'title': podcast.title,
-        'description': 'Audiobooks provided as a Podcast Feed for use in Podcast Apps',
-        'image_url': PODCAST_FEED_IMAGE,
-        'items': items
-    }
-
-    return templates.TemplateResponse(request, 'podcast.xml.j2', data, media_type='text/xml')
+    chapter_mode = use_chapter_episodes(request)
+    page = get_feed_page(request, url_prefix, chapter_episode_count(podcast.books) if chapter_mode else len(podcast.books))
+
+    def render_data():
+        def items():
+            counter = page.start
+            for book in podcast.books[page.start:page.end]:
+
+                url = f'{url_prefix}/audio_file/{get_salted_hash(book.audio_file)}/{book.audio_file}'
+
+                yield {
+                    'title': book.title,
+                    'audio_url': url,
+                    'byte_size': book.byte_size,
+                    'duration': round(book.media_info.duration) if book.media_info else None,
+                    'chapters_url': generate_chapters_url(url_prefix, book),
+                    'type': 'audio/x-m4a',
+                    'guid': book.asin,
+                    'episode': counter,
+                    'pub_date': format_datetime(datetime.strptime(book.pub_date, "%Y-%m-%d") + timedelta(minutes=counter)),
+                    **cover_image(url_prefix, book),
+                }
+                counter += 1
+
+        return {
+            'title': podcast.title,
+            'description': 'Audiobooks provided as a Podcast Feed for use in Podcast Apps',
+            **feed_image(url_prefix, podcast.books),
+            'page_links': page.links,
+            'items': chapter_episodes(url_prefix, podcast.books, page) if chapter_mode else items()
+        }
+
+    return cached_feed_response(request, ('podcast', asin, url_prefix, page.number, chapter_mode), library, 'podcast.xml.j2', 'text/xml', render_data, page.end - page.start)
 
 @add_route(path='/')
 def overview(request: Request):
     auth_check(request)
-    series_books = get_series()
-    podcast_books = get_podcasts()
-    individual_books = get_all_individual_books()
-    return templates.TemplateResponse(request, 'overview.html.j2',
-                                      {'series_books': series_books,
-                                       'podcast_books': podcast_books,
-                                       'individual_books': individual_books,
-                                       'url_prefix': generate_auth_url_prefix(request)
-                                       },
-                                      media_type='text/html')
+    library = get_request_library(request)
+    url_prefix = generate_auth_url_prefix(request) + account_path(request)
+    # Only the merged overview links the accounts
+    accounts = get_library().accounts.keys() if not account_path(request) else []
+
+    def render_data():
+        return {'series_books': library.series.values(),
+                'podcast_books': library.podcasts.values(),
+                'individual_books': library.individual_books,
+                'accounts': accounts,
+                'url_prefix': url_prefix
+                }
+
+    return cached_feed_response(request, ('overview', url_prefix), library, 'overview.html.j2', 'text/html', render_data)
 
 @add_route(path='/series/{asin}')
 def book_series(request: Request):
     auth_check(request)
     asin = request.path_params['asin']
-    series = get_series_by_asin(asin)
-
-    items = list()
+    library = get_request_library(request)
+    if asin not in library.series:
+        raise HTTPException(status_code=404)
+    series = library.series[asin]
 
     url_prefix = generate_book_url_prefix(request)
-
-    counter = 0
-    for book in series.books:
-
-        url = f'{url_prefix}/audio_file/{get_salted_hash(book.audio_file)}/{book.audio_file}'
-
-        items.append({
-            'title': book.title,
-            'audio_url': url,
-            'byte_size':  os.stat(f'{AUDIO_FOLDER}/{book.audio_file}').st_size,
-            'type': 'audio/x-m4a',
-            'guid': book.asin,
-            'episode': counter,
-            'pub_date': format_datetime(datetime.strptime(book.pub_date, "%Y-%m-%d") + timedelta(minutes=counter)),
+    chapter_mode = use_chapter_episodes(request)
+    page = get_feed_page(request, url_prefix, chapter_episode_count(series.books) if chapter_mode else len(series.books))
+
+    def render_data():
+        def items():
+            counter = page.start
+            for book in series.books[page.start:page.end]:
+
+                url = f'{url_prefix}/audio_file/{get_salted_hash(book.audio_file)}/{book.audio_file}'
+
+                yield {
+                    'title': book.title,
+                    'audio_url': url,
+                    'byte_size': book.byte_size,
+                    'duration': round(book.media_info.duration) if book.media_info else None,
+                    'chapters_url': generate_chapters_url(url_prefix, book),
+                    'type': 'audio/x-m4a',
+                    'guid': book.asin,
+                    'episode': counter,
+                    'pub_date': format_datetime(datetime.strptime(book.pub_date, "%Y-%m-%d") + timedelta(minutes=counter)),
+                    **cover_image(url_prefix, book),
+                }
+
+                counter += 1
+
+        return {
+            'title': series.title,
+            'description': 'Audiobooks provided as a Podcast Feed for use in Podcast Apps',
+            **feed_image(url_prefix, series.books),
+            'page_links': page.links,
+            'items': chapter_episodes(url_prefix, series.books, page) if chapter_mode else items()
+        }
+
+    return cached_feed_response(request, ('series', asin, url_prefix, page.number, chapter_mode), library, 'podcast.xml.j2', 'text/xml', render_data, page.end - page.start)
+
+@add_route(path='/chapters/{hash}/{asin}.json')
+def chapters(request: Request):
+    # Unauthenticated like the audio files, podcast apps load chapters the same way
+    library = get_library()
+    book = library.books.get(request.path_params['asin'])
+    if book is None or book.media_info is None or not hmac.compare_digest(request.path_params['hash'].encode(), get_salted_hash(book.audio_file).encode()):
+        raise HTTPException(status_code=404)
+
+    def render():
+        return json.dumps({
+            'version': '1.2.0',
+            'chapters': [{'startTime': chapter.start, 'endTime': chapter.end, 'title': chapter.title} for chapter in book.media_info.chapters],
         })
 
-        counter += 1
+    feed = feed_cache.get(('chapters', book.asin), library.generation, library.last_modified, 'application/json+chapters', render)
+    return feed_response(request, feed)
 
-    data = {
-        'title': series.title,
-        'description': 'Audiobooks provided as a Podcast Feed for use in Podcast Apps',
-        'image_url': PODCAST_FEED_IMAGE,
-        'items': items
-    }
+@add_route(path='/metrics')
+def metrics(request: Request):
+    auth_check(request)
 
-    return templates.TemplateResponse(request, 'podcast.xml.j2', data, media_type='text/xml')
+    # The library gauges are set when the index is rebuilt, the refresh only checks for changes
+    get_library()
+    return PlainTextResponse(REGISTRY.render(), media_type=CONTENT_TYPE)
 
-routes.append(Mount('/audio_file', app=SaltHashStaticfiles(directory=AUDIO_FOLDER), name='audio_files'))
+# Every feed also exists per account, the audio files and chapters are shared
+routes.append(Mount('/accounts/{account}', routes=[route for route in routes if route.name in ('overview', 'individual_books', 'podcast_series', 'book_series')]))
+routes.append(Mount('/audio_file', app=AudioFileServer(AUDIO_FOLDER, get_salted_hash, max_open_files=AUDIO_MAX_OPEN_FILES, cache_max_age=AUDIO_CACHE_MAX_AGE), name='audio_files'))
+routes.append(Mount('/cover', app=CoverFileServer(covers_folder(folder_settings.METADATA_FOLDER), get_salted_hash, max_open_files=AUDIO_MAX_OPEN_FILES, cache_max_age=COVER_CACHE_MAX_AGE), name='covers'))
 
 middleware = [
+    Middleware(MetricsMiddleware),
     Middleware(AuthenticationMiddleware, backend=BasicAuthBackend())
 ]
 app = Starlette(debug=True, routes=routes, middleware=middleware)
@@ -0,0 +1,92 @@
+import asyncio
+import json
+import logging
+import os
+from dataclasses import dataclass, asdict
+from typing import List
+
+from audio_store import AudioFile
+
+_logger = logging.getLogger(__name__)
+
+PROBE_SUFFIX = '.probe.json'
+
+@dataclass(frozen=True)
+class Chapter:
+    start: float
+    end: float
+    title: str
+
+@dataclass(frozen=True)
+class MediaInfo:
+    duration: float
+    bit_rate: int | None
+    chapters: List[Chapter]
+
+def probe_filename(audio_folder: str, audio_file: AudioFile) -> str:
+    return os.path.join(audio_folder, audio_file.filename + PROBE_SUFFIX)
+
+def read_media_info(audio_folder: str, audio_file: AudioFile) -> MediaInfo | None:
+    """
+    Returns the probed media info of an audio file from its sidecar file.
+
+    Returns None if there is no sidecar or it was written for a different version of the audio file.
+    """
+    try:
+        with open(probe_filename(audio_folder, audio_file), 'r') as file:
+            probe = json.load(file)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+    if probe.get('size') != audio_file.size or probe.get('mtime_ns') != audio_file.mtime_ns:
+        return None
+
+    return MediaInfo(
+        duration=probe['duration'],
+        bit_rate=probe['bit_rate'],
+        chapters=[Chapter(**chapter) for chapter in probe['chapters']],
+    )
+
+def write_media_info(audio_folder: str, audio_file: AudioFile, media_info: MediaInfo):
+    path = probe_filename(audio_folder, audio_file)
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'w') as file:
+        json.dump({'size': audio_file.size, 'mtime_ns': audio_file.mtime_ns, **asdict(media_info)}, file)
+    os.replace(tmp_path, path)
+
+def _parse_ffprobe(output: dict) -> MediaInfo:
+    fmt = output['format']
+    chapters = [
+        Chapter(
+            start=float(chapter['start_time']),
+            end=float(chapter['end_time']),
+            title=chapter.get('tags', {}).get('title', f'Chapter {i + 1}'),
+        )
+        for i, chapter in enumerate(output.get('chapters', []))
+    ]
+    return MediaInfo(
+        duration=float(fmt['duration']),
+        bit_rate=int(fmt['bit_rate']) if 'bit_rate' in fmt else None,
+        chapters=chapters,
+    )
+
+async def probe(path: str) -> MediaInfo:
+    args = ['-v', 'error', '-print_format', 'json', '-show_format', '-show_chapters', path]
+
+    _logger.debug(f'Running ffprobe with args: {" ".join(args)}')
+    proc = await asyncio.create_subprocess_exec(
+        'ffprobe', *args,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.DEVNULL
+    )
+    stdout, _ = await proc.communicate()
+
+    if proc.returncode != 0:
+        raise RuntimeError(f'ffprobe failed for {path}')
+
+    return _parse_ffprobe(json.loads(stdout))
+
+async def probe_and_store(audio_folder: str, audio_file: AudioFile) -> MediaInfo:
+    media_info = await probe(os.path.join(audio_folder, audio_file.filename))
+    write_media_info(audio_folder, audio_file, media_info)
+    return media_info
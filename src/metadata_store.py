@@ -0,0 +1,287 @@
+import json
+import logging
+import os
+import re
+import sqlite3
+import threading
+from dataclasses import dataclass
+from typing import Dict, Iterable, List, Tuple
+
+import folder_settings
+
+_logger = logging.getLogger(__name__)
+
+GroupedProducts = Tuple[List[Dict], Dict[str, List[Dict]], Dict[str, List[Dict]]]
+
+def is_metadata_file(filename: str) -> bool:
+    return re.fullmatch(r"(?!series)(?!content).*.json", filename) is not None
+
+def group_products(products: Iterable[Dict]) -> GroupedProducts:
+    series_books = dict()
+    podcast_books = dict()
+    individual_books = list()
+
+    for product in products:
+        is_individual = True
+        if 'series' in product:
+            is_individual = False
+            for series in product['series']:
+                if series['asin'] not in series_books:
+                    series_books[series['asin']] = list()
+                series_books[series['asin']].append(product)
+        if 'podcasts' in product:
+            is_individual = False
+            for podcast in product['podcasts']:
+                if podcast['asin'] not in podcast_books:
+                    podcast_books[podcast['asin']] = list()
+                podcast_books[podcast['asin']].append(product)
+        if is_individual:
+            individual_books.append(product)
+
+    for series_asin, book_data in series_books.items():
+        book_data.sort(key=lambda x: list(filter(lambda y: y['asin'] == series_asin, x['series']))[0]['sequence'])
+
+    for podcast_asin, book_data in podcast_books.items():
+        book_data.sort(key=lambda x: float(list(filter(lambda y: y['asin'] == podcast_asin, x['podcasts']))[0]['sort']))
+
+    return individual_books, series_books, podcast_books
+
+@dataclass
+class _MetadataFile:
+    mtime_ns: int
+    product: Dict
+
+class JsonMetadataStore:
+    """
+    Stores the metadata of every book as {asin}.json in the metadata folder, this is the default backend.
+
+    refresh() caches the parsed files and only re-reads the ones whose mtime changed.
+    """
+    def __init__(self, folder: str):
+        self.folder = folder
+        self._files: Dict[str, _MetadataFile] = dict()
+        self._folder_mtime: int | None = None
+
+    def get_set_of_asins(self) -> set:
+        metadata_files = [x for x in os.listdir(self.folder) if is_metadata_file(x)]
+
+        asins = set()
+
+        for metadata_filename in metadata_files:
+            with open(os.path.join(self.folder, metadata_filename), "r") as f:
+                parsed_data = json.load(f)
+                asins.add(parsed_data['product']['asin'])
+
+        return asins
+
+    def read(self, asin: str) -> Dict | None:
+        try:
+            with open(f'{self.folder}/{asin}.json', 'r') as file:
+                return json.load(file)['product']
+        except FileNotFoundError:
+            return None
+
+    def write(self, product: Dict):
+        # Renamed into place, so the web server never reads a half written file
+        path = f'{self.folder}/{product["asin"]}.json'
+        tmp_path = f'{path}.tmp'
+        with open(tmp_path, 'w') as file:
+            file.write(json.dumps({'product': product}))
+        os.replace(tmp_path, path)
+
+    def write_many(self, products: Iterable[Dict]):
+        for product in products:
+            self.write(product)
+
+    def has_changed(self) -> bool:
+        """Cheap check if files were added, removed or renamed since the last refresh."""
+        return os.stat(self.folder).st_mtime_ns != self._folder_mtime
+
+    def refresh(self) -> bool:
+        """Re-reads all changed metadata files, returns True if anything changed."""
+        folder_mtime = os.stat(self.folder).st_mtime_ns
+        changed = False
+        seen = set()
+
+        with os.scandir(self.folder) as it:
+            for entry in it:
+                if not is_metadata_file(entry.name):
+                    continue
+                seen.add(entry.name)
+
+                mtime_ns = entry.stat().st_mtime_ns
+                cached = self._files.get(entry.name)
+                if cached is not None and cached.mtime_ns == mtime_ns:
+                    continue
+
+                try:
+                    with open(entry.path, "r") as metadata_file:
+                        product = json.load(metadata_file)['product']
+                except (OSError, ValueError, KeyError) as e:
+                    # Most likely the file is being written right now, it's picked up on the next refresh
+                    _logger.warning(f'Failed to read metadata file {entry.name}: {e}')
+                    continue
+
+                self._files[entry.name] = _MetadataFile(mtime_ns=mtime_ns, product=product)
+                changed = True
+
+        for filename in self._files.keys() - seen:
+            del self._files[filename]
+            changed = True
+
+        self._folder_mtime = folder_mtime
+        return changed
+
+    def grouped_products(self) -> GroupedProducts:
+        """Groups the products read by the last refresh."""
+        return group_products(x.product for x in self._files.values())
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS books (
+    asin TEXT PRIMARY KEY,
+    title TEXT NOT NULL,
+    release_date TEXT,
+    product TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS series_books (
+    series_asin TEXT NOT NULL,
+    book_asin TEXT NOT NULL REFERENCES books(asin) ON DELETE CASCADE,
+    title TEXT NOT NULL,
+    sequence TEXT NOT NULL,
+    PRIMARY KEY (series_asin, book_asin)
+);
+CREATE INDEX IF NOT EXISTS series_books_by_sequence ON series_books(series_asin, sequence);
+CREATE INDEX IF NOT EXISTS series_books_by_book ON series_books(book_asin);
+CREATE TABLE IF NOT EXISTS podcast_books (
+    podcast_asin TEXT NOT NULL,
+    book_asin TEXT NOT NULL REFERENCES books(asin) ON DELETE CASCADE,
+    title TEXT NOT NULL,
+    sort REAL NOT NULL,
+    PRIMARY KEY (podcast_asin, book_asin)
+);
+CREATE INDEX IF NOT EXISTS podcast_books_by_sort ON podcast_books(podcast_asin, sort);
+CREATE INDEX IF NOT EXISTS podcast_books_by_book ON podcast_books(book_asin);
+"""
+
+class SqliteMetadataStore:
+    """
+    Stores the metadata of all books in a single SQLite catalog.
+
+    Series and podcast memberships are kept in their own indexed tables, so the grouped and sorted
+    library is read with three ordered queries instead of opening every metadata file.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._data_version: int | None = None
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA foreign_keys=ON')
+        self._conn.executescript(_SCHEMA)
+
+    def get_set_of_asins(self) -> set:
+        with self._lock:
+            return {row[0] for row in self._conn.execute('SELECT asin FROM books')}
+
+    def read(self, asin: str) -> Dict | None:
+        with self._lock:
+            row = self._conn.execute('SELECT product FROM books WHERE asin = ?', (asin,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def _write(self, product: Dict):
+        asin = product['asin']
+        self._conn.execute('DELETE FROM series_books WHERE book_asin = ?', (asin,))
+        self._conn.execute('DELETE FROM podcast_books WHERE book_asin = ?', (asin,))
+        self._conn.execute('INSERT OR REPLACE INTO books (asin, title, release_date, product) VALUES (?, ?, ?, ?)',
+                           (asin, product['title'], product.get('release_date'), json.dumps(product)))
+        self._conn.executemany('INSERT OR REPLACE INTO series_books (series_asin, book_asin, title, sequence) VALUES (?, ?, ?, ?)',
+                               [(s['asin'], asin, s['title'], s['sequence']) for s in product.get('series', [])])
+        self._conn.executemany('INSERT OR REPLACE INTO podcast_books (podcast_asin, book_asin, title, sort) VALUES (?, ?, ?, ?)',
+                               [(p['asin'], asin, p['title'], float(p['sort'])) for p in product.get('podcasts', [])])
+
+    def write(self, product: Dict):
+        self.write_many([product])
+
+    def write_many(self, products: Iterable[Dict]):
+        """Writes all products in a single transaction."""
+        with self._lock, self._conn:
+            for product in products:
+                self._write(product)
+
+    def _current_data_version(self) -> int:
+        # data_version changes whenever another connection, e.g. the downloader, commits
+        return self._conn.execute('PRAGMA data_version').fetchone()[0]
+
+    def has_changed(self) -> bool:
+        with self._lock:
+            return self._current_data_version() != self._data_version
+
+    def refresh(self) -> bool:
+        with self._lock:
+            data_version = self._current_data_version()
+            changed = data_version != self._data_version
+            self._data_version = data_version
+            return changed
+
+    def grouped_products(self) -> GroupedProducts:
+        with self._lock:
+            individual_books = [json.loads(row[0]) for row in self._conn.execute(
+                'SELECT product FROM books b '
+                'WHERE NOT EXISTS (SELECT 1 FROM series_books s WHERE s.book_asin = b.asin) '
+                'AND NOT EXISTS (SELECT 1 FROM podcast_books p WHERE p.book_asin = b.asin)')]
+
+            series_books = dict()
+            for series_asin, product in self._conn.execute(
+                    'SELECT s.series_asin, b.product FROM series_books s JOIN books b ON b.asin = s.book_asin '
+                    'ORDER BY s.series_asin, s.sequence'):
+                series_books.setdefault(series_asin, list()).append(json.loads(product))
+
+            podcast_books = dict()
+            for podcast_asin, product in self._conn.execute(
+                    'SELECT p.podcast_asin, b.product FROM podcast_books p JOIN books b ON b.asin = p.book_asin '
+                    'ORDER BY p.podcast_asin, p.sort'):
+                podcast_books.setdefault(podcast_asin, list()).append(json.loads(product))
+
+        return individual_books, series_books, podcast_books
+
+MetadataStore = JsonMetadataStore | SqliteMetadataStore
+
+def write_if_changed(store: MetadataStore, product: Dict) -> bool:
+    """Writes product unless the store already has the same record, returns True if it was written."""
+    try:
+        existing = store.read(product['asin'])
+    except ValueError:
+        existing = None
+    # The round trip turns tuples into lists like in the stored record
+    if existing == json.loads(json.dumps(product)):
+        return False
+    store.write(product)
+    return True
+
+def import_json_folder(folder: str, store: MetadataStore) -> int:
+    """Copies every {asin}.json file from folder into store in one transaction, returns the number of books."""
+    products = list()
+    for metadata_filename in os.listdir(folder):
+        if not is_metadata_file(metadata_filename):
+            continue
+        with open(os.path.join(folder, metadata_filename), 'r') as metadata_file:
+            products.append(json.load(metadata_file)['product'])
+
+    store.write_many(products)
+    return len(products)
+
+_metadata_store: MetadataStore | None = None
+_metadata_store_lock = threading.Lock()
+
+def get_metadata_store() -> MetadataStore:
+    global _metadata_store
+    with _metadata_store_lock:
+        if _metadata_store is None:
+            match folder_settings.METADATA_BACKEND:
+                case 'json':
+                    _metadata_store = JsonMetadataStore(folder_settings.METADATA_FOLDER)
+                case 'sqlite':
+                    _metadata_store = SqliteMetadataStore(folder_settings.METADATA_CATALOG)
+                case backend:
+                    raise ValueError(f'Unknown metadata backend {backend}')
+        return _metadata_store
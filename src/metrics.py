@@ -0,0 +1,148 @@
+import bisect
+import threading
+import time
+from typing import Callable, Dict, List, Sequence, Tuple
+
+LabelValues = Tuple[str, ...]
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _format_labels(names: Sequence[str], values: Sequence[str]) -> str:
+    if not names:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in zip(names, values)) + '}'
+
+def _format_value(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+class Metric:
+    type_name = ''
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._lock = threading.Lock()
+        REGISTRY.register(self)
+
+    def _samples(self) -> List[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.type_name}']
+        with self._lock:
+            lines.extend(self._samples())
+        return '\n'.join(lines)
+
+class Counter(Metric):
+    type_name = 'counter'
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = ()):
+        super().__init__(name, documentation, labels)
+        self._values: Dict[LabelValues, float] = dict()
+
+    def inc(self, *label_values: str, amount: float = 1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def _samples(self) -> List[str]:
+        return [f'{self.name}{_format_labels(self.labels, values)} {_format_value(value)}' for values, value in self._values.items()]
+
+class Gauge(Counter):
+    type_name = 'gauge'
+
+    def dec(self, *label_values: str, amount: float = 1):
+        self.inc(*label_values, amount=-amount)
+
+    def set(self, value: float, *label_values: str):
+        with self._lock:
+            self._values[label_values] = value
+
+class Histogram(Metric):
+    type_name = 'histogram'
+
+    DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets))
+        # Label values -> non-cumulative bucket counts (the last one is +Inf), sum
+        self._values: Dict[LabelValues, Tuple[List[int], float]] = dict()
+
+    def observe(self, value: float, *label_values: str):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts, total = self._values.get(label_values) or ([0] * (len(self.buckets) + 1), 0.0)
+            counts[index] += 1
+            self._values[label_values] = (counts, total + value)
+
+    def _samples(self) -> List[str]:
+        lines = list()
+        for values, (counts, total) in self._values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else _format_value(bound)
+                lines.append(f'{self.name}_bucket{_format_labels(self.labels + ("le",), values + (le,))} {cumulative}')
+            lines.append(f'{self.name}_sum{_format_labels(self.labels, values)} {_format_value(total)}')
+            lines.append(f'{self.name}_count{_format_labels(self.labels, values)} {cumulative}')
+        return lines
+
+class Registry:
+    def __init__(self):
+        self._metrics: List[Metric] = list()
+
+    def register(self, metric: Metric):
+        self._metrics.append(metric)
+
+    def render(self) -> str:
+        """Renders all metrics in the Prometheus text exposition format."""
+        return '\n'.join(metric.render() for metric in self._metrics) + '\n'
+
+REGISTRY = Registry()
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+REQUEST_SECONDS = Histogram('audible_feed_http_request_duration_seconds', 'Time until the response was sent completely.', ['route'])
+REQUESTS = Counter('audible_feed_http_requests_total', 'Handled requests.', ['route', 'method', 'status'])
+RESPONSE_BYTES = Counter('audible_feed_http_response_bytes_total', 'Sent response body bytes, after compression.', ['route'])
+
+def _route_name(scope: dict) -> str:
+    # The router stores the matched endpoint in the scope, its name keeps the number of label values small
+    endpoint = scope.get('endpoint')
+    if endpoint is None:
+        return 'unmatched'
+    return getattr(endpoint, '__name__', type(endpoint).__name__)
+
+class MetricsMiddleware:
+    """Measures latency, status and body size of every http request, labelled with the name of the matched route."""
+    def __init__(self, app: Callable):
+        self.app = app
+
+    async def __call__(self, scope: dict, receive: Callable, send: Callable):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        start = time.perf_counter()
+        status = 500
+        sent = 0
+
+        async def send_and_count(message: dict):
+            nonlocal status, sent
+            if message['type'] == 'http.response.start':
+                status = message['status']
+            elif message['type'] == 'http.response.body':
+                sent += len(message.get('body', b''))
+            elif message['type'] == 'http.response.zerocopysend':
+                sent += message.get('count', 0)
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_and_count)
+        finally:
+            route = _route_name(scope)
+            REQUEST_SECONDS.observe(time.perf_counter() - start, route)
+            REQUESTS.inc(route, scope['method'], str(status))
+            RESPONSE_BYTES.inc(route, amount=sent)
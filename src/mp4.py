@@ -0,0 +1,81 @@
+import os
+import struct
+from typing import BinaryIO, Collection, Iterator, Sequence, Tuple
+
+BoxHeader = Tuple[int, str, int]
+
+def read_box_header(data: bytes, offset: int) -> BoxHeader | None:
+    """
+    Reads the header of the box starting at offset.
+
+    Returns the box size, type and header size, or None if data ends before the header does.
+    A size of 0 means the box extends to the end of the file.
+    """
+    if offset + 8 > len(data):
+        return None
+    size, box_type = struct.unpack_from('>I4s', data, offset)
+    header_size = 8
+    if size == 1:
+        if offset + 16 > len(data):
+            return None
+        size, = struct.unpack_from('>Q', data, offset + 8)
+        header_size = 16
+    return size, box_type.decode('latin-1'), header_size
+
+def first_top_level_box(data: bytes, box_types: Collection[str]) -> str | None:
+    """Returns which of box_types comes first in the top level boxes at the start of a file, None if data is too short to tell."""
+    offset = 0
+    while True:
+        header = read_box_header(data, offset)
+        if header is None:
+            return None
+        size, box_type, header_size = header
+        if box_type in box_types:
+            return box_type
+        if size < header_size:
+            return None
+        offset += size
+
+def iter_boxes(data: bytes, start: int = 0, end: int | None = None) -> Iterator[Tuple[int, int, str, int]]:
+    """Yields offset, size, type and header size of the boxes between start and end."""
+    end = len(data) if end is None else end
+    offset = start
+    while offset < end:
+        header = read_box_header(data, offset)
+        if header is None:
+            raise ValueError(f'Truncated box header at offset {offset}')
+        size, box_type, header_size = header
+        if size == 0:
+            size = end - offset
+        if size < header_size or offset + size > end:
+            raise ValueError(f'Invalid size {size} of box {box_type!r} at offset {offset}')
+        yield offset, size, box_type, header_size
+        offset += size
+
+def find_box(data: bytes, path: Sequence[str], start: int = 0, end: int | None = None) -> Tuple[int, int, int] | None:
+    """Returns offset, size and header size of the first box matching path, a list of nested box types."""
+    for offset, size, box_type, header_size in iter_boxes(data, start, end):
+        if box_type == path[0]:
+            if len(path) == 1:
+                return offset, size, header_size
+            found = find_box(data, path[1:], offset + header_size, offset + size)
+            if found is not None:
+                return found
+    return None
+
+def iter_file_boxes(file: BinaryIO) -> Iterator[Tuple[int, int, str, int]]:
+    """Yields offset, size, type and header size of the top level boxes of a file without reading their content."""
+    file_size = os.fstat(file.fileno()).st_size
+    offset = 0
+    while offset < file_size:
+        file.seek(offset)
+        header = read_box_header(file.read(16), 0)
+        if header is None:
+            raise ValueError(f'Truncated box header at offset {offset}')
+        size, box_type, header_size = header
+        if size == 0:
+            size = file_size - offset
+        if size < header_size:
+            raise ValueError(f'Invalid size {size} of box {box_type!r} at offset {offset}')
+        yield offset, size, box_type, header_size
+        offset += size
@@ -0,0 +1,182 @@
+import asyncio
+import contextlib
+import json
+import logging
+import os
+import time
+from dataclasses import dataclass, field, asdict
+from datetime import datetime, timezone
+from typing import Any, Dict, Iterator, List, Sequence
+
+_logger = logging.getLogger(__name__)
+
+MB = 1024 * 1024
+
+@dataclass
+class StageTiming:
+    seconds: float = 0.0
+    bytes: int = 0
+    failed: bool = False
+
+@dataclass
+class TransferProgress:
+    """Progress of a download, bytes that were already on disk when it started count as done but not towards the rate."""
+    total: int | None = None
+    done: int = 0
+    transferred: int = 0
+    started: float = field(default_factory=time.monotonic)
+    finished: bool = False
+
+    def start(self, total: int | None, done: int):
+        self.total = total
+        self.done = done
+
+    def add(self, count: int):
+        self.done += count
+        self.transferred += count
+
+    @property
+    def rate(self) -> float:
+        elapsed = time.monotonic() - self.started
+        return self.transferred / elapsed if elapsed > 0 else 0.0
+
+    @property
+    def eta(self) -> float | None:
+        if self.total is None or self.rate == 0:
+            return None
+        return max(self.total - self.done, 0) / self.rate
+
+@dataclass
+class BookStats:
+    title: str | None = None
+    # Stage name -> timing, in the order the stages ran
+    stages: Dict[str, StageTiming] = field(default_factory=dict)
+    download: TransferProgress | None = None
+
+    @contextlib.contextmanager
+    def measure(self, stage: str) -> Iterator[StageTiming]:
+        """Times the block as stage, an exception or setting failed on the yielded timing marks the stage as failed."""
+        timing = StageTiming()
+        self.stages[stage] = timing
+        start = time.perf_counter()
+        try:
+            yield timing
+        except BaseException:
+            timing.failed = True
+            raise
+        finally:
+            timing.seconds = time.perf_counter() - start
+
+    def transfer(self) -> TransferProgress:
+        self.download = TransferProgress()
+        return self.download
+
+def _format_duration(seconds: float | None) -> str:
+    if seconds is None:
+        return '?'
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f'{hours}:{minutes:02d}:{seconds:02d}'
+
+class PipelineStats:
+    """
+    Collects the stage timings of the books of a download run, samples the queue depth of the stages and
+    logs the progress of the running downloads.
+
+    The stages only need a name, their queue and the number of busy workers.
+    """
+    SAMPLE_INTERVAL = 5.0
+    LOG_INTERVAL = 10.0
+
+    def __init__(self):
+        self.started = datetime.now(timezone.utc)
+        self._start = time.monotonic()
+        self.books: Dict[str, BookStats] = dict()
+        self.queue_depth: List[Dict[str, Any]] = list()
+        self._stages: Sequence[Any] = ()
+        self._task: asyncio.Task | None = None
+
+    def track(self, asin: str, stats: BookStats):
+        self.books[asin] = stats
+
+    def watch(self, stages: Sequence[Any]):
+        self._stages = stages
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        self._sample()
+
+    async def _run(self):
+        last_log = time.monotonic()
+        while True:
+            self._sample()
+            await asyncio.sleep(self.SAMPLE_INTERVAL)
+            if time.monotonic() - last_log >= self.LOG_INTERVAL:
+                last_log = time.monotonic()
+                self.log_progress()
+
+    def _sample(self):
+        self.queue_depth.append({
+            'seconds': round(time.monotonic() - self._start, 1),
+            'stages': {stage.name: {'queued': stage.queue.qsize(), 'busy': stage.busy} for stage in self._stages},
+        })
+
+    def log_progress(self):
+        for asin, stats in self.books.items():
+            progress = stats.download
+            if progress is None or progress.finished:
+                continue
+            if progress.total:
+                done = f'{progress.done * 100 // progress.total}% of {progress.total / MB:.0f} MB'
+            else:
+                done = f'{progress.done / MB:.0f} MB'
+            _logger.info(f'{stats.title or asin}: {done}, {progress.rate / MB:.1f} MB/s, ETA {_format_duration(progress.eta)}')
+
+        if self._stages:
+            queues = ', '.join(f'{stage.name} {stage.queue.qsize()} queued/{stage.busy} busy' for stage in self._stages)
+            _logger.info(f'Queues: {queues}')
+
+    def summary(self) -> Dict[str, Dict[str, Any]]:
+        """Aggregates the timings of every stage over all books."""
+        summary = dict()
+        for stats in self.books.values():
+            for name, timing in stats.stages.items():
+                stage = summary.setdefault(name, {'books': 0, 'failed': 0, 'seconds': 0.0, 'max_seconds': 0.0, 'bytes': 0})
+                stage['books'] += 1
+                stage['failed'] += timing.failed
+                stage['seconds'] += timing.seconds
+                stage['max_seconds'] = max(stage['max_seconds'], timing.seconds)
+                stage['bytes'] += timing.bytes
+
+        for stage in summary.values():
+            stage['mean_seconds'] = stage['seconds'] / stage['books']
+            # Per worker, the stage concurrency multiplies it
+            stage['mb_per_second'] = stage['bytes'] / MB / stage['seconds'] if stage['bytes'] and stage['seconds'] > 0 else None
+        return summary
+
+    def log_summary(self):
+        for name, stage in self.summary().items():
+            rate = f', {stage["mb_per_second"]:.1f} MB/s' if stage['mb_per_second'] is not None else ''
+            _logger.info(f'{name}: {stage["books"]} books, {stage["failed"]} failed, mean {stage["mean_seconds"]:.1f}s, max {stage["max_seconds"]:.1f}s{rate}')
+
+    def report(self) -> Dict[str, Any]:
+        return {
+            'started': self.started.isoformat(),
+            'seconds': time.monotonic() - self._start,
+            'stages': self.summary(),
+            'queue_depth': self.queue_depth,
+            'books': {
+                asin: {'title': stats.title, 'stages': {name: asdict(timing) for name, timing in stats.stages.items()}}
+                for asin, stats in self.books.items()
+            },
+        }
+
+    def write_report(self, path: str):
+        tmp_path = f'{path}.tmp'
+        with open(tmp_path, 'w') as file:
+            json.dump(self.report(), file, indent=2)
+        os.replace(tmp_path, path)
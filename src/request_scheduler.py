@@ -0,0 +1,178 @@
+import asyncio
+import logging
+import random
+import time
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from typing import Any, Awaitable, Callable, Dict, TypeVar
+
+import audible
+import httpx
+from audible.exceptions import NetworkError, NotResponding, RequestError, StatusError
+
+_logger = logging.getLogger(__name__)
+
+T = TypeVar('T')
+
+AUDIBLE_API_HOST = 'audible-api'
+
+@dataclass
+class HostLimits:
+    # Requests per second, None for no rate limit
+    rate: float | None = None
+    burst: int = 1
+    max_in_flight: int = 8
+
+class TokenBucket:
+    """
+    Rate limit that halves its rate when the server throttles and slowly recovers on success.
+
+    pause() blocks all requests until a Retry-After time has passed.
+    """
+    MIN_RATE = 0.1
+
+    def __init__(self, rate: float, burst: int):
+        self.max_rate = rate
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+
+                self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+    def pause(self, seconds: float):
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    def throttled(self):
+        self.rate = max(self.MIN_RATE, self.rate / 2)
+        _logger.info(f'Throttled, reducing request rate to {self.rate:.2f}/s')
+
+    def succeeded(self):
+        self.rate = min(self.max_rate, self.rate + self.max_rate / 20)
+
+class _Host:
+    def __init__(self, limits: HostLimits):
+        self.semaphore = asyncio.Semaphore(limits.max_in_flight)
+        self.bucket = TokenBucket(limits.rate, limits.burst) if limits.rate else None
+
+def _status_code(exc: Exception) -> int | None:
+    if isinstance(exc, StatusError):
+        return exc.code
+    if isinstance(exc, httpx.HTTPStatusError):
+        return exc.response.status_code
+    return None
+
+def _retry_after(exc: Exception) -> float | None:
+    response = getattr(exc, 'response', None)
+    if response is None or 'Retry-After' not in response.headers:
+        return None
+    value = response.headers['Retry-After']
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+def is_retryable(exc: Exception) -> bool:
+    """Throttling, server errors and transport errors are worth retrying, other errors won't go away."""
+    status_code = _status_code(exc)
+    if status_code is not None:
+        return status_code == 429 or status_code >= 500
+    return isinstance(exc, (NotResponding, NetworkError, httpx.TransportError)) or type(exc) is RequestError
+
+class RequestScheduler:
+    """
+    Shared scheduler for all requests to the audible api and the CDN.
+
+    Requests are limited per host by a token bucket and the number of requests in flight. Throttled,
+    failed and interrupted requests are retried with jittered exponential backoff, honoring Retry-After.
+    """
+    def __init__(self, limits: Dict[str, HostLimits] | None = None, default_limits: HostLimits = HostLimits(),
+                 max_retries: int = 5, base_delay: float = 1.0, max_delay: float = 60.0):
+        self.limits = limits if limits is not None else dict()
+        self.default_limits = default_limits
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self._hosts: Dict[str, _Host] = dict()
+
+    def _host(self, host: str) -> _Host:
+        if host not in self._hosts:
+            self._hosts[host] = _Host(self.limits.get(host, self.default_limits))
+        return self._hosts[host]
+
+    @asynccontextmanager
+    async def slot(self, host: str):
+        """Waits for the rate limit and a free in-flight slot of host, the slot is held until the block exits."""
+        state = self._host(host)
+        async with state.semaphore:
+            if state.bucket is not None:
+                await state.bucket.acquire()
+            yield
+
+    def backoff(self, attempt: int) -> float:
+        delay = min(self.max_delay, self.base_delay * 2 ** attempt)
+        return random.uniform(delay / 2, delay)
+
+    async def call(self, host: str, request: Callable[[], Awaitable[T]]) -> T:
+        """Runs request in a slot of host and retries it until it succeeds, fails permanently or runs out of retries."""
+        state = self._host(host)
+        attempt = 0
+        while True:
+            try:
+                async with self.slot(host):
+                    result = await request()
+                if state.bucket is not None:
+                    state.bucket.succeeded()
+                return result
+            except Exception as e:
+                if not is_retryable(e) or attempt >= self.max_retries:
+                    raise
+
+                delay = self.backoff(attempt)
+                retry_after = _retry_after(e)
+                if retry_after is not None:
+                    delay = retry_after + random.uniform(0, self.base_delay)
+                if _status_code(e) == 429 and state.bucket is not None:
+                    state.bucket.throttled()
+                    state.bucket.pause(delay)
+
+                attempt += 1
+                _logger.warning(f'Request to {host} failed ({e}), retry {attempt}/{self.max_retries} in {delay:.1f}s')
+                await asyncio.sleep(delay)
+
+class ScheduledAudibleClient:
+    """Sends all requests of an audible.AsyncClient through a RequestScheduler."""
+    def __init__(self, client: audible.AsyncClient, scheduler: RequestScheduler):
+        self.client = client
+        self.scheduler = scheduler
+
+    @property
+    def auth(self) -> audible.Authenticator:
+        return self.client.auth
+
+    async def get(self, path: str, **kwargs: Any) -> Any:
+        return await self.scheduler.call(AUDIBLE_API_HOST, lambda: self.client.get(path, **kwargs))
+
+    async def post(self, path: str, **kwargs: Any) -> Any:
+        return await self.scheduler.call(AUDIBLE_API_HOST, lambda: self.client.post(path, **kwargs))
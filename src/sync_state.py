@@ -0,0 +1,125 @@
+import dataclasses
+import json
+import os
+import time
+from dataclasses import dataclass
+from typing import Dict, Iterable
+
+# Marks are written at most this often, the rest is saved at the end of a run
+SAVE_INTERVAL = 5.0
+
+# A book that failed is retried after this many seconds, doubled with every further failure up to RETRY_MAX_INTERVAL
+RETRY_INTERVAL = 3600.0
+RETRY_MAX_INTERVAL = 7 * 24 * 3600.0
+
+@dataclass
+class BookStatus:
+    metadata: bool = False
+    downloaded: bool = False
+    decrypted: bool = False
+    # Runs that failed to complete the book and the unix time of the last one
+    failures: int = 0
+    last_failure: float | None = None
+
+    @property
+    def complete(self) -> bool:
+        return self.metadata and self.decrypted
+
+    def retry_due(self, now: float) -> bool:
+        if self.failures == 0 or self.last_failure is None:
+            return True
+        return now >= self.last_failure + min(RETRY_INTERVAL * 2 ** (self.failures - 1), RETRY_MAX_INTERVAL)
+
+class SyncState:
+    """
+    Checkpoint of the last download run, persisted as json.
+
+    Holds the newest purchase seen in the library and the processing status of every book, so a
+    scheduled run can page the library newest first and stop at the first book it already has.
+    A state without a path is only kept in memory.
+
+    Books that keep failing are retried with a growing interval, until then they don't count as incomplete,
+    so one broken book doesn't turn every run into a full library walk.
+    """
+    def __init__(self, path: str | None, last_purchase_date: str | None = None, last_asin: str | None = None, books: Dict[str, BookStatus] | None = None):
+        self.path = path
+        self.last_purchase_date = last_purchase_date
+        self.last_asin = last_asin
+        self.books = books if books is not None else dict()
+        self._last_save = time.monotonic()
+
+    @classmethod
+    def load(cls, path: str) -> 'SyncState | None':
+        try:
+            with open(path, 'r') as file:
+                data = json.load(file)
+        except FileNotFoundError:
+            return None
+        return cls(
+            path=path,
+            last_purchase_date=data.get('last_purchase_date'),
+            last_asin=data.get('last_asin'),
+            books={asin: BookStatus(**status) for asin, status in data.get('books', {}).items()},
+        )
+
+    @classmethod
+    def bootstrap(cls, path: str | None, asins_with_metadata: Iterable[str], asins_with_audio: Iterable[str]) -> 'SyncState':
+        """Creates the state for an existing library, that was synced before the state existed."""
+        state = cls(path)
+        for asin in asins_with_metadata:
+            state.status(asin).metadata = True
+        for asin in asins_with_audio:
+            status = state.status(asin)
+            status.downloaded = True
+            status.decrypted = True
+        return state
+
+    def save(self):
+        if self.path is None:
+            return
+        tmp_path = f'{self.path}.tmp'
+        with open(tmp_path, 'w') as file:
+            json.dump({
+                'last_purchase_date': self.last_purchase_date,
+                'last_asin': self.last_asin,
+                'books': {asin: dataclasses.asdict(status) for asin, status in self.books.items()},
+            }, file)
+        os.replace(tmp_path, self.path)
+        self._last_save = time.monotonic()
+
+    def status(self, asin: str) -> BookStatus:
+        if asin not in self.books:
+            self.books[asin] = BookStatus()
+        return self.books[asin]
+
+    def mark(self, asin: str, **flags: bool):
+        """Updates the status flags of a book, the state is persisted at most every SAVE_INTERVAL seconds."""
+        status = self.status(asin)
+        for flag, value in flags.items():
+            setattr(status, flag, value)
+        if time.monotonic() - self._last_save >= SAVE_INTERVAL:
+            self.save()
+
+    def failed(self, asin: str):
+        """Records a run that didn't complete the book."""
+        status = self.status(asin)
+        status.failures += 1
+        status.last_failure = time.time()
+
+    def retry_due(self, asin: str) -> bool:
+        return asin not in self.books or self.books[asin].retry_due(time.time())
+
+    def is_complete(self, asin: str) -> bool:
+        return asin in self.books and self.books[asin].complete
+
+    def has_incomplete(self) -> bool:
+        """True if a book is incomplete and due for a retry."""
+        now = time.time()
+        return any(not status.complete and status.retry_due(now) for status in self.books.values())
+
+    def saw_purchase(self, item: dict):
+        """Remembers the newest purchase of the library."""
+        purchase_date = item.get('purchase_date')
+        if purchase_date is not None and (self.last_purchase_date is None or purchase_date > self.last_purchase_date):
+            self.last_purchase_date = purchase_date
+            self.last_asin = item['asin']